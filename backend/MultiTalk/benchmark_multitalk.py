@@ -0,0 +1,432 @@
+"""
+Stage-by-stage benchmark of the MultiTalk generation path.
+
+Builds miniature, randomly initialized versions of the wav2vec2 audio encoder,
+T5 encoder, CLIP vision tower, Wan VAE and MultiTalk DiT (including its
+AudioProjModel) and times every stage of `generate_multitalk.generate` on
+synthetic inputs: audio prep, wav2vec, T5, CLIP, VAE encode, each sampling
+step, VAE decode and mux. Runs on CPU; no checkpoints are needed.
+
+The sampling steps go through `MultiTalkPipeline.forward_samples`,
+`get_sample_scheduler` and `step_latent`, so --sample_solver, --batched_cfg and
+--use_teacache time the same code the pipeline runs.
+
+    python benchmark_multitalk.py --output bench.json
+    python benchmark_multitalk.py --output new.json --compare bench.json
+
+The JSON results record the git commit, so runs of different commits can be
+compared with --compare.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+warnings.filterwarnings('ignore')
+
+import numpy as np
+import soundfile as sf
+import torch
+import torch.nn.functional as F
+from transformers import Wav2Vec2Config, Wav2Vec2FeatureExtractor
+
+from generate_multitalk import audio_prepare_multi, audio_prepare_single, get_embedding
+from src.audio_analysis.wav2vec2 import Wav2Vec2Model
+from wan.modules.attention import ATTENTION_BACKENDS, select_attention_backend
+from wan.modules.clip import VisionTransformer
+from wan.modules.multitalk_model import WanModel
+from wan.modules.t5 import T5Encoder
+from wan.modules.vae import WanVAE_
+from wan.multitalk import MultiTalkPipeline
+from wan.utils.multitalk_utils import save_video_ffmpeg
+from wan.utils.teacache import TeaCache
+
+# AudioProjModel consumes all 12 hidden states of the 768-dim wav2vec2-base
+WAV2VEC_LAYERS = 12
+WAV2VEC_DIM = 768
+AUDIO_WINDOW = 5
+SAMPLE_RATE = 16000
+FPS = 25
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the MultiTalk pipeline stages on a tiny random model")
+    parser.add_argument("--device", type=str, default="cpu",
+                        help="Device to run on, e.g. 'cpu' or 'cuda:0'.")
+    parser.add_argument("--dtype", type=str, default="float32",
+                        choices=["float32", "bfloat16", "float16"],
+                        help="Parameter dtype of the DiT.")
+    parser.add_argument("--size", type=str, default="64*64",
+                        help="Output video size as height*width, multiples of 16.")
+    parser.add_argument("--frame_num", type=int, default=17,
+                        help="Frames per clip, 4n+1.")
+    parser.add_argument("--sample_steps", type=int, default=4,
+                        help="Sampling steps per run.")
+    parser.add_argument("--sample_solver", type=str, default="euler",
+                        choices=["euler", "unipc", "dpm++"],
+                        help="The solver used to sample.")
+    parser.add_argument("--sample_shift", type=float, default=5.0,
+                        help="Sampling shift factor for flow matching schedulers.")
+    parser.add_argument("--batched_cfg", action="store_true", default=False,
+                        help="Run the three guidance branches as one batched DiT forward per step.")
+    parser.add_argument("--use_teacache", action="store_true", default=False,
+                        help="Enable teacache, it skips nothing before step 5.")
+    parser.add_argument("--teacache_thresh", type=float, default=0.2,
+                        help="Threshold for teacache.")
+    parser.add_argument("--num_persons", type=int, default=2, choices=[1, 2],
+                        help="Number of conditioning audio tracks.")
+    parser.add_argument("--dim", type=int, default=128, help="DiT hidden size.")
+    parser.add_argument("--num_layers", type=int, default=2, help="DiT blocks.")
+    parser.add_argument("--num_heads", type=int, default=2, help="DiT attention heads.")
+    parser.add_argument("--vae_dim", type=int, default=16, help="VAE base channels.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs, after one untimed warmup run.")
+    parser.add_argument("--attention_backend", type=str, default="auto",
+                        choices=["auto", "autotune"] + list(ATTENTION_BACKENDS),
+                        help="Attention backend to benchmark.")
+    parser.add_argument("--skip_mux", action="store_true", default=False,
+                        help="Do not time the ffmpeg mux stage.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the JSON results file.")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="JSON results of an earlier run to compare against.")
+    args = parser.parse_args(argv)
+    assert (args.frame_num - 1) % 4 == 0, "frame_num should be 4n+1."
+    return args
+
+
+class StageTimer:
+    """Collects wall time, and peak CUDA memory on GPUs, per named stage."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.enabled = True
+        self.times = defaultdict(list)
+        self.peak_memory = defaultdict(int)
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def __call__(self, name):
+        self._sync()
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        start = time.perf_counter()
+        yield
+        self._sync()
+        if self.enabled:
+            self.times[name].append(time.perf_counter() - start)
+            if self.device.type == 'cuda':
+                self.peak_memory[name] = max(
+                    self.peak_memory[name],
+                    torch.cuda.max_memory_allocated(self.device))
+
+    def summary(self):
+        stages = {}
+        for name, times in self.times.items():
+            stages[name] = {
+                'runs': len(times),
+                'mean': float(np.mean(times)),
+                'median': float(np.median(times)),
+                'min': float(np.min(times)),
+                'max': float(np.max(times)),
+            }
+            if name in self.peak_memory:
+                stages[name]['peak_memory_bytes'] = self.peak_memory[name]
+        return stages
+
+
+def build_models(args, device, dtype):
+    """Tiny, randomly initialized stand-ins for every model of the pipeline."""
+    torch.manual_seed(args.seed)
+    wav2vec_config = Wav2Vec2Config(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        conv_dim=(32,) * 7,
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=4,
+    )
+    audio_encoder = Wav2Vec2Model(wav2vec_config).eval()
+    audio_encoder.feature_extractor._freeze_parameters()
+    feature_extractor = Wav2Vec2FeatureExtractor()
+
+    text_dim = 64
+    text_encoder = T5Encoder(
+        vocab=1000,
+        dim=text_dim,
+        dim_attn=text_dim,
+        dim_ffn=2 * text_dim,
+        num_heads=2,
+        num_layers=2,
+        num_buckets=32).eval().to(device)
+
+    clip = VisionTransformer(
+        # 224 / 14 gives the 257 image tokens the DiT cross attention expects
+        image_size=224,
+        patch_size=14,
+        dim=64,
+        mlp_ratio=2,
+        out_dim=None,
+        num_heads=2,
+        num_layers=3,
+        activation='gelu').eval().to(device)
+
+    vae = WanVAE_(
+        dim=args.vae_dim,
+        z_dim=16,
+        dim_mult=[1, 2, 4, 4],
+        num_res_blocks=1,
+        attn_scales=[],
+        temperal_downsample=[False, True, True]).eval().to(device)
+
+    model = WanModel(
+        model_type='i2v',
+        patch_size=(1, 2, 2),
+        text_len=64,
+        in_dim=36,
+        dim=args.dim,
+        ffn_dim=2 * args.dim,
+        freq_dim=256,
+        text_dim=text_dim,
+        out_dim=16,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        audio_window=AUDIO_WINDOW,
+        intermediate_dim=64,
+        output_dim=WAV2VEC_DIM,
+        context_tokens=4,
+        vae_scale=4).eval().to(device=device, dtype=dtype)
+
+    # the tiny CLIP tower feeds the DiT image projection through a fixed random map
+    clip_to_dit = torch.randn(clip.dim, 1280, device=device) / math.sqrt(clip.dim)
+    # the attributes of MultiTalkPipeline the sampling methods use
+    pipeline = SimpleNamespace(model=model, device=device, num_timesteps=1000, use_timestep_transform=True)
+    return dict(
+        audio_encoder=audio_encoder,
+        feature_extractor=feature_extractor,
+        text_encoder=text_encoder,
+        clip=clip,
+        clip_to_dit=clip_to_dit,
+        vae=vae,
+        model=model,
+        pipeline=pipeline,
+    )
+
+
+def write_synthetic_audio(work_dir, num_persons, duration):
+    """Write `num_persons` speech-like test tones and return their paths."""
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    paths = []
+    for i in range(num_persons):
+        # an amplitude-modulated tone, loud enough for loudness normalization
+        wave = 0.3 * np.sin(2 * np.pi * (180 + 60 * i) * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2
+        path = os.path.join(work_dir, f'person{i + 1}.wav')
+        sf.write(path, wave.astype(np.float32), SAMPLE_RATE)
+        paths.append(path)
+    return paths
+
+
+def window_audio(audio_emb, frame_num):
+    """[F, L, C] wav2vec2 features to the [F, W, S, C] windows fed to the DiT."""
+    indices = torch.arange(AUDIO_WINDOW) - AUDIO_WINDOW // 2
+    center = torch.arange(frame_num).clamp(max=audio_emb.shape[0] - 1)
+    indices = (center.unsqueeze(1) + indices.unsqueeze(0)).clamp(0, audio_emb.shape[0] - 1)
+    audio_emb = audio_emb[indices]
+    # the tiny wav2vec2 has fewer and narrower hidden states than AudioProjModel expects
+    layers, dim = audio_emb.shape[-2:]
+    audio_emb = audio_emb.repeat_interleave(math.ceil(WAV2VEC_LAYERS / layers), dim=-2)[..., :WAV2VEC_LAYERS, :]
+    return F.pad(audio_emb, (0, WAV2VEC_DIM - dim))
+
+
+def run_once(args, models, timer, work_dir, device, dtype):
+    """One pass over every stage, returns the TeaCache stats of the sampling stage."""
+    height, width = [int(v) for v in args.size.split('*')]
+    lat_t = (args.frame_num - 1) // 4 + 1
+    lat_h, lat_w = height // 8, width // 8
+    duration = args.frame_num / FPS + 0.2
+
+    # audio prep
+    audio_paths = write_synthetic_audio(work_dir, args.num_persons, duration)
+    with timer('audio_prep'):
+        if args.num_persons == 2:
+            speech1, speech2, sum_speech = audio_prepare_multi(audio_paths[0], audio_paths[1], 'para')
+            speeches = [speech1, speech2]
+        else:
+            sum_speech = audio_prepare_single(audio_paths[0])
+            speeches = [sum_speech]
+    sum_audio_path = os.path.join(work_dir, 'sum.wav')
+    sf.write(sum_audio_path, sum_speech, SAMPLE_RATE)
+
+    # wav2vec
+    with timer('wav2vec'):
+        audio_embs = [
+            get_embedding(speech, models['feature_extractor'], models['audio_encoder'])
+            for speech in speeches
+        ]
+    audio = torch.stack([window_audio(emb, args.frame_num) for emb in audio_embs]).to(device=device, dtype=dtype)
+
+    # T5, for the prompt and the negative prompt
+    with timer('t5'), torch.no_grad():
+        ids = torch.randint(2, 1000, (2, 48), device=device)
+        mask = torch.ones_like(ids)
+        context, context_null = models['text_encoder'](ids, mask).to(dtype).unbind(0)
+
+    # CLIP on the conditioning frame
+    cond_image = torch.rand(1, 3, 1, height, width, device=device) * 2 - 1
+    with timer('clip'), torch.no_grad():
+        clip = models['clip']
+        image = F.interpolate(cond_image[:, :, -1], size=(clip.image_size,) * 2, mode='bicubic', align_corners=False)
+        clip_fea = clip(image, use_31_block=True) @ models['clip_to_dit']
+        clip_fea = clip_fea.to(dtype)
+
+    # VAE encode of the conditioning frame followed by zero frames
+    with timer('vae_encode'), torch.no_grad():
+        video = torch.cat([cond_image, cond_image.new_zeros(1, 3, args.frame_num - 1, height, width)], dim=2)
+        latent = models['vae'].encode(video, [0, 1])[0]
+    msk = torch.ones(1, args.frame_num, lat_h, lat_w, device=device)
+    msk[:, 1:] = 0
+    msk = torch.cat([torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]], dim=1)
+    msk = msk.view(1, lat_t, 4, lat_h, lat_w).transpose(1, 2)[0]
+    y = torch.cat([msk, latent], dim=0).to(dtype)
+
+    ref_target_masks = torch.zeros(args.num_persons + 1, lat_h, lat_w, device=device)
+    for i in range(args.num_persons):
+        ref_target_masks[i, :, i * lat_w // args.num_persons:(i + 1) * lat_w // args.num_persons] = 1
+    ref_target_masks[-1] = 1 - ref_target_masks[:-1].sum(0)
+
+    # sampling, the three guidance branches as the pipeline yields them
+    pipeline = models['pipeline']
+    teacache = None
+    if args.use_teacache:
+        teacache = TeaCache(sample_steps=args.sample_steps, teacache_thresh=args.teacache_thresh)
+    arg_c = dict(context=context, clip_fea=clip_fea, seq_len=lat_t * lat_h * lat_w // 4, y=y.unsqueeze(0),
+                 audio=audio, ref_target_masks=ref_target_masks, teacache=teacache, teacache_branch='cond')
+    arg_null_text = dict(arg_c, context=context_null, teacache_branch='drop_text')
+    arg_null = dict(arg_null_text, audio=torch.zeros_like(audio)[-1:], teacache_branch='uncond')
+    latents = torch.randn(16, lat_t, lat_h, lat_w, device=device)
+    with torch.no_grad():
+        sample_scheduler, timesteps = MultiTalkPipeline.get_sample_scheduler(
+            pipeline, args.sample_solver, args.sample_steps, args.sample_shift)
+        for i in range(len(timesteps) - 1):
+            samples = [dict(arg, x=latents, t=timesteps[i]) for arg in (arg_c, arg_null_text, arg_null)]
+            with timer(f'sampling_step_{i}'):
+                if args.batched_cfg:
+                    noise_pred_cond, noise_pred_drop_text, noise_pred_uncond = \
+                        MultiTalkPipeline.forward_samples(pipeline, samples)
+                else:
+                    noise_pred_cond, noise_pred_drop_text, noise_pred_uncond = [
+                        MultiTalkPipeline.forward_samples(pipeline, [sample])[0] for sample in samples]
+                noise_pred = noise_pred_uncond + 5.0 * (noise_pred_cond - noise_pred_drop_text) \
+                    + 4.0 * (noise_pred_drop_text - noise_pred_uncond)
+                latents = MultiTalkPipeline.step_latent(pipeline, sample_scheduler, timesteps, i, latents, noise_pred)
+
+    # VAE decode
+    with timer('vae_decode'), torch.no_grad():
+        video = models['vae'].decode(latents.unsqueeze(0), [0, 1])[0].float().clamp_(-1, 1)
+
+    # mux
+    if not args.skip_mux:
+        with timer('mux'):
+            save_video_ffmpeg(video.cpu(), os.path.join(work_dir, 'result'), [sum_audio_path], fps=FPS)
+
+    return teacache.stats() if teacache is not None else None
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline):
+    """Log the mean time of every stage next to the baseline run."""
+    logging.info(f"Comparing against {baseline.get('commit')} ({baseline.get('timestamp')})")
+    logging.info(f"{'stage':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            logging.info(f"{name:<24}{'-':>12}{stage['mean']:>12.4f}{'-':>10}")
+            continue
+        old = baseline['stages'][name]['mean']
+        change = (stage['mean'] - old) / old * 100 if old else float('nan')
+        logging.info(f"{name:<24}{old:>12.4f}{stage['mean']:>12.4f}{change:>+9.1f}%")
+
+
+def benchmark(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+    if not args.skip_mux and shutil.which('ffmpeg') is None:
+        logging.warning("ffmpeg not found, skipping the mux stage.")
+        args.skip_mux = True
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    # autotune times the kernels on the benchmark's own DiT sequence
+    height, width = [int(v) for v in args.size.split('*')]
+    seq_len = ((args.frame_num - 1) // 4 + 1) * (height // 16) * (width // 16)
+    select_attention_backend(args.attention_backend, device, args.num_heads,
+                             args.dim // args.num_heads, dtype, seq_len=seq_len)
+    models = build_models(args, device, dtype)
+    timer = StageTimer(device)
+
+    for run in range(args.repeat + 1):
+        # the first run warms up kernels and caches and is not recorded
+        timer.enabled = run > 0
+        with tempfile.TemporaryDirectory() as work_dir:
+            teacache_stats = run_once(args, models, timer, work_dir, device, dtype)
+        logging.info(f"Finished {'warmup' if run == 0 else f'run {run}/{args.repeat}'}.")
+
+    stages = timer.summary()
+    step_names = [name for name in stages if name.startswith('sampling_step_')]
+    stages['sampling_total'] = {
+        'runs': args.repeat,
+        'mean': sum(stages[name]['mean'] for name in step_names),
+    }
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'device': str(device),
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'config': vars(args),
+        'teacache_stats': teacache_stats,
+        'stages': stages,
+    }
+
+    for name, stage in stages.items():
+        logging.info(f"{name:<24}{stage['mean']:>10.4f}s")
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(results, json.load(f))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Saved results to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    benchmark(args)
@@ -18,17 +18,18 @@ import subprocess
 
 import wan
 from wan.configs import SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
+from wan.modules.attention import ATTENTION_BACKENDS, select_attention_backend
 from wan.utils.utils import cache_image, cache_video, str2bool
-from wan.utils.multitalk_utils import save_video_ffmpeg
+from wan.utils.multitalk_utils import StreamingVideoWriter, save_video_ffmpeg
 
 from transformers import Wav2Vec2FeatureExtractor
 from src.audio_analysis.wav2vec2 import Wav2Vec2Model
+from src.audio_analysis.embedding_cache import AudioEmbeddingCache
 
 import librosa
 import pyloudnorm as pyln
 import numpy as np
 from einops import rearrange
-import soundfile as sf
 
 def _validate_args(args):
     # Basic check
@@ -55,7 +56,7 @@ def _validate_args(args):
         task], f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
 
 
-def _parse_args():
+def _parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description="Generate a image or video from a text prompt or image using Wan"
     )
@@ -128,7 +129,17 @@ def _parse_args():
         "--audio_save_dir",
         type=str,
         default='save_audio',
-        help="The path to save the audio embedding.")
+        help="The path to save the audio embedding. Embeddings are cached there by audio content.")
+    parser.add_argument(
+        "--audio_cache_max_gb",
+        type=float,
+        default=10,
+        help="Size limit of the audio embedding cache, least recently used entries are evicted beyond it.")
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help="The path to persist T5 prompt embeddings in. If not set, they are only cached in memory.")
     parser.add_argument(
         "--base_seed",
         type=int,
@@ -152,6 +163,12 @@ def _parse_args():
         help="clip: generate one video chunk, streaming: long video generation")
     parser.add_argument(
         "--sample_steps", type=int, default=None, help="The sampling steps.")
+    parser.add_argument(
+        "--sample_solver",
+        type=str,
+        default='euler',
+        choices=['euler', 'unipc', 'dpm++'],
+        help="The solver used to sample. unipc and dpm++ reach the quality of 40 euler steps in about 15-20 steps.")
     parser.add_argument(
         "--sample_shift",
         type=float,
@@ -174,6 +191,18 @@ def _parse_args():
         required=False,
         help="Maximum parameter quantity retained in video memory, small number to reduce VRAM required",
     )
+    parser.add_argument(
+        "--vram_streaming",
+        action="store_true",
+        default=False,
+        help="With --num_persistent_param_in_dit, stream the overflowing DiT blocks from pinned host memory, prefetching the next block while the current one computes.",
+    )
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        default=False,
+        help="Encode and decode with the VAE in overlapping spatial tiles to reduce its peak memory.",
+    )
     parser.add_argument(
         "--use_teacache",
         action="store_true",
@@ -186,6 +215,62 @@ def _parse_args():
         default=0.2,
         help="Threshold for teacache."
     )
+    parser.add_argument(
+        "--clip_checkpoint_dir",
+        type=str,
+        default=None,
+        help="Save a checkpoint after every clip of a multi-clip render under this directory, one subdirectory per job. Rerunning the same job resumes from its last completed clip.",
+    )
+    parser.add_argument(
+        "--memory_release",
+        type=str,
+        default="stage",
+        choices=["always", "stage", "never"],
+        help="When generation returns cached CUDA memory: after every DiT forward ('always', the previous behaviour), only at stage boundaries ('stage') or never.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        default=False,
+        help="Time every generation stage and log the duration and peak CUDA memory per stage.",
+    )
+    parser.add_argument(
+        "--trace_file",
+        type=str,
+        default=None,
+        help="Write the stage spans to this file in the Chrome trace format. Implies --trace.",
+    )
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Run the text, audio and unconditional guidance branches as one batched DiT forward per step."
+    )
+    parser.add_argument(
+        "--incremental_cond",
+        action="store_true",
+        default=False,
+        help="In streaming mode, reuse the CLIP features of the first clip's reference image and the latent of the zero padding across clips, and only VAE-encode the new motion frames. Changes the conditioning: without it, every clip is CLIP-encoded from its last motion frame, so later clips condition on the generated video rather than the reference image. The reused padding latent is also an approximation: the causal VAE encodes the padding after the motion frames, so the cached latent carries the second clip's motion frames rather than the current clip's."
+    )
+    parser.add_argument(
+        "--overlap_decode",
+        action="store_true",
+        default=False,
+        help="In streaming mode, decode only the motion frames before sampling the next clip and run the full VAE decode of each clip in the background. Approximate: the motion frames are decoded with a short warm-up instead of the whole clip."
+    )
+    parser.add_argument(
+        "--stream_output",
+        action="store_true",
+        default=False,
+        help="Encode each clip as soon as it is decoded, piping the frames into a single ffmpeg process that also muxes the audio."
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=os.getenv("WAN_ATTENTION_BACKEND", "auto"),
+        choices=["auto", "autotune"] + list(ATTENTION_BACKENDS),
+        help="The attention kernel to use. `auto` picks flash attention 3 / 2, xformers or sdpa, whichever is available for the device. `autotune` times the available kernels on a DiT-sized attention at startup and uses the fastest."
+    )
     parser.add_argument(
         "--use_apg",
         action="store_true",
@@ -206,7 +291,7 @@ def _parse_args():
     )
 
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     _validate_args(args)
 
@@ -229,13 +314,13 @@ def loudness_norm(audio_array, sr=16000, lufs=-23):
 def audio_prepare_multi(left_path, right_path, audio_type, sample_rate=16000):
 
     if not (left_path=='None' or right_path=='None'):
-        human_speech_array1 = audio_prepare_single(left_path)
-        human_speech_array2 = audio_prepare_single(right_path)
+        human_speech_array1 = audio_prepare_single(left_path, sample_rate)
+        human_speech_array2 = audio_prepare_single(right_path, sample_rate)
     elif left_path=='None':
-        human_speech_array2 = audio_prepare_single(right_path)
+        human_speech_array2 = audio_prepare_single(right_path, sample_rate)
         human_speech_array1 = np.zeros(human_speech_array2.shape[0])
     elif right_path=='None':
-        human_speech_array1 = audio_prepare_single(left_path)
+        human_speech_array1 = audio_prepare_single(left_path, sample_rate)
         human_speech_array2 = np.zeros(human_speech_array1.shape[0])
 
     if audio_type=='para':
@@ -316,6 +401,99 @@ def audio_prepare_single(audio_path, sample_rate=16000):
         human_speech_array = loudness_norm(human_speech_array, sr)
         return human_speech_array
 
+def prepare_audio_embeddings(input_data, audio_cache, wav2vec_dir, wav2vec_feature_extractor, audio_encoder, sample_rate=16000, pin=False):
+    """
+    Encode the `cond_audio` entries of `input_data` with wav2vec2 and rewrite them
+    in place to the paths of the saved embeddings. Also sets `video_audio` to the
+    mixed speech track used when muxing the result. The audio is resampled to
+    and embedded at `sample_rate`. Embeddings are looked up in and stored to
+    `audio_cache`, keyed by the audio content.
+
+    Returns the cache key of the entry. With `pin`, the entry is pinned against
+    eviction and the caller must `audio_cache.release` the key when it is done.
+    """
+    persons = ['person1', 'person2'][:len(input_data['cond_audio'])]
+    audio_type = input_data['audio_type'] if len(persons)==2 else None
+    cache_key = audio_cache.make_key(
+        [input_data['cond_audio'][person] for person in persons], sample_rate, wav2vec_dir, audio_type)
+    entry = audio_cache.get(cache_key, len(persons), pin=pin)
+
+    if entry is None:
+        if len(persons)==2:
+            new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(input_data['cond_audio']['person1'], input_data['cond_audio']['person2'], audio_type, sample_rate)
+            audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, sr=sample_rate)
+            audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, sr=sample_rate)
+            entry = audio_cache.put(cache_key, [audio_embedding_1, audio_embedding_2], sum_human_speechs, sample_rate, pin=pin)
+        elif len(persons)==1:
+            human_speech = audio_prepare_single(input_data['cond_audio']['person1'], sample_rate)
+            audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder, sr=sample_rate)
+            entry = audio_cache.put(cache_key, [audio_embedding], human_speech, sample_rate, pin=pin)
+    else:
+        logging.info(f"Reusing cached audio embedding {cache_key}")
+
+    for person, emb_path in zip(persons, entry['embeddings']):
+        input_data['cond_audio'][person] = emb_path
+    input_data['video_audio'] = entry['sum_audio']
+    return cache_key
+
+def build_pipeline(args, cfg, device=0, rank=0):
+    select_attention_backend(args.attention_backend, torch.device('cuda', device),
+                             cfg.num_heads, cfg.dim // cfg.num_heads, cfg.param_dtype)
+    wan_i2v = wan.MultiTalkPipeline(
+        config=cfg,
+        checkpoint_dir=args.ckpt_dir,
+        device_id=device,
+        rank=rank,
+        t5_fsdp=args.t5_fsdp,
+        dit_fsdp=args.dit_fsdp, 
+        use_usp=(args.ulysses_size > 1 or args.ring_size > 1),  
+        t5_cpu=args.t5_cpu,
+        prompt_cache_dir=args.prompt_cache_dir,
+    )
+
+    if args.vae_tiling:
+        wan_i2v.vae.enable_tiling()
+
+    if args.num_persistent_param_in_dit is not None:
+        wan_i2v.vram_management = True
+        wan_i2v.enable_vram_management(
+            num_persistent_param_in_dit=args.num_persistent_param_in_dit,
+            streaming=args.vram_streaming,
+        )
+    return wan_i2v
+
+def max_frames_num(args):
+    return args.frame_num if args.mode == 'clip' else 1000
+
+def open_video_writer(args, save_file, audio_path):
+    # the last clip may still be trimmed by up to one clip of frames
+    return StreamingVideoWriter(save_file, audio_path,
+                                max_frames=max_frames_num(args),
+                                holdback=args.frame_num)
+
+def generation_kwargs(input_data, args, progress_callback=None, video_writer=None):
+    """The keyword arguments of `MultiTalkPipeline.generate` for one job."""
+    return dict(
+        input_data=input_data,
+        size_buckget=args.size,
+        motion_frame=args.motion_frame,
+        frame_num=args.frame_num,
+        shift=args.sample_shift,
+        sampling_steps=args.sample_steps,
+        sample_solver=args.sample_solver,
+        text_guide_scale=args.sample_text_guide_scale,
+        audio_guide_scale=args.sample_audio_guide_scale,
+        seed=args.base_seed,
+        offload_model=args.offload_model,
+        max_frames_num=max_frames_num(args),
+        extra_args=args,
+        progress_callback=progress_callback,
+        video_writer=video_writer,
+        )
+
+def generate_video(wan_i2v, input_data, args, progress_callback=None, video_writer=None):
+    return wan_i2v.generate(**generation_kwargs(input_data, args, progress_callback, video_writer))
+
 def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -420,77 +598,36 @@ def generate(args):
         input_data = json.load(f)
         
         wav2vec_feature_extractor, audio_encoder= custom_init('cpu', args.wav2vec_dir)
-        args.audio_save_dir = os.path.join(args.audio_save_dir, input_data['cond_image'].split('/')[-1].split('.')[0])
-        os.makedirs(args.audio_save_dir,exist_ok=True)
-        
-        if len(input_data['cond_audio'])==2:
-            new_human_speech1, new_human_speech2, sum_human_speechs = audio_prepare_multi(input_data['cond_audio']['person1'], input_data['cond_audio']['person2'], input_data['audio_type'])
-            audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder)
-            audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder)
-            emb1_path = os.path.join(args.audio_save_dir, '1.pt')
-            emb2_path = os.path.join(args.audio_save_dir, '2.pt')
-            sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
-            sf.write(sum_audio, sum_human_speechs, 16000)
-            torch.save(audio_embedding_1, emb1_path)
-            torch.save(audio_embedding_2, emb2_path)
-            input_data['cond_audio']['person1'] = emb1_path
-            input_data['cond_audio']['person2'] = emb2_path
-            input_data['video_audio'] = sum_audio
-        elif len(input_data['cond_audio'])==1:
-            human_speech = audio_prepare_single(input_data['cond_audio']['person1'])
-            audio_embedding = get_embedding(human_speech, wav2vec_feature_extractor, audio_encoder)
-            emb_path = os.path.join(args.audio_save_dir, '1.pt')
-            sum_audio = os.path.join(args.audio_save_dir, 'sum.wav')
-            sf.write(sum_audio, human_speech, 16000)
-            torch.save(audio_embedding, emb_path)
-            input_data['cond_audio']['person1'] = emb_path
-            input_data['video_audio'] = sum_audio
+        audio_cache = AudioEmbeddingCache(args.audio_save_dir, max_bytes=int(args.audio_cache_max_gb * 1024**3))
+        prepare_audio_embeddings(input_data, audio_cache, args.wav2vec_dir, wav2vec_feature_extractor, audio_encoder)
 
     logging.info("Creating MultiTalk pipeline.")
-    wan_i2v = wan.MultiTalkPipeline(
-        config=cfg,
-        checkpoint_dir=args.ckpt_dir,
-        device_id=device,
-        rank=rank,
-        t5_fsdp=args.t5_fsdp,
-        dit_fsdp=args.dit_fsdp, 
-        use_usp=(args.ulysses_size > 1 or args.ring_size > 1),  
-        t5_cpu=args.t5_cpu
-    )
-
-    if args.num_persistent_param_in_dit is not None:
-        wan_i2v.vram_management = True
-        wan_i2v.enable_vram_management(
-            num_persistent_param_in_dit=args.num_persistent_param_in_dit
-        )
-    
-    logging.info("Generating video ...")
-    video = wan_i2v.generate(
-        input_data,
-        size_buckget=args.size,
-        motion_frame=args.motion_frame,
-        frame_num=args.frame_num,
-        shift=args.sample_shift,
-        sampling_steps=args.sample_steps,
-        text_guide_scale=args.sample_text_guide_scale,
-        audio_guide_scale=args.sample_audio_guide_scale,
-        seed=args.base_seed,
-        offload_model=args.offload_model,
-        max_frames_num=args.frame_num if args.mode == 'clip' else 1000,
-        extra_args=args,
-        )
+    wan_i2v = build_pipeline(args, cfg, device, rank)
     
+    if args.save_file is None:
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        formatted_prompt = input_data['prompt'].replace(" ", "_").replace("/",
+                                                                    "_")[:50]
+        args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}"
+
+    if args.stream_output:
+        logging.info(f"Generating video and streaming it to {args.save_file}.mp4 ...")
+        video_writer = open_video_writer(args, args.save_file, input_data['video_audio']) if rank == 0 else None
+        try:
+            generate_video(wan_i2v, input_data, args, video_writer=video_writer)
+        except BaseException:
+            if video_writer is not None:
+                video_writer.abort()
+            raise
+        if video_writer is not None:
+            video_writer.close()
+    else:
+        logging.info("Generating video ...")
+        video = generate_video(wan_i2v, input_data, args)
 
-    if rank == 0:
-        
-        if args.save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = input_data['prompt'].replace(" ", "_").replace("/",
-                                                                        "_")[:50]
-            args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}"
-        
-        logging.info(f"Saving generated video to {args.save_file}.mp4")
-        save_video_ffmpeg(video, args.save_file, [input_data['video_audio']])
+        if rank == 0:
+            logging.info(f"Saving generated video to {args.save_file}.mp4")
+            save_video_ffmpeg(video, args.save_file, [input_data['video_audio']])
         
     logging.info("Finished.")
 
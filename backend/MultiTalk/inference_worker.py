@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Persistent in-process MultiTalk inference worker.
+
+Builds `wan.MultiTalkPipeline` and the wav2vec2 audio encoder once and serves
+generation jobs from a bounded priority queue, so the T5 / CLIP / VAE /
+wav2vec2 / DiT weights are loaded on the first request only. Jobs can be
+awaited directly or polled by id for status and per-step progress. Queued
+jobs with the same size bucket, clip length and step count can be sampled
+together in one batched denoising loop.
+"""
+
+import copy
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from generate_multitalk import (
+    _init_logging,
+    _parse_args,
+    build_pipeline,
+    custom_init,
+    generation_kwargs,
+    open_video_writer,
+    prepare_audio_embeddings,
+)
+from src.audio_analysis.embedding_cache import AudioEmbeddingCache
+from wan.configs import WAN_CONFIGS
+from wan.utils.multitalk_utils import save_video_ffmpeg
+
+# Same flags the wrappers used to pass to `python generate_multitalk.py`
+DEFAULT_WORKER_ARGV = [
+    "--ckpt_dir", "weights/Wan2.1-I2V-14B-480P",
+    "--wav2vec_dir", "weights/chinese-wav2vec2-base",
+    "--sample_steps", "40",
+    "--mode", "streaming",
+    "--use_teacache",
+    "--size", "multitalk-480",
+    "--stream_output",
+]
+
+# Number of job threads. Audio encoding and muxing run concurrently,
+# the DiT sampling itself is serialized on the single pipeline.
+WORKER_CONCURRENCY = int(os.getenv("MULTITALK_WORKER_CONCURRENCY", 2))
+MAX_QUEUED_JOBS = int(os.getenv("MULTITALK_MAX_QUEUED_JOBS", 32))
+MAX_FINISHED_JOBS = int(os.getenv("MULTITALK_MAX_FINISHED_JOBS", 256))
+# Up to this many compatible queued jobs share one batched denoising loop.
+# Batches of more than one job keep the DiT on the GPU and run without TeaCache.
+MAX_BATCH_JOBS = int(os.getenv("MULTITALK_MAX_BATCH_JOBS", 1))
+
+# Generation args that have to match for jobs to be sampled in lockstep
+BATCH_KEY_ARGS = ('size', 'frame_num', 'motion_frame', 'mode', 'sample_steps', 'sample_solver', 'stream_output')
+
+DEFAULT_PRIORITY = 10
+
+
+class GenerationJob:
+    """A single queued generation request and its progress."""
+
+    def __init__(self, input_data, save_file, overrides=None,
+                 priority=DEFAULT_PRIORITY, cleanup_paths=None):
+        self.job_id = uuid.uuid4().hex
+        self.input_data = input_data
+        self.save_file = save_file
+        self.overrides = overrides or {}
+        self.priority = priority
+        self.cleanup_paths = cleanup_paths or []
+        self.future = Future()
+
+        self.status = 'queued'
+        self.stage = None
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.teacache_stats = None
+        self.trace = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update_progress(self, clip, total_clips, step, total_steps):
+        self.stage = 'sampling'
+        self.progress = {
+            'clip': clip + 1,
+            'total_clips': total_clips,
+            'step': step,
+            'total_steps': total_steps,
+            'percent': round(100.0 * (clip * total_steps + step) / (total_clips * total_steps), 1),
+        }
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'stage': self.stage,
+            'priority': self.priority,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'teacache_stats': self.teacache_stats,
+            'trace': self.trace,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class MultiTalkWorker:
+    """
+    Long-lived worker that owns one MultiTalk pipeline.
+
+    Models are loaded lazily on the first job thread, so `start()` returns
+    immediately and the first job waits for the load to finish.
+    """
+
+    def __init__(self, argv=None, device=0, concurrency=WORKER_CONCURRENCY,
+                 max_queued_jobs=MAX_QUEUED_JOBS, max_batch_jobs=MAX_BATCH_JOBS):
+        self.args = _parse_args(DEFAULT_WORKER_ARGV if argv is None else argv)
+        if self.args.offload_model is None:
+            self.args.offload_model = True
+        self.device = device
+        self.cfg = WAN_CONFIGS[self.args.task]
+        self.concurrency = max(1, concurrency)
+        self.max_batch_jobs = max(1, max_batch_jobs)
+        self.audio_cache = AudioEmbeddingCache(
+            self.args.audio_save_dir,
+            max_bytes=int(self.args.audio_cache_max_gb * 1024**3))
+
+        self.pipeline = None
+        self.wav2vec_feature_extractor = None
+        self.audio_encoder = None
+        self.load_error = None
+
+        # entries are (priority, sequence, job): lower priority runs first, FIFO within a priority
+        self._queue = queue.PriorityQueue(maxsize=max_queued_jobs)
+        self._sequence = itertools.count()
+        self._jobs = OrderedDict()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._gpu_lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.concurrency:
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f"multitalk-worker-{len(self._threads)}",
+                    daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def submit(self, input_data, save_file, priority=DEFAULT_PRIORITY,
+               cleanup_paths=None, **overrides):
+        """
+        Queue a generation job and return it without waiting.
+
+        `job.future` resolves to the path of the saved mp4. `overrides` replace
+        fields of the worker's generation args (e.g. `sample_steps`, `mode`) for
+        this job only, and `cleanup_paths` are deleted once the job finishes.
+        Raises `queue.Full` when the queue is at capacity.
+        """
+        self.start()
+        job = GenerationJob(input_data, save_file, overrides, priority, cleanup_paths)
+        with self._lock:
+            self._queue.put_nowait((priority, next(self._sequence), job))
+            self._jobs[job.job_id] = job
+            self._prune_finished_jobs()
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def load_models(self):
+        with self._load_lock:
+            if self.pipeline is not None or self.load_error is not None:
+                return
+            try:
+                logging.info("Loading wav2vec2 audio encoder.")
+                self.wav2vec_feature_extractor, self.audio_encoder = custom_init(
+                    'cpu', self.args.wav2vec_dir)
+                logging.info("Creating MultiTalk pipeline.")
+                self.pipeline = build_pipeline(self.args, self.cfg, self.device)
+            except Exception as e:
+                logging.exception("Failed to load MultiTalk models.")
+                self.load_error = e
+
+    def job_args(self, job):
+        args = copy.copy(self.args)
+        for key, value in job.overrides.items():
+            setattr(args, key, value)
+        return args
+
+    def batch_key(self, job):
+        args = self.job_args(job)
+        return tuple(getattr(args, key) for key in BATCH_KEY_ARGS)
+
+    def run_job(self, job):
+        outcome = self.run_batch([job])[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def run_batch(self, jobs):
+        """
+        Generate compatible jobs in one batched denoising loop.
+
+        Returns the result or the exception of every job, a failing job doesn't
+        fail the others.
+        """
+        # the cached audio entries stay pinned until the videos are muxed
+        cache_keys = []
+        try:
+            return self._run_batch(jobs, cache_keys)
+        finally:
+            for cache_key in cache_keys:
+                self.audio_cache.release(cache_key)
+
+    def _run_batch(self, jobs, cache_keys):
+        outcomes = [None] * len(jobs)
+        prepared = []
+        for i, job in enumerate(jobs):
+            args = self.job_args(job)
+            job.stage = 'audio'
+            input_data = copy.deepcopy(job.input_data)
+            try:
+                cache_keys.append(prepare_audio_embeddings(
+                    input_data, self.audio_cache, args.wav2vec_dir,
+                    self.wav2vec_feature_extractor, self.audio_encoder, pin=True))
+                # clips are encoded while the following ones are sampled
+                video_writer = open_video_writer(args, job.save_file, input_data['video_audio']) \
+                    if args.stream_output else None
+            except Exception as e:
+                outcomes[i] = e
+                continue
+            job.stage = 'waiting_for_gpu'
+            prepared.append((i, job, args, input_data, video_writer))
+        if not prepared:
+            return outcomes
+
+        try:
+            with self._gpu_lock:
+                logging.info(f"Generating video for jobs {', '.join(job.job_id for _, job, *_ in prepared)} ...")
+                results = self.pipeline.generate_batch([
+                    generation_kwargs(input_data, args, progress_callback=job.update_progress,
+                                      video_writer=video_writer)
+                    for _, job, args, input_data, video_writer in prepared
+                ], return_exceptions=True)
+                stats = self.pipeline.last_batch_stats
+        except BaseException:
+            for *_, video_writer in prepared:
+                if video_writer is not None:
+                    video_writer.abort()
+            raise
+
+        for (i, job, args, input_data, video_writer), result, job_stats in zip(prepared, results, stats):
+            if job_stats is not None:
+                job.teacache_stats = job_stats['teacache_stats'] if args.use_teacache else None
+                job.trace = job_stats['trace'] if args.trace or args.trace_file else None
+            if isinstance(result, Exception):
+                if video_writer is not None:
+                    video_writer.abort()
+                outcomes[i] = result
+                continue
+            job.stage = 'saving'
+            try:
+                if video_writer is not None:
+                    video_writer.close()
+                    outcomes[i] = video_writer.save_path
+                else:
+                    logging.info(f"Saving generated video to {job.save_file}.mp4")
+                    save_video_ffmpeg(result, job.save_file, [input_data['video_audio']])
+                    outcomes[i] = f"{job.save_file}.mp4"
+            except Exception as e:
+                outcomes[i] = e
+        return outcomes
+
+    def _take_batch(self, job):
+        """Pop the queued jobs that can be sampled together with `job`, in queue order."""
+        batch = [job]
+        if self.max_batch_jobs == 1:
+            return batch
+        key = self.batch_key(job)
+        skipped = []
+        with self._lock:
+            while len(batch) < self.max_batch_jobs:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if self.batch_key(entry[2]) == key:
+                    batch.append(entry[2])
+                else:
+                    skipped.append(entry)
+            for entry in skipped:
+                self._queue.put_nowait(entry)
+        return batch
+
+    def _run(self):
+        self.load_models()
+        while True:
+            _, _, job = self._queue.get()
+            batch = []
+            for job in self._take_batch(job):
+                if job.future.set_running_or_notify_cancel():
+                    batch.append(job)
+                else:
+                    # cancelled while queued
+                    job.status = 'cancelled'
+                    job.finished_at = time.time()
+                    self._remove_cleanup_paths(job)
+            if not batch:
+                continue
+            for job in batch:
+                job.status = 'running'
+                job.started_at = time.time()
+            try:
+                if self.load_error is not None:
+                    raise self.load_error
+                outcomes = self.run_batch(batch)
+            except Exception as e:
+                outcomes = [e] * len(batch)
+            for job, outcome in zip(batch, outcomes):
+                self._finish(job, outcome)
+
+    def _finish(self, job, outcome):
+        if isinstance(outcome, Exception):
+            logging.error(f"Job {job.job_id} failed.", exc_info=outcome)
+            job.status = 'failed'
+            job.error = str(outcome)
+            job.future.set_exception(outcome)
+        else:
+            job.result = outcome
+            job.status = 'succeeded'
+            job.future.set_result(outcome)
+        job.stage = None
+        job.finished_at = time.time()
+        self._remove_cleanup_paths(job)
+
+    def _remove_cleanup_paths(self, job):
+        for path in job.cleanup_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _prune_finished_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    """Return the process-wide worker, creating and starting it on first use."""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _init_logging(int(os.getenv("RANK", 0)))
+            _worker = MultiTalkWorker().start()
+    return _worker
@@ -1,76 +1,74 @@
 #!/usr/bin/env python3
 """
-Simple wrapper for MultiTalk - just calls their existing script
-NO CUSTOM CODE - just a thin wrapper around their generate_multitalk.py
+Simple wrapper for MultiTalk - submits jobs to the persistent inference worker
+The worker runs their generate_multitalk.py pipeline with models loaded once
 """
 
-import os
-import json
-import subprocess
-import tempfile
 import uuid
-from pathlib import Path
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
-def generate_talking_video(audio_file, image_file, prompt, output_name=None):
+from inference_worker import DEFAULT_PRIORITY, get_worker
+
+def build_input_config(audio_file, image_file, prompt):
+    """Input JSON for a single speaker (using their exact format)"""
+    return {
+        "prompt": prompt,
+        "cond_image": image_file,
+        "cond_audio": {
+            "person1": audio_file
+        }
+    }
+
+def submit_talking_video(audio_file, image_file, prompt, output_name, priority=DEFAULT_PRIORITY, cleanup_paths=None):
+    """
+    Queue a talking video job without waiting for it
+    
+    Returns:
+        The queued job; poll `job.to_dict()` or wait on `job.future`.
+        Raises queue.Full when the worker queue is at capacity.
+    """
+    return get_worker().submit(
+        build_input_config(audio_file, image_file, prompt),
+        output_name,
+        priority=priority,
+        cleanup_paths=cleanup_paths,
+    )
+
+def generate_talking_video(audio_file, image_file, prompt, output_name=None, timeout=600, cleanup_paths=None):
     """
-    Simple wrapper that calls MultiTalk's generate_multitalk.py directly
+    Simple wrapper that runs MultiTalk on the persistent inference worker
     
     Args:
         audio_file: Path to audio file
         image_file: Path to image file  
         prompt: Text description
         output_name: Optional output name
+        timeout: Seconds to wait for the job to finish
+        cleanup_paths: Files the worker removes once the job finishes
     
     Returns:
         Path to generated video or None if failed
+    
+    On timeout a job that is still queued is cancelled, a job that already
+    started keeps running on the worker and still writes its video.
+    Raises queue.Full when the worker queue is at capacity, in which case
+    `cleanup_paths` are left to the caller.
     """
     
     # Generate unique output name if not provided
     if output_name is None:
         output_name = f"talking_video_{uuid.uuid4().hex[:8]}"
     
-    # Create input JSON file (using their exact format)
-    input_config = {
-        "prompt": prompt,
-        "cond_image": image_file,
-        "cond_audio": {
-            "person1": audio_file
-        }
-    }
-    
-    # Save config to temp file
-    config_file = f"{output_name}_config.json"
-    with open(config_file, 'w') as f:
-        json.dump(input_config, f, indent=2)
-    
-    # Call their script directly (exactly as they designed it)
-    cmd = [
-        "python", "generate_multitalk.py",
-        "--ckpt_dir", "weights/Wan2.1-I2V-14B-480P",
-        "--wav2vec_dir", "weights/chinese-wav2vec2-base", 
-        "--input_json", config_file,
-        "--sample_steps", "40",
-        "--mode", "streaming",
-        "--use_teacache",
-        "--save_file", output_name
-    ]
-    
+    # Same pipeline as their script, without reloading the models
+    job = submit_talking_video(audio_file, image_file, prompt, output_name,
+                               cleanup_paths=cleanup_paths)
     try:
-        # Run their script
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-        
-        # Clean up config file
-        if os.path.exists(config_file):
-            os.remove(config_file)
-        
-        if result.returncode == 0:
-            # Find the generated video file
-            video_file = f"{output_name}.mp4"
-            if os.path.exists(video_file):
-                return video_file
+        return job.future.result(timeout=timeout)
         
+    except FutureTimeoutError:
+        job.future.cancel()
+        print(f"Error: no result after {timeout}s")
         return None
-        
     except Exception as e:
         print(f"Error: {e}")
         return None
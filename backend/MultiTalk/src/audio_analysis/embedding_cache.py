@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter
+
+import soundfile as sf
+import torch
+
+
+class AudioEmbeddingCache:
+    """
+    Content-addressed on-disk cache of wav2vec2 audio embeddings.
+
+    Entries are keyed by a hash of the raw audio bytes, the sample rate, the
+    wav2vec2 checkpoint and the audio mixing type, so re-rendering the same
+    voice track with a different prompt or image skips loudness normalization
+    and the audio encoder. Each entry is a directory holding one embedding per
+    speaker (`1.pt`, `2.pt`) and the mixed speech track (`sum.wav`). The least
+    recently used entries are evicted once the cache exceeds `max_bytes`.
+
+    Entries looked up or stored with `pin=True` are never evicted until they
+    are released, so the files of queued and running jobs stay in place until
+    the job is done with them. Pins are tracked per process.
+    """
+
+    COMPLETE_MARKER = '.complete'
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pins = Counter()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(audio_paths, sample_rate, wav2vec_dir, audio_type=None):
+        h = hashlib.sha256()
+        for path in audio_paths:
+            if path == 'None':
+                # silent speaker in audio_prepare_multi
+                h.update(b'None')
+            else:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        h.update(chunk)
+            h.update(b'\0')
+        h.update(f'{sample_rate}|{os.path.realpath(wav2vec_dir)}|{audio_type}'.encode())
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _entry_paths(self, entry_dir, num_speakers):
+        return {
+            'embeddings': [os.path.join(entry_dir, f'{i + 1}.pt') for i in range(num_speakers)],
+            'sum_audio': os.path.join(entry_dir, 'sum.wav'),
+        }
+
+    def get(self, key, num_speakers, pin=False):
+        """Return the paths of a cached entry, or None on a miss. With `pin`, a hit is pinned."""
+        entry_dir = self._entry_dir(key)
+        marker = os.path.join(entry_dir, self.COMPLETE_MARKER)
+        with self._lock:
+            if not os.path.exists(marker):
+                return None
+            # mark as most recently used
+            os.utime(marker)
+            if pin:
+                self._pins[key] += 1
+        return self._entry_paths(entry_dir, num_speakers)
+
+    def release(self, key):
+        """Unpin an entry pinned by `get` or `put`."""
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+
+    def put(self, key, embeddings, sum_audio, sample_rate=16000, pin=False):
+        """Store the speaker embeddings and mixed speech track and return their paths."""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = os.path.join(self.cache_dir, f'.tmp-{key}-{uuid.uuid4().hex[:8]}')
+        os.makedirs(tmp_dir)
+        paths = self._entry_paths(tmp_dir, len(embeddings))
+        for embedding, path in zip(embeddings, paths['embeddings']):
+            torch.save(embedding.contiguous(), path)
+        sf.write(paths['sum_audio'], sum_audio, sample_rate)
+        open(os.path.join(tmp_dir, self.COMPLETE_MARKER), 'w').close()
+
+        with self._lock:
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # stored concurrently by another job
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.utime(os.path.join(entry_dir, self.COMPLETE_MARKER))
+            if pin:
+                self._pins[key] += 1
+        self.evict(keep=key)
+        return self._entry_paths(entry_dir, len(embeddings))
+
+    @staticmethod
+    def load(path):
+        """Load an embedding as a memory-mapped tensor."""
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = []
+            for key in os.listdir(self.cache_dir):
+                entry_dir = self._entry_dir(key)
+                marker = os.path.join(entry_dir, self.COMPLETE_MARKER)
+                if key.startswith('.') or not os.path.exists(marker):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, name))
+                    for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(marker), size, key))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep or self._pins[key] > 0:
+                    continue
+                logging.info(f'evicting audio embedding cache entry {key}')
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                total -= size
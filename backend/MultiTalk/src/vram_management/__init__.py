@@ -1 +1,2 @@
 from .layers import *
+from .streaming import *
@@ -1,4 +1,4 @@
-import copy
+import itertools
 
 import torch
 
@@ -53,12 +53,19 @@ class AutoWrappedModule(torch.nn.Module):
             self.onload_dtype == self.computation_dtype
             and self.onload_device == self.computation_device
         ):
-            module = self.module
-        else:
-            module = copy.deepcopy(self.module).to(
-                dtype=self.computation_dtype, device=self.computation_device
+            return self.module(*args, **kwargs)
+        # cast the tensors only, instead of deep-copying the whole module
+        tensors = {
+            name: cast_to(
+                tensor,
+                self.computation_dtype if tensor.is_floating_point() else tensor.dtype,
+                self.computation_device,
+            )
+            for name, tensor in itertools.chain(
+                self.module.named_parameters(), self.module.named_buffers()
             )
-        return module(*args, **kwargs)
+        }
+        return torch.func.functional_call(self.module, tensors, args, kwargs)
 
 
 class AutoWrappedLinear(torch.nn.Linear):
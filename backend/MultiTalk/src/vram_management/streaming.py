@@ -0,0 +1,151 @@
+from collections import defaultdict
+
+import torch
+
+__all__ = ["BlockStreamingEngine", "enable_block_streaming"]
+
+
+class _StreamedBlock:
+    def __init__(self, index, module, computation_dtype):
+        self.index = index
+        self.module = module
+        # one flat pinned host tensor per dtype, the parameters are views into it
+        self.params = defaultdict(list)
+        for name, param in module.named_parameters():
+            dtype = computation_dtype if param.is_floating_point() else param.dtype
+            self.params[dtype].append((name, param))
+        self.host = {}
+        self.numel = {}
+        for dtype, params in self.params.items():
+            numel = sum(p.numel() for _, p in params)
+            host = torch.empty(numel, dtype=dtype, pin_memory=True)
+            offset = 0
+            for _, param in params:
+                n = param.numel()
+                host[offset:offset + n].copy_(param.data.reshape(-1))
+                param.data = host[offset:offset + n].view_as(param)
+                offset += n
+            self.host[dtype] = host
+            self.numel[dtype] = numel
+
+    def point_to(self, flat):
+        for dtype, params in self.params.items():
+            offset = 0
+            for _, param in params:
+                n = param.numel()
+                param.data = flat[dtype][offset:offset + n].view_as(param)
+                offset += n
+
+
+class BlockStreamingEngine:
+    """
+    Streams the weights of a sequence of blocks from pinned host memory.
+
+    Streamed blocks keep their parameters in pinned host memory, already in the
+    computation dtype. Two preallocated device buffers are used alternately:
+    while block N computes on the current stream, block N+1 is copied into the
+    other buffer on a side stream, and the parameters are re-pointed at the
+    buffer right before the block runs. No module is copied or cast during the
+    forward pass. After the last streamed block, the first one is prefetched
+    again for the next forward.
+    """
+
+    NUM_SLOTS = 2
+
+    def __init__(self, blocks, streamed_indices, device, computation_dtype):
+        self.device = torch.device(device)
+        self.copy_stream = torch.cuda.Stream(device=self.device)
+        self.blocks = [_StreamedBlock(i, blocks[i], computation_dtype) for i in streamed_indices]
+        self.position = {block.index: pos for pos, block in enumerate(self.blocks)}
+
+        sizes = defaultdict(int)
+        for block in self.blocks:
+            for dtype, numel in block.numel.items():
+                sizes[dtype] = max(sizes[dtype], numel)
+        self.slots = [
+            {dtype: torch.empty(numel, dtype=dtype, device=self.device) for dtype, numel in sizes.items()}
+            for _ in range(self.NUM_SLOTS)
+        ]
+        self.ready_events = [torch.cuda.Event() for _ in range(self.NUM_SLOTS)]
+        self.free_events = [torch.cuda.Event() for _ in range(self.NUM_SLOTS)]
+        self.slot_owner = [None] * self.NUM_SLOTS
+
+        self._handles = []
+        for block in self.blocks:
+            self._handles.append(block.module.register_forward_pre_hook(self._pre_hook(block)))
+            self._handles.append(block.module.register_forward_hook(self._post_hook(block)))
+
+    def _slot(self, block):
+        return self.position[block.index] % self.NUM_SLOTS
+
+    def prefetch(self, block):
+        slot = self._slot(block)
+        if self.slot_owner[slot] is block:
+            return
+        with torch.cuda.stream(self.copy_stream):
+            # wait until the previous user of the buffer has finished computing
+            self.copy_stream.wait_event(self.free_events[slot])
+            for dtype, host in block.host.items():
+                self.slots[slot][dtype][:host.numel()].copy_(host, non_blocking=True)
+            self.ready_events[slot].record(self.copy_stream)
+        self.slot_owner[slot] = block
+
+    def _pre_hook(self, block):
+        def hook(module, args):
+            self.prefetch(block)
+            slot = self._slot(block)
+            torch.cuda.current_stream(self.device).wait_event(self.ready_events[slot])
+            block.point_to(self.slots[slot])
+            # start copying the next block while this one computes; with an odd
+            # number of blocks the wrap-around shares this buffer and has to wait
+            next_block = self.blocks[(self.position[block.index] + 1) % len(self.blocks)]
+            if self._slot(next_block) != slot:
+                self.prefetch(next_block)
+        return hook
+
+    def _post_hook(self, block):
+        def hook(module, args, output):
+            slot = self._slot(block)
+            self.free_events[slot].record(torch.cuda.current_stream(self.device))
+            block.point_to(block.host)
+            if len(self.blocks) > self.NUM_SLOTS:
+                # the buffer will be overwritten, so the block must be fetched again
+                self.slot_owner[slot] = None
+        return hook
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+
+def enable_block_streaming(model, blocks, device, computation_dtype, max_num_param=None):
+    """
+    Keep `model` on `device` except for the blocks that overflow `max_num_param`,
+    which are streamed from pinned host memory by a `BlockStreamingEngine`.
+    """
+    total_num_param = 0
+    streamed_indices = []
+    for i, block in enumerate(blocks):
+        num_param = sum(p.numel() for p in block.parameters())
+        if max_num_param is not None and total_num_param + num_param > max_num_param:
+            streamed_indices.append(i)
+        else:
+            total_num_param += num_param
+
+    # everything outside the streamed blocks is small and stays resident,
+    # including the buffers of the streamed blocks
+    streamed_modules = {id(m) for i in streamed_indices for m in blocks[i].modules()}
+    for module in model.modules():
+        if id(module) not in streamed_modules:
+            for param in module.parameters(recurse=False):
+                param.data = param.data.to(
+                    device=device,
+                    dtype=computation_dtype if param.is_floating_point() else param.dtype)
+        for name, buf in module.named_buffers(recurse=False):
+            module._buffers[name] = buf.to(device)
+
+    engine = BlockStreamingEngine(blocks, streamed_indices, device, computation_dtype) if streamed_indices else None
+    model.vram_management_enabled = True
+    model.streaming_engine = engine
+    return engine
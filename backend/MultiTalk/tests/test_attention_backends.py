@@ -0,0 +1,101 @@
+"""
+The sdpa attention backend must match plain per-sequence attention.
+
+Covers the packed varlen paths of `_sdpa_varlen` (equal and unequal lengths,
+bottom-right causal masks, grouped query attention) and the zero-filled
+padded query rows of `flash_attention`, all on the CPU.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('einops')
+
+import torch.nn.functional as F
+
+from wan.modules import attention
+
+NUM_HEADS = 4
+HEAD_DIM = 8
+
+
+@pytest.fixture
+def sdpa_backend():
+    previous = attention._attention_backend
+    attention.set_attention_backend('sdpa')
+    yield
+    attention.set_attention_backend(previous)
+
+
+def reference_attention(q, k, v, causal=False):
+    """Attention of one sequence, q [Lq, Nq, C], k / v [Lk, Nk, C]."""
+    lq, lk = q.size(0), k.size(0)
+    group = q.size(1) // k.size(1)
+    attn_mask = None
+    if causal:
+        # query i sees the keys up to i + (lk - lq), aligned to the bottom right
+        attn_mask = torch.arange(lk)[None, :] <= torch.arange(lq)[:, None] + (lk - lq)
+    heads = []
+    for h in range(q.size(1)):
+        heads.append(F.scaled_dot_product_attention(
+            q[:, h][None], k[:, h // group][None], v[:, h // group][None],
+            attn_mask=attn_mask)[0])
+    return torch.stack(heads, dim=1)
+
+
+def packed(lens, num_heads=NUM_HEADS):
+    return torch.randn(sum(lens), num_heads, HEAD_DIM)
+
+
+def packed_reference(q, k, v, q_lens, k_lens, causal=False):
+    return torch.cat([
+        reference_attention(q_i, k_i, v_i, causal)
+        for q_i, k_i, v_i in zip(q.split(q_lens), k.split(k_lens), v.split(k_lens))
+    ])
+
+
+@pytest.mark.parametrize('q_lens, k_lens', [
+    ([5, 5], [7, 7]),  # single batched call
+    ([3, 6], [4, 9]),  # split per sequence
+])
+def test_sdpa_varlen_matches_reference(sdpa_backend, q_lens, k_lens):
+    torch.manual_seed(0)
+    q, k, v = packed(q_lens), packed(k_lens), packed(k_lens)
+    out = attention.varlen_attention(q, k, v, q_lens, k_lens)
+    torch.testing.assert_close(out, packed_reference(q, k, v, q_lens, k_lens))
+
+
+@pytest.mark.parametrize('q_lens, k_lens', [
+    ([6, 6], [6, 6]),  # is_causal
+    ([3, 3], [7, 7]),  # bottom-right mask, batched
+    ([2, 5], [6, 8]),  # bottom-right mask, split
+])
+def test_sdpa_varlen_causal(sdpa_backend, q_lens, k_lens):
+    torch.manual_seed(0)
+    q, k, v = packed(q_lens), packed(k_lens), packed(k_lens)
+    out = attention.varlen_attention(q, k, v, q_lens, k_lens, causal=True)
+    torch.testing.assert_close(out, packed_reference(q, k, v, q_lens, k_lens, causal=True))
+
+
+def test_sdpa_varlen_grouped_query(sdpa_backend):
+    torch.manual_seed(0)
+    q_lens, k_lens = [4, 6], [5, 3]
+    q, k, v = packed(q_lens), packed(k_lens, NUM_HEADS // 2), packed(k_lens, NUM_HEADS // 2)
+    out = attention.varlen_attention(q, k, v, q_lens, k_lens)
+    torch.testing.assert_close(out, packed_reference(q, k, v, q_lens, k_lens))
+
+
+def test_flash_attention_zero_fills_padded_queries(sdpa_backend):
+    torch.manual_seed(0)
+    q_lens, k_lens = [3, 5], [6, 4]
+    q = torch.randn(2, 5, NUM_HEADS, HEAD_DIM)
+    k = torch.randn(2, 6, NUM_HEADS, HEAD_DIM)
+    v = torch.randn(2, 6, NUM_HEADS, HEAD_DIM)
+    out = attention.flash_attention(
+        q, k, v, q_lens=torch.tensor(q_lens), k_lens=torch.tensor(k_lens))
+
+    assert out.shape == (2, 5, NUM_HEADS, HEAD_DIM)
+    for i in range(2):
+        torch.testing.assert_close(
+            out[i, :q_lens[i]],
+            reference_attention(q[i, :q_lens[i]], k[i, :k_lens[i]], v[i, :k_lens[i]]))
+        assert torch.all(out[i, q_lens[i]:] == 0)
@@ -0,0 +1,95 @@
+"""
+Batched classifier-free guidance must match the three sequential DiT forwards.
+
+Runs a tiny WanModel on the CPU with the sdpa attention backend.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+from wan.modules import attention
+from wan.modules.multitalk_model import WanModel
+from wan.multitalk import MultiTalkPipeline
+
+TEXT_DIM = 16
+LATENT_SHAPE = (4, 2, 4, 4)  # C, T, H, W; 2 x 2 x 2 tokens with patch size (1, 2, 2)
+SEQ_LEN = 8
+AUDIO_FRAMES = 5  # 1 + vae_scale * (T - 1)
+
+
+@pytest.fixture
+def sdpa_backend():
+    previous = attention._attention_backend
+    attention.set_attention_backend('sdpa')
+    yield
+    attention.set_attention_backend(previous)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    model = WanModel(
+        in_dim=8,
+        dim=32,
+        ffn_dim=64,
+        freq_dim=32,
+        text_dim=TEXT_DIM,
+        text_len=8,
+        out_dim=4,
+        num_heads=2,
+        num_layers=2,
+        intermediate_dim=16,
+        output_dim=16).eval()
+    # the head is zero-initialized, perturb every weight so all paths contribute
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param) * 0.05)
+    return model
+
+
+def token_masks():
+    """Speaker 1, speaker 2 and background masks in latent resolution."""
+    masks = torch.tensor([
+        [[1., 0.], [0., 0.]],
+        [[0., 1.], [0., 0.]],
+        [[0., 0.], [1., 1.]],
+    ])
+    return masks.repeat_interleave(2, dim=1).repeat_interleave(2, dim=2)
+
+
+def cfg_samples(num_speakers):
+    """The cond, drop-text and uncond samples of one step, as `generate_job` yields them."""
+    generator = torch.Generator().manual_seed(0)
+    audio = torch.randn(num_speakers, AUDIO_FRAMES, 5, 12, 768, generator=generator)
+    common = dict(
+        x=torch.randn(*LATENT_SHAPE, generator=generator),
+        t=torch.tensor([500.]),
+        clip_fea=torch.randn(1, 257, 1280, generator=generator),
+        seq_len=SEQ_LEN,
+        y=torch.randn(1, *LATENT_SHAPE, generator=generator),
+        ref_target_masks=token_masks(),
+        teacache=None)
+    context = torch.randn(6, TEXT_DIM, generator=generator)
+    context_null = torch.randn(6, TEXT_DIM, generator=generator)
+    return [
+        dict(common, context=context, audio=audio, teacache_branch='cond'),
+        dict(common, context=context_null, audio=audio, teacache_branch='drop_text'),
+        dict(common, context=context_null, audio=torch.zeros_like(audio)[-1:], teacache_branch='uncond'),
+    ]
+
+
+@pytest.mark.parametrize('num_speakers', [1, 2])
+def test_batched_cfg_matches_sequential(model, sdpa_backend, num_speakers):
+    pipeline = SimpleNamespace(model=model)
+    samples = cfg_samples(num_speakers)
+    with torch.no_grad():
+        batched = MultiTalkPipeline.forward_samples(pipeline, samples)
+        sequential = [MultiTalkPipeline.forward_samples(pipeline, [sample])[0] for sample in samples]
+
+    assert len(batched) == 3
+    for branch, batched_pred, sequential_pred in zip(('cond', 'drop_text', 'uncond'), batched, sequential):
+        assert batched_pred.shape == sequential_pred.shape
+        assert torch.allclose(batched_pred, sequential_pred, rtol=1e-4, atol=1e-5), branch
@@ -6,11 +6,12 @@ Provides basic video generation capabilities for the Video Generator tab
 
 import os
 import sys
+import queue
 import uuid
-import json
-import subprocess
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+from inference_worker import DEFAULT_PRIORITY, get_worker
 
 app = Flask(__name__)
 CORS(app)
@@ -18,101 +19,125 @@ CORS(app)
 # Allowed file types
 ALLOWED_IMAGE = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
 ALLOWED_VIDEO = {'mp4', 'avi', 'mov', 'webm'}
+ALLOWED_AUDIO = {'wav', 'mp3', 'flac', 'm4a'}
 
 def allowed_file(filename, allowed_types):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_types
 
-def generate_video_from_text(prompt, output_name=None, image_path=None):
+def check_uploads():
+    """
+    Validate the 'audio' and 'image' uploads of a request
+
+    The worker runs the audio-driven MultiTalk pipeline, a job without a
+    reference image and a speech track could never succeed.
+
+    Returns:
+        An error message, or None if both files are present and valid
+    """
+    if 'audio' not in request.files or 'image' not in request.files:
+        return 'Audio and image files required'
+    if not allowed_file(request.files['audio'].filename, ALLOWED_AUDIO):
+        return 'Invalid audio file type'
+    if not allowed_file(request.files['image'].filename, ALLOWED_IMAGE):
+        return 'Invalid image file type'
+    return None
+
+def save_uploads(request_id):
+    """Save the checked uploads to temp files and return (audio_path, image_path)"""
+    audio_file = request.files['audio']
+    image_file = request.files['image']
+    audio_path = f"temp_audio_{request_id}.{audio_file.filename.rsplit('.', 1)[1]}"
+    image_path = f"temp_image_{request_id}.{image_file.filename.rsplit('.', 1)[1]}"
+    audio_file.save(audio_path)
+    image_file.save(image_path)
+    return audio_path, image_path
+
+def remove_uploads(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def build_video_config(prompt, image_path=None, audio_path=None):
+    """Input JSON for the Wan2.1 model"""
+    input_config = {
+        "prompt": prompt
+    }
+    
+    # Add image if provided (Image-to-Video mode)
+    if image_path and os.path.exists(image_path):
+        input_config["cond_image"] = image_path
+    
+    # Add the speech track driving the MultiTalk pipeline
+    if audio_path and os.path.exists(audio_path):
+        input_config["cond_audio"] = {"person1": audio_path}
+    return input_config
+
+def generate_video_from_text(prompt, output_name=None, image_path=None, audio_path=None, cleanup_paths=None):
     """
     Generate video using Wan2.1-I2V-14B-480P model
     
     Args:
         prompt: Text description for video generation
         output_name: Optional output name
-        image_path: Optional reference image for I2V generation
+        image_path: Reference image for I2V generation
+        audio_path: Speech track driving the video
+        cleanup_paths: Files the worker removes once the job finishes
     
     Returns:
         Path to generated video or None if failed
+    
+    On timeout a job that is still queued is cancelled, a job that already
+    started keeps running on the worker and still writes its video.
+    Raises queue.Full when the worker queue is at capacity, in which case
+    `cleanup_paths` are left to the caller.
     """
     
     # Generate unique output name if not provided
     if output_name is None:
         output_name = f"video_{uuid.uuid4().hex[:8]}"
     
-    # Create input JSON file for Wan2.1 model
-    input_config = {
-        "prompt": prompt
-    }
-    
-    # Add image if provided (Image-to-Video mode)
-    if image_path and os.path.exists(image_path):
-        input_config["cond_image"] = image_path
-    
-    # Save config to temp file
-    config_file = f"{output_name}_config.json"
-    with open(config_file, 'w') as f:
-        json.dump(input_config, f, indent=2)
-    
-    # Call Wan2.1 script for basic video generation (without MultiTalk features)
-    cmd = [
-        "python", "generate_multitalk.py",
-        "--ckpt_dir", "weights/Wan2.1-I2V-14B-480P",
-        "--input_json", config_file,
-        "--sample_steps", "40",
-        "--mode", "streaming",
-        "--use_teacache",
-        "--size", "multitalk-480",  # 480P video generation
-        "--save_file", output_name
-    ]
-    
+    # Run video generation on the persistent worker (models stay loaded)
+    job = get_worker().submit(build_video_config(prompt, image_path, audio_path), output_name,
+                              cleanup_paths=cleanup_paths)
     try:
-        # Run video generation
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
-        # Clean up config file
-        if os.path.exists(config_file):
-            os.remove(config_file)
-        
-        if result.returncode == 0:
-            # Find the generated video file
-            video_file = f"{output_name}.mp4"
-            if os.path.exists(video_file):
-                return video_file
-        else:
-            print(f"Video generation failed: {result.stderr}")
+        return job.future.result(timeout=300)
         
+    except FutureTimeoutError:
+        job.future.cancel()
+        print("Video generation failed: no result after 300s")
         return None
-        
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Video generation failed: {e}")
         return None
 
 @app.route('/api/video/generate', methods=['POST'])
 def generate_video():
     """Generate video using Wan2.1-I2V-14B-480P model"""
     
-    data = request.get_json()
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
+    error = check_uploads()
+    if error:
+        return jsonify({'error': error}), 400
     
-    prompt = data.get('prompt', '')
+    prompt = request.form.get('prompt', '')
     if not prompt.strip():
         return jsonify({'error': 'Prompt is required'}), 400
     
     # Optional parameters
-    quality = data.get('quality', '480p')  # 480p or 720p
-    style = data.get('style', 'realistic')  # realistic, cinematic, artistic
-    duration = data.get('duration', 'short')  # short, medium, long
+    quality = request.form.get('quality', '480p')  # 480p or 720p
+    style = request.form.get('style', 'realistic')  # realistic, cinematic, artistic
+    duration = request.form.get('duration', 'short')  # short, medium, long
     
     # Enhance prompt based on style and quality preferences
     enhanced_prompt = enhance_video_prompt(prompt, style, quality, duration)
     
+    # Save uploaded files, the worker removes them when the job finishes
+    request_id = str(uuid.uuid4())
+    audio_path, image_path = save_uploads(request_id)
+    
     try:
-        # Generate unique request ID
-        request_id = str(uuid.uuid4())
-        
         # Call video generation
-        result = generate_video_from_text(enhanced_prompt, f"video_{request_id}")
+        result = generate_video_from_text(enhanced_prompt, f"video_{request_id}", image_path, audio_path,
+                                          cleanup_paths=[audio_path, image_path])
         
         if result:
             return jsonify({
@@ -124,36 +149,31 @@ def generate_video():
         else:
             return jsonify({'error': 'Video generation failed'}), 500
             
+    except queue.Full:
+        remove_uploads(audio_path, image_path)
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503
     except Exception as e:
+        remove_uploads(audio_path, image_path)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/video/generate-from-image', methods=['POST'])
 def generate_video_from_image():
     """Generate video from image using Image-to-Video capabilities"""
     
-    # Check if image file is provided
-    if 'image' not in request.files:
-        return jsonify({'error': 'Image file required'}), 400
+    error = check_uploads()
+    if error:
+        return jsonify({'error': error}), 400
     
-    image_file = request.files['image']
     prompt = request.form.get('prompt', 'A dynamic video scene')
     
-    # Validate image file
-    if not allowed_file(image_file.filename, ALLOWED_IMAGE):
-        return jsonify({'error': 'Invalid image file type'}), 400
-    
-    # Save uploaded image
+    # Save uploaded files, the worker removes them when the job finishes
     request_id = str(uuid.uuid4())
-    image_path = f"temp_image_{request_id}.{image_file.filename.rsplit('.', 1)[1]}"
-    image_file.save(image_path)
+    audio_path, image_path = save_uploads(request_id)
     
     try:
         # Generate video from image
-        result = generate_video_from_text(prompt, f"i2v_{request_id}", image_path)
-        
-        # Clean up temp image
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        result = generate_video_from_text(prompt, f"i2v_{request_id}", image_path, audio_path,
+                                          cleanup_paths=[audio_path, image_path])
         
         if result:
             return jsonify({
@@ -164,12 +184,78 @@ def generate_video_from_image():
         else:
             return jsonify({'error': 'Video generation failed'}), 500
             
+    except queue.Full:
+        remove_uploads(audio_path, image_path)
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503
     except Exception as e:
-        # Clean up temp image on error
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        remove_uploads(audio_path, image_path)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/video/jobs', methods=['POST'])
+def submit_video_job():
+    """Queue a video generation job and return its id right away"""
+    
+    error = check_uploads()
+    if error:
+        return jsonify({'error': error}), 400
+    
+    prompt = request.form.get('prompt', '')
+    if not prompt.strip():
+        return jsonify({'error': 'Prompt is required'}), 400
+    
+    try:
+        priority = int(request.form.get('priority', DEFAULT_PRIORITY))
+    except ValueError:
+        return jsonify({'error': 'Priority must be an integer'}), 400
+    
+    enhanced_prompt = enhance_video_prompt(
+        prompt,
+        request.form.get('style', 'realistic'),
+        request.form.get('quality', '480p'),
+        request.form.get('duration', 'short'))
+    
+    # Save uploaded files, the worker removes them when the job finishes
+    request_id = str(uuid.uuid4())
+    audio_path, image_path = save_uploads(request_id)
+    
+    try:
+        job = get_worker().submit(build_video_config(enhanced_prompt, image_path, audio_path),
+                                  f"video_{request_id}", priority=priority,
+                                  cleanup_paths=[audio_path, image_path])
+    except queue.Full:
+        remove_uploads(audio_path, image_path)
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503
+    
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id,
+        'status_url': f'/api/video/jobs/{job.job_id}',
+        'download_url': f'/api/video/jobs/{job.job_id}/download',
+        'enhanced_prompt': enhanced_prompt
+    }), 202
+
+@app.route('/api/video/jobs/<job_id>')
+def video_job_status(job_id):
+    """Status and per-clip / per-step progress of a queued job"""
+    job = get_worker().get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    status = job.to_dict()
+    status['queued_jobs'] = get_worker().queue_size()
+    return jsonify(status)
+
+@app.route('/api/video/jobs/<job_id>/download')
+def download_job_video(job_id):
+    """Stream the video of a finished job (supports range requests)"""
+    job = get_worker().get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'succeeded':
+        return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+    if not os.path.exists(job.result):
+        return jsonify({'error': 'File not found'}), 404
+    return send_file(job.result, mimetype='video/mp4', as_attachment=True, conditional=True)
+
 @app.route('/api/video/download/<filename>')
 def download_video(filename):
     """Download generated video"""
@@ -234,8 +320,11 @@ if __name__ == '__main__':
     print("📁 Model path: weights/Wan2.1-I2V-14B-480P")
     print("🌐 API will be available at: http://localhost:5005")
     print("📋 Endpoints:")
-    print("   POST /api/video/generate - Text-to-Video")
-    print("   POST /api/video/generate-from-image - Image-to-Video")
+    print("   POST /api/video/generate - Talking video (image + audio)")
+    print("   POST /api/video/generate-from-image - Image-to-Video (image + audio)")
+    print("   POST /api/video/jobs - Queue a video job (image + audio)")
+    print("   GET  /api/video/jobs/<job_id> - Job status and progress")
+    print("   GET  /api/video/jobs/<job_id>/download - Download job result")
     print("   GET  /api/video/status - Check model status")
     print("   GET  /api/video/download/<filename> - Download video")
     
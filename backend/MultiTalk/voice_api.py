@@ -7,8 +7,10 @@ Just calls their existing script - NO CUSTOM CODE
 from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 import os
+import queue
 import uuid
-from simple_wrapper import generate_talking_video
+from inference_worker import DEFAULT_PRIORITY, get_worker
+from simple_wrapper import generate_talking_video, submit_talking_video
 
 app = Flask(__name__)
 
@@ -38,7 +40,7 @@ def generate_voice_video():
     if not allowed_file(image_file.filename, ALLOWED_IMAGE):
         return jsonify({'error': 'Invalid image file type'}), 400
     
-    # Save uploaded files
+    # Save uploaded files, the worker removes them when the job finishes
     request_id = str(uuid.uuid4())
     audio_path = f"temp_audio_{request_id}.{audio_file.filename.rsplit('.', 1)[1]}"
     image_path = f"temp_image_{request_id}.{image_file.filename.rsplit('.', 1)[1]}"
@@ -48,11 +50,8 @@ def generate_voice_video():
     
     try:
         # Call MultiTalk wrapper
-        result = generate_talking_video(audio_path, image_path, prompt, f"output_{request_id}")
-        
-        # Clean up temp files
-        os.remove(audio_path)
-        os.remove(image_path)
+        result = generate_talking_video(audio_path, image_path, prompt, f"output_{request_id}",
+                                        cleanup_paths=[audio_path, image_path])
         
         if result:
             return jsonify({
@@ -63,9 +62,84 @@ def generate_voice_video():
         else:
             return jsonify({'error': 'Video generation failed'}), 500
             
+    except queue.Full:
+        os.remove(audio_path)
+        os.remove(image_path)
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503
     except Exception as e:
+        os.remove(audio_path)
+        os.remove(image_path)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/voice/jobs', methods=['POST'])
+def submit_voice_job():
+    """Queue a talking video job and return its id right away"""
+    
+    # Check files
+    if 'audio' not in request.files or 'image' not in request.files:
+        return jsonify({'error': 'Audio and image files required'}), 400
+    
+    audio_file = request.files['audio']
+    image_file = request.files['image'] 
+    prompt = request.form.get('prompt', 'A person talking')
+    
+    # Validate files
+    if not allowed_file(audio_file.filename, ALLOWED_AUDIO):
+        return jsonify({'error': 'Invalid audio file type'}), 400
+    
+    if not allowed_file(image_file.filename, ALLOWED_IMAGE):
+        return jsonify({'error': 'Invalid image file type'}), 400
+    
+    try:
+        priority = int(request.form.get('priority', DEFAULT_PRIORITY))
+    except ValueError:
+        return jsonify({'error': 'Priority must be an integer'}), 400
+    
+    # Save uploaded files, the worker removes them when the job finishes
+    request_id = str(uuid.uuid4())
+    audio_path = f"temp_audio_{request_id}.{audio_file.filename.rsplit('.', 1)[1]}"
+    image_path = f"temp_image_{request_id}.{image_file.filename.rsplit('.', 1)[1]}"
+    
+    audio_file.save(audio_path)
+    image_file.save(image_path)
+    
+    try:
+        job = submit_talking_video(audio_path, image_path, prompt, f"output_{request_id}",
+                                   priority=priority, cleanup_paths=[audio_path, image_path])
+    except queue.Full:
+        os.remove(audio_path)
+        os.remove(image_path)
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503
+    
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id,
+        'status_url': f'/api/voice/jobs/{job.job_id}',
+        'download_url': f'/api/voice/jobs/{job.job_id}/download'
+    }), 202
+
+@app.route('/api/voice/jobs/<job_id>')
+def voice_job_status(job_id):
+    """Status and per-clip / per-step progress of a queued job"""
+    job = get_worker().get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    status = job.to_dict()
+    status['queued_jobs'] = get_worker().queue_size()
+    return jsonify(status)
+
+@app.route('/api/voice/jobs/<job_id>/download')
+def download_job_video(job_id):
+    """Stream the video of a finished job (supports range requests)"""
+    job = get_worker().get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'succeeded':
+        return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+    if not os.path.exists(job.result):
+        return jsonify({'error': 'File not found'}), 404
+    return send_file(job.result, mimetype='video/mp4', as_attachment=True, conditional=True)
+
 @app.route('/api/voice/download/<filename>')
 def download_video(filename):
     """Download generated video"""
@@ -1,5 +1,4 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.cuda.amp as amp
@@ -10,20 +9,21 @@ from xfuser.core.distributed import (
 )
 from einops import rearrange
 from xfuser.core.long_ctx_attention import xFuserLongContextAttention
-import xformers.ops
 
 from ..modules.model import sinusoidal_embedding_1d
+from ..modules.multitalk_model import apply_rotary, rope_cos_sin
 from ..utils.multitalk_utils import get_attn_map_with_target, split_token_counts_and_frame_ids, normalize_and_scale
-from ..modules.attention import SingleStreamAttention, SingleStreamMutiAttention
+from ..modules.attention import SingleStreamAttention, SingleStreamMutiAttention, segment_attention
 
 
-def pad_freqs(original_tensor, target_len):
+def pad_freqs(original_tensor, target_len, value=1):
     seq_len, s1, s2 = original_tensor.shape
     pad_size = target_len - seq_len
-    padding_tensor = torch.ones(
-        pad_size,
+    padding_tensor = torch.full(
+        (pad_size,
         s1,
-        s2,
+        s2),
+        value,
         dtype=original_tensor.dtype,
         device=original_tensor.device)
     padded_tensor = torch.cat([original_tensor, padding_tensor], dim=0)
@@ -37,38 +37,21 @@ def rope_apply(x, grid_sizes, freqs):
     grid_sizes: [B, 3].
     freqs:      [M, C // 2].
     """
-    s, n, c = x.size(1), x.size(2), x.size(3) // 2
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1) # [[N, head_dim/2], [N, head_dim/2], [N, head_dim/2]] # T H W 极坐标
+    s = x.size(1)
+    sp_size = get_sequence_parallel_world_size()
+    sp_rank = get_sequence_parallel_rank()
 
     # loop over samples
     output = []
     for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
-
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2)) # [L, N, C/2] # 极坐标
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1) # seq_lens, 1,  3 * dim / 2 (T H W)
+        # cached float32 tables, padded with the identity rotation and sharded per rank
+        cos, sin = rope_cos_sin(freqs, f, h, w, x.device)
+        cos = pad_freqs(cos, s * sp_size, 1)[sp_rank * s:(sp_rank + 1) * s]
+        sin = pad_freqs(sin, s * sp_size, 0)[sp_rank * s:(sp_rank + 1) * s]
 
         # apply rotary embedding
-        sp_size = get_sequence_parallel_world_size()
-        sp_rank = get_sequence_parallel_rank()
-        freqs_i = pad_freqs(freqs_i, s * sp_size)
-        s_per_rank = s
-        freqs_i_rank = freqs_i[(sp_rank * s_per_rank):((sp_rank + 1) *
-                                                       s_per_rank), :, :]
-        x_i = torch.view_as_real(x_i * freqs_i_rank).flatten(2)
-        x_i = torch.cat([x_i, x[i, s:]])
-
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+        output.append(apply_rotary(x[i], cos, sin))
+    return torch.stack(output)
 
 
 def usp_dit_forward_vace(self, x, vace_context, seq_len, kwargs):
@@ -239,11 +222,15 @@ def usp_dit_forward_multitalk(
     y=None,
     audio=None,
     ref_target_masks=None,
+    teacache=None,
+    teacache_branch=None,
 ):
     """
     x:              A list of videos each with shape [C, T, H, W].
     t:              [B].
     context:        A list of text embeddings each with shape [L, C].
+    teacache:       Optional `TeaCache` of the running job.
+    teacache_branch: Guidance branch key of the batch.
     """
     
     assert clip_fea is not None and y is not None
@@ -319,49 +306,6 @@ def usp_dit_forward_multitalk(
         token_ref_target_masks = token_ref_target_masks.view(token_ref_target_masks.shape[0], -1) 
         token_ref_target_masks = token_ref_target_masks.to(x.dtype)
     
-    if self.enable_teacache:
-        modulated_inp = e0 if self.use_ret_steps else e
-        if self.cnt%3==0: # cond
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_cond = True
-                self.accumulated_rel_l1_distance_cond = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_cond += rescale_func(((modulated_inp-self.previous_e0_cond).abs().mean() / self.previous_e0_cond.abs().mean()).cpu().item())
-                # print("accumulated_rel_l1_distance_even", self.accumulated_rel_l1_distance_even)
-                if self.accumulated_rel_l1_distance_cond < self.teacache_thresh:
-                    should_calc_cond = False
-                else:
-                    should_calc_cond = True
-                    self.accumulated_rel_l1_distance_cond = 0
-            self.previous_e0_cond = modulated_inp.clone()
-        elif self.cnt%3==1: # drop_text
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_drop_text = True
-                self.accumulated_rel_l1_distance_drop_text = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_drop_text += rescale_func(((modulated_inp-self.previous_e0_drop_text).abs().mean() / self.previous_e0_drop_text.abs().mean()).cpu().item())
-                if self.accumulated_rel_l1_distance_drop_text < self.teacache_thresh:
-                    should_calc_drop_text = False
-                else:
-                    should_calc_drop_text = True
-                    self.accumulated_rel_l1_distance_drop_text = 0
-            self.previous_e0_drop_text = modulated_inp.clone()
-        else: # uncond
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                should_calc_uncond = True
-                self.accumulated_rel_l1_distance_uncond = 0
-            else:
-                rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_uncond += rescale_func(((modulated_inp-self.previous_e0_uncond).abs().mean() / self.previous_e0_uncond.abs().mean()).cpu().item())
-                if self.accumulated_rel_l1_distance_uncond < self.teacache_thresh:
-                    should_calc_uncond = False
-                else:
-                    should_calc_uncond = True
-                    self.accumulated_rel_l1_distance_uncond = 0
-            self.previous_e0_uncond = modulated_inp.clone()
-
     # Context Parallel
     x = torch.chunk(
         x, get_sequence_parallel_world_size(),
@@ -380,34 +324,15 @@ def usp_dit_forward_multitalk(
         human_num=human_num,
         )
 
-    if self.enable_teacache:
-        if self.cnt%3==0:
-            if not should_calc_cond:
-                x +=  self.previous_residual_cond
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_cond = x - ori_x
-        elif self.cnt%3==1:
-            if not should_calc_drop_text:
-                x +=  self.previous_residual_drop_text
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_drop_text = x - ori_x
-        else:
-            if not should_calc_uncond:
-                x +=  self.previous_residual_uncond
-            else:
-                ori_x = x.clone()
-                for block in self.blocks:
-                    x = block(x, **kwargs)
-                self.previous_residual_uncond = x - ori_x
-    else:
+    def run_blocks(x):
         for block in self.blocks:
             x = block(x, **kwargs)
+        return x
+
+    if teacache is not None:
+        x = teacache.run(teacache_branch, x, e0 if teacache.use_ret_steps else e, run_blocks)
+    else:
+        x = run_blocks(x)
 
     # head
     x = self.head(x, e)
@@ -417,11 +342,7 @@ def usp_dit_forward_multitalk(
 
     # unpatchify
     x = self.unpatchify(x, grid_sizes)
-    if self.enable_teacache:
-        self.cnt += 1
-        if self.cnt >= self.num_steps:
-            self.cnt = 0
-        
+
     return torch.stack(x).float()
 
 
@@ -536,8 +457,7 @@ def usp_crossattn_multi_forward_multitalk(self,
         q = rearrange(q, "B H M K -> B M H K")
         encoder_k = rearrange(encoder_k, "B H M K -> B M H K")
         encoder_v = rearrange(encoder_v, "B H M K -> B M H K")
-        attn_bias = xformers.ops.fmha.attn_bias.BlockDiagonalMask.from_seqlens(visual_seqlen, kv_seq)
-        x = xformers.ops.memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=attn_bias, op=None,)
+        x = segment_attention(q, encoder_k, encoder_v, visual_seqlen, kv_seq)
         x = rearrange(x, "B M H K -> B H M K")
 
         # linear transform
@@ -1,14 +1,13 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+import time
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 from ..utils.multitalk_utils import RotaryPositionalEmbedding1D, normalize_and_scale, split_token_counts_and_frame_ids
-from xfuser.core.distributed import (
-    get_sequence_parallel_rank,
-    get_sequence_parallel_world_size,
-    get_sp_group,
-)
-import xformers.ops
 
 try:
     import flash_attn_interface
@@ -22,14 +21,251 @@ try:
 except ModuleNotFoundError:
     FLASH_ATTN_2_AVAILABLE = False
 
+try:
+    import xformers.ops
+    XFORMERS_AVAILABLE = True
+except ModuleNotFoundError:
+    XFORMERS_AVAILABLE = False
+
 import warnings
 
 __all__ = [
     'flash_attention',
     'attention',
+    'varlen_attention',
+    'segment_attention',
+    'register_attention_backend',
+    'set_attention_backend',
+    'get_attention_backend',
+    'available_attention_backends',
+    'autotune_attention_backend',
+    'select_attention_backend',
 ]
 
 
+# Attention backends all implement the packed varlen interface of
+# flash_attn_varlen_func:
+#   fn(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+#      dropout_p, softmax_scale, causal, window_size, deterministic)
+# with q [sum(q_lens), Nq, C1], k [sum(k_lens), Nk, C1], v [sum(k_lens), Nk, C2].
+# Sequence i attends only to key / value sequence i, so padding masks and
+# block-diagonal masks are both expressed through the cu_seqlens.
+ATTENTION_BACKENDS = {}
+
+# Preference order of the `auto` backend on CUDA devices.
+AUTO_BACKEND_ORDER = ['flash3', 'flash2', 'xformers', 'sdpa']
+
+# Tokens of the problem `autotune` times the backends on, about a quarter of a
+# 480p clip's latent sequence.
+AUTOTUNE_SEQ_LEN = 8192
+
+_attention_backend = os.getenv('WAN_ATTENTION_BACKEND', 'auto')
+
+
+class AttentionBackend:
+
+    def __init__(self, name, fn, available, cuda_only=True, half_only=True):
+        self.name = name
+        self.fn = fn
+        self.available = available
+        self.cuda_only = cuda_only
+        self.half_only = half_only
+
+    def supports(self, device):
+        return self.available and (device.type == 'cuda' or not self.cuda_only)
+
+
+def register_attention_backend(name, available=True, cuda_only=True, half_only=True):
+    """Decorator registering a varlen attention implementation under `name`."""
+
+    def decorator(fn):
+        ATTENTION_BACKENDS[name] = AttentionBackend(name, fn, available, cuda_only, half_only)
+        return fn
+
+    return decorator
+
+
+def set_attention_backend(name):
+    """Select the attention backend of this process (`auto` or a registered name)."""
+    global _attention_backend
+    if name != 'auto':
+        if name not in ATTENTION_BACKENDS:
+            raise ValueError(f'Unknown attention backend {name}, choose from {list(ATTENTION_BACKENDS)}')
+        if not ATTENTION_BACKENDS[name].available:
+            raise ValueError(f'Attention backend {name} is not installed.')
+    _attention_backend = name
+
+
+def get_attention_backend(device, version=None):
+    """Resolve the backend used for tensors on `device`."""
+    if _attention_backend not in ('auto', 'autotune'):
+        backend = ATTENTION_BACKENDS[_attention_backend]
+        if not backend.supports(device):
+            raise RuntimeError(f'Attention backend {backend.name} does not support {device.type} tensors.')
+        return backend
+    order = AUTO_BACKEND_ORDER
+    if version == 2:
+        order = [name for name in order if name != 'flash3']
+    for name in order:
+        if ATTENTION_BACKENDS[name].supports(device):
+            return ATTENTION_BACKENDS[name]
+    raise RuntimeError(f'No attention backend supports {device.type} tensors.')
+
+
+def available_attention_backends(device):
+    return [name for name, backend in ATTENTION_BACKENDS.items() if backend.supports(device)]
+
+
+def _seqlens(cu_seqlens):
+    return (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+
+
+@register_attention_backend('flash3', available=FLASH_ATTN_3_AVAILABLE)
+def _flash3_varlen(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+                   dropout_p=0., softmax_scale=None, causal=False,
+                   window_size=(-1, -1), deterministic=False):
+    # Note: dropout_p, window_size are not supported in FA3 now.
+    return flash_attn_interface.flash_attn_varlen_func(
+        q=q,
+        k=k,
+        v=v,
+        cu_seqlens_q=cu_seqlens_q,
+        cu_seqlens_k=cu_seqlens_k,
+        seqused_q=None,
+        seqused_k=None,
+        max_seqlen_q=max_seqlen_q,
+        max_seqlen_k=max_seqlen_k,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        deterministic=deterministic)[0]
+
+
+@register_attention_backend('flash2', available=FLASH_ATTN_2_AVAILABLE)
+def _flash2_varlen(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+                   dropout_p=0., softmax_scale=None, causal=False,
+                   window_size=(-1, -1), deterministic=False):
+    return flash_attn.flash_attn_varlen_func(
+        q=q,
+        k=k,
+        v=v,
+        cu_seqlens_q=cu_seqlens_q,
+        cu_seqlens_k=cu_seqlens_k,
+        max_seqlen_q=max_seqlen_q,
+        max_seqlen_k=max_seqlen_k,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic)
+
+
+@register_attention_backend('xformers', available=XFORMERS_AVAILABLE)
+def _xformers_varlen(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+                     dropout_p=0., softmax_scale=None, causal=False,
+                     window_size=(-1, -1), deterministic=False):
+    if window_size != (-1, -1):
+        raise NotImplementedError('The xformers attention backend does not support window_size.')
+    mask_cls = xformers.ops.fmha.attn_bias.BlockDiagonalCausalFromBottomRightMask if causal \
+        else xformers.ops.fmha.attn_bias.BlockDiagonalMask
+    attn_bias = mask_cls.from_seqlens(_seqlens(cu_seqlens_q), _seqlens(cu_seqlens_k))
+    if k.size(1) != q.size(1):
+        # grouped query attention
+        k = k.repeat_interleave(q.size(1) // k.size(1), dim=1)
+        v = v.repeat_interleave(q.size(1) // v.size(1), dim=1)
+    return xformers.ops.memory_efficient_attention(
+        q[None], k[None], v[None], attn_bias=attn_bias, p=dropout_p, scale=softmax_scale)[0]
+
+
+@register_attention_backend('sdpa', cuda_only=False, half_only=False)
+def _sdpa_varlen(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k,
+                 dropout_p=0., softmax_scale=None, causal=False,
+                 window_size=(-1, -1), deterministic=False):
+    if window_size != (-1, -1):
+        raise NotImplementedError('The sdpa attention backend does not support window_size.')
+    if k.size(1) != q.size(1):
+        # grouped query attention
+        k = k.repeat_interleave(q.size(1) // k.size(1), dim=1)
+        v = v.repeat_interleave(q.size(1) // v.size(1), dim=1)
+    q_lens, k_lens = _seqlens(cu_seqlens_q), _seqlens(cu_seqlens_k)
+
+    def sdpa(q, k, v):
+        # q, k, v: [B, L, N, C]
+        lq, lk = q.size(1), k.size(1)
+        attn_mask = None
+        if causal and lq != lk:
+            # align the causal mask to the bottom right like flash attention
+            attn_mask = torch.ones(lq, lk, dtype=torch.bool, device=q.device).tril(lk - lq)
+        out = F.scaled_dot_product_attention(
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2),
+            attn_mask=attn_mask, dropout_p=dropout_p,
+            is_causal=causal and lq == lk, scale=softmax_scale)
+        return out.transpose(1, 2)
+
+    if len(set(q_lens)) == 1 and len(set(k_lens)) == 1:
+        # equal lengths: a single batched call
+        b = len(q_lens)
+        return sdpa(q.unflatten(0, (b, q_lens[0])), k.unflatten(0, (b, k_lens[0])),
+                    v.unflatten(0, (b, k_lens[0]))).flatten(0, 1)
+    out = [
+        sdpa(q_i[None], k_i[None], v_i[None])[0]
+        for q_i, k_i, v_i in zip(q.split(q_lens), k.split(k_lens), v.split(k_lens))
+    ]
+    return torch.cat(out)
+
+
+def varlen_attention(
+    q,
+    k,
+    v,
+    q_lens,
+    k_lens,
+    dropout_p=0.,
+    softmax_scale=None,
+    causal=False,
+    window_size=(-1, -1),
+    deterministic=False,
+    dtype=torch.bfloat16,
+    version=None,
+):
+    """
+    q:              [sum(q_lens), Nq, C1], packed sequences.
+    k:              [sum(k_lens), Nk, C1].
+    v:              [sum(k_lens), Nk, C2]. Nq must be divisible by Nk.
+    q_lens:         list of int or [B] tensor. Query sequence i attends to key sequence i only.
+    k_lens:         list of int or [B] tensor.
+    dtype:          torch.dtype. Apply when the backend needs float16/bfloat16 inputs.
+    version:        int. Restricts the `auto` backend to flash attention 2 when set to 2.
+
+    Returns [sum(q_lens), Nq, C2] computed with the selected attention backend.
+    """
+    half_dtypes = (torch.float16, torch.bfloat16)
+    out_dtype = q.dtype
+    backend = get_attention_backend(q.device, version)
+    if backend.half_only:
+        assert dtype in half_dtypes and q.size(-1) <= 256
+        q, k, v = [x if x.dtype in half_dtypes else x.to(dtype) for x in (q, k, v)]
+    q = q.to(v.dtype)
+    k = k.to(v.dtype)
+
+    q_lens = torch.as_tensor(q_lens, dtype=torch.int32)
+    k_lens = torch.as_tensor(k_lens, dtype=torch.int32)
+    cu_seqlens_q = torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
+        0, dtype=torch.int32).to(q.device, non_blocking=True)
+    cu_seqlens_k = torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
+        0, dtype=torch.int32).to(q.device, non_blocking=True)
+
+    x = backend.fn(
+        q, k, v, cu_seqlens_q, cu_seqlens_k,
+        max_seqlen_q=int(q_lens.max()),
+        max_seqlen_k=int(k_lens.max()),
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic)
+    return x.type(out_dtype)
+
+
 def flash_attention(
     q,
     k,
@@ -57,86 +293,57 @@ def flash_attention(
     window_size:    (left right). If not (-1, -1), apply sliding window local attention.
     deterministic:  bool. If True, slightly slower and uses more memory.
     dtype:          torch.dtype. Apply when dtype of q/k/v is not float16/bfloat16.
+
+    Runs on the attention backend selected with `set_attention_backend` (or the
+    WAN_ATTENTION_BACKEND environment variable); query positions past q_lens
+    are returned as zeros.
     """
-    half_dtypes = (torch.float16, torch.bfloat16)
-    assert dtype in half_dtypes
-    assert q.device.type == 'cuda' and q.size(-1) <= 256
+    if version is not None and version == 3 and not FLASH_ATTN_3_AVAILABLE:
+        warnings.warn(
+            'Flash attention 3 is not available, use flash attention 2 instead.'
+        )
 
     # params
-    b, lq, lk, out_dtype = q.size(0), q.size(1), k.size(1), q.dtype
-
-    def half(x):
-        return x if x.dtype in half_dtypes else x.to(dtype)
+    b, lq, lk = q.size(0), q.size(1), k.size(1)
 
     # preprocess query
     if q_lens is None:
-        q = half(q.flatten(0, 1))
-        q_lens = torch.tensor(
-            [lq] * b, dtype=torch.int32).to(
-                device=q.device, non_blocking=True)
+        q_lens = [lq] * b
+        q = q.flatten(0, 1)
     else:
-        q = half(torch.cat([u[:v] for u, v in zip(q, q_lens)]))
+        q = torch.cat([u[:v] for u, v in zip(q, q_lens)])
 
     # preprocess key, value
     if k_lens is None:
-        k = half(k.flatten(0, 1))
-        v = half(v.flatten(0, 1))
-        k_lens = torch.tensor(
-            [lk] * b, dtype=torch.int32).to(
-                device=k.device, non_blocking=True)
+        k_lens = [lk] * b
+        k = k.flatten(0, 1)
+        v = v.flatten(0, 1)
     else:
-        k = half(torch.cat([u[:v] for u, v in zip(k, k_lens)]))
-        v = half(torch.cat([u[:v] for u, v in zip(v, k_lens)]))
-
-    q = q.to(v.dtype)
-    k = k.to(v.dtype)
+        k = torch.cat([u[:v] for u, v in zip(k, k_lens)])
+        v = torch.cat([u[:v] for u, v in zip(v, k_lens)])
 
     if q_scale is not None:
         q = q * q_scale
 
-    if version is not None and version == 3 and not FLASH_ATTN_3_AVAILABLE:
-        warnings.warn(
-            'Flash attention 3 is not available, use flash attention 2 instead.'
-        )
-
     # apply attention
-    if (version is None or version == 3) and FLASH_ATTN_3_AVAILABLE:
-        # Note: dropout_p, window_size are not supported in FA3 now.
-        x = flash_attn_interface.flash_attn_varlen_func(
-            q=q,
-            k=k,
-            v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            seqused_q=None,
-            seqused_k=None,
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
-            softmax_scale=softmax_scale,
-            causal=causal,
-            deterministic=deterministic)[0].unflatten(0, (b, lq))
-    else:
-        assert FLASH_ATTN_2_AVAILABLE
-        x = flash_attn.flash_attn_varlen_func(
-            q=q,
-            k=k,
-            v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic).unflatten(0, (b, lq))
+    x = varlen_attention(
+        q, k, v, q_lens, k_lens,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        dtype=dtype,
+        version=version)
 
     # output
-    return x.type(out_dtype)
+    q_lens = torch.as_tensor(q_lens).tolist()
+    if sum(q_lens) == b * lq:
+        return x.unflatten(0, (b, lq))
+    out = x.new_zeros(b, lq, *x.shape[1:])
+    for out_i, x_i in zip(out, x.split(q_lens)):
+        out_i[:x_i.size(0)] = x_i
+    return out
 
 
 def attention(
@@ -154,39 +361,79 @@ def attention(
     dtype=torch.bfloat16,
     fa_version=None,
 ):
-    if FLASH_ATTN_2_AVAILABLE or FLASH_ATTN_3_AVAILABLE:
-        return flash_attention(
-            q=q,
-            k=k,
-            v=v,
-            q_lens=q_lens,
-            k_lens=k_lens,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            q_scale=q_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic,
-            dtype=dtype,
-            version=fa_version,
-        )
-    else:
-        if q_lens is not None or k_lens is not None:
-            warnings.warn(
-                'Padding mask is disabled when using scaled_dot_product_attention. It can have a significant impact on performance.'
-            )
-        attn_mask = None
+    # every backend honours q_lens / k_lens, including the sdpa fallback
+    return flash_attention(
+        q=q,
+        k=k,
+        v=v,
+        q_lens=q_lens,
+        k_lens=k_lens,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        q_scale=q_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        dtype=dtype,
+        version=fa_version,
+    )
+
+
+def segment_attention(q, k, v, q_seqlens=None, kv_seqlens=None):
+    """
+    Drop-in for `xformers.ops.memory_efficient_attention` on [B, M, H, K] inputs.
 
-        q = q.transpose(1, 2).to(dtype)
-        k = k.transpose(1, 2).to(dtype)
-        v = v.transpose(1, 2).to(dtype)
+    With `q_seqlens` / `kv_seqlens` (B must be 1) the tokens are split into
+    segments and segment i of q only attends to segment i of k / v, like
+    xformers' `BlockDiagonalMask.from_seqlens`.
+    """
+    if q_seqlens is None:
+        return flash_attention(q, k, v)
+    assert q.size(0) == 1, 'block-diagonal attention expects a packed batch of one'
+    return varlen_attention(q[0], k[0], v[0], q_seqlens, kv_seqlens)[None]
 
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
 
-        out = out.transpose(1, 2).contiguous()
-        return out
-    
+def autotune_attention_backend(q, k, v, repeats=5, select=True):
+    """
+    Time every backend available for `q.device` on a representative [B, L, N, C]
+    problem, optionally select the fastest and return {name: seconds per call}.
+    """
+    timings = {}
+    previous = _attention_backend
+    for name in available_attention_backends(q.device):
+        set_attention_backend(name)
+        try:
+            flash_attention(q, k, v)
+            if q.device.type == 'cuda':
+                torch.cuda.synchronize(q.device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                flash_attention(q, k, v)
+            if q.device.type == 'cuda':
+                torch.cuda.synchronize(q.device)
+            timings[name] = (time.perf_counter() - start) / repeats
+        except (RuntimeError, NotImplementedError, AssertionError) as e:
+            warnings.warn(f'Attention backend {name} failed during autotune: {e}')
+    set_attention_backend(min(timings, key=timings.get) if select and timings else previous)
+    return timings
+
+
+def select_attention_backend(name, device, num_heads, head_dim, dtype=torch.bfloat16,
+                             seq_len=AUTOTUNE_SEQ_LEN):
+    """
+    Select the backend `name`. `autotune` times the backends available for
+    `device` on a [1, seq_len, num_heads, head_dim] self-attention and selects
+    the fastest, falling back to `auto` when none of them runs.
+    """
+    if name != 'autotune':
+        set_attention_backend(name)
+        return
+    set_attention_backend('auto')
+    q, k, v = (torch.randn(1, seq_len, num_heads, head_dim, device=device, dtype=dtype)
+               for _ in range(3))
+    timings = autotune_attention_backend(q, k, v)
+    logging.info(f'Attention backend timings: {timings}, using {_attention_backend}')
+
 
 class SingleStreamAttention(nn.Module):
     def __init__(
@@ -256,14 +503,17 @@ class SingleStreamAttention(nn.Module):
 
         if enable_sp:
             # context parallel
+            from xfuser.core.distributed import (
+                get_sequence_parallel_rank,
+                get_sequence_parallel_world_size,
+            )
             sp_size = get_sequence_parallel_world_size()
             sp_rank = get_sequence_parallel_rank()
             visual_seqlen, _ = split_token_counts_and_frame_ids(N_t, N_h * N_w, sp_size, sp_rank)
             assert kv_seq is not None, f"kv_seq should not be None."
-            attn_bias = xformers.ops.fmha.attn_bias.BlockDiagonalMask.from_seqlens(visual_seqlen, kv_seq)
+            x = segment_attention(q, encoder_k, encoder_v, visual_seqlen, kv_seq)
         else:
-            attn_bias = None
-        x = xformers.ops.memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=attn_bias, op=None,)
+            x = segment_attention(q, encoder_k, encoder_v)
         x = rearrange(x, "B M H K -> B H M K") 
 
         # linear transform
@@ -377,7 +627,7 @@ class SingleStreamMutiAttention(SingleStreamAttention):
         q = rearrange(q, "B H M K -> B M H K")
         encoder_k = rearrange(encoder_k, "B H M K -> B M H K")
         encoder_v = rearrange(encoder_v, "B H M K -> B M H K")
-        x = xformers.ops.memory_efficient_attention(q, encoder_k, encoder_v, attn_bias=None, op=None,)
+        x = segment_attention(q, encoder_k, encoder_v)
         x = rearrange(x, "B M H K -> B H M K")
 
         # linear transform
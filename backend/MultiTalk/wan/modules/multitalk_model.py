@@ -1,11 +1,11 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
-import numpy as np
 import os
 import torch
 import torch.cuda.amp as amp
 import torch.nn as nn
 import torch.nn.functional as F
+from functools import lru_cache
 
 from einops import rearrange
 from diffusers import ModelMixin
@@ -43,30 +43,58 @@ def rope_params(max_seq_len, dim, theta=10000):
     return freqs
 
 
-@amp.autocast(enabled=False)
-def rope_apply(x, grid_sizes, freqs):
-    s, n, c = x.size(1), x.size(2), x.size(3) // 2
+@lru_cache(maxsize=32)
+def rope_cos_sin(freqs, f, h, w, device):
+    """
+    float32 cos / sin tables [f * h * w, 1, C // 2] of the 3D rope for an (f, h, w) grid.
 
+    Cached per grid and device, so the tables are built and copied to the device
+    once instead of in every attention block.
+    """
+    c = freqs.size(1)
     freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+    freqs_i = torch.cat([
+        freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+        freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+        freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+    ],
+                        dim=-1).reshape(f * h * w, 1, -1)
+    return (freqs_i.real.to(device=device, dtype=torch.float32),
+            freqs_i.imag.to(device=device, dtype=torch.float32))
 
-    output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
 
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
-        freqs_i = freqs_i.to(device=x_i.device)
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
+def apply_rotary(x, cos, sin):
+    """
+    Rotate interleaved (real, imag) channel pairs of x [..., L, N, C] by cos / sin [L, 1, C // 2] in float32.
+    """
+    x = x.float().unflatten(-1, (-1, 2))
+    x_re, x_im = x.unbind(-1)
+    return torch.stack([x_re * cos - x_im * sin, x_re * sin + x_im * cos], dim=-1).flatten(-2)
+
+
+@amp.autocast(enabled=False)
+def rope_apply(x, grid_sizes, freqs):
+    """
+    x:          [B, L, N, C].
+    grid_sizes: [B, 3].
+    freqs:      [M, C // 2], complex.
+    """
+    grids = [tuple(g) for g in grid_sizes.tolist()]
+    if len(set(grids)) == 1:
+        # all samples share a grid: one batched apply
+        f, h, w = grids[0]
+        seq_len = f * h * w
+        cos, sin = rope_cos_sin(freqs, f, h, w, x.device)
+        out = apply_rotary(x[:, :seq_len], cos, sin)
+        return torch.cat([out, x[:, seq_len:].float()], dim=1)
 
-        output.append(x_i)
-    return torch.stack(output).float()
+    output = []
+    for i, (f, h, w) in enumerate(grids):
+        seq_len = f * h * w
+        cos, sin = rope_cos_sin(freqs, f, h, w, x.device)
+        x_i = apply_rotary(x[i, :seq_len], cos, sin)
+        output.append(torch.cat([x_i, x[i, seq_len:].float()]))
+    return torch.stack(output)
 
 
 class WanRMSNorm(nn.Module):
@@ -157,8 +185,18 @@ class WanSelfAttention(nn.Module):
         x = x.flatten(2)
         x = self.o(x)
         with torch.no_grad():
-            x_ref_attn_map = get_attn_map_with_target(q.type_as(x), k.type_as(x), grid_sizes[0], 
-                                                    ref_target_masks=ref_target_masks)
+            # a list holds the masks of each sample, when the batch mixes jobs
+            per_sample_masks = isinstance(ref_target_masks, (list, tuple))
+            if b == 1:
+                x_ref_attn_map = get_attn_map_with_target(q.type_as(x), k.type_as(x), grid_sizes[0], 
+                                                        ref_target_masks=ref_target_masks[0] if per_sample_masks else ref_target_masks)
+            else:
+                # the routing map is defined per sample, so compute it for each batch entry
+                x_ref_attn_map = [
+                    get_attn_map_with_target(q[i:i+1].type_as(x), k[i:i+1].type_as(x), grid_sizes[i], 
+                                             ref_target_masks=ref_target_masks[i] if per_sample_masks else ref_target_masks)
+                    for i in range(b)
+                ]
 
         return x, x_ref_attn_map
 
@@ -291,8 +329,12 @@ class WanAttentionBlock(nn.Module):
         x = x + self.cross_attn(self.norm3(x), context, context_lens)
 
         # cross attn of audio
-        x_a = self.audio_cross_attn(self.norm_x(x), encoder_hidden_states=audio_embedding,
-                                        shape=grid_sizes[0], x_ref_attn_map=x_ref_attn_map, human_num=human_num)
+        if isinstance(human_num, (list, tuple)):
+            x_a = self.batched_audio_cross_attn(self.norm_x(x), audio_embedding,
+                                                grid_sizes[0], x_ref_attn_map, human_num)
+        else:
+            x_a = self.audio_cross_attn(self.norm_x(x), encoder_hidden_states=audio_embedding,
+                                            shape=grid_sizes[0], x_ref_attn_map=x_ref_attn_map, human_num=human_num)
         x = x + x_a
 
         y = self.ffn((self.norm2(x).float() * (1 + e[4]) + e[3]).to(dtype))
@@ -305,6 +347,33 @@ class WanAttentionBlock(nn.Module):
         return x
 
 
+    def batched_audio_cross_attn(self, x, audio_embedding, shape, x_ref_attn_map, human_num):
+        r"""
+        Audio cross-attention for a batch whose samples carry different audio.
+
+        Args:
+            x(Tensor): Shape [B, L, C]
+            audio_embedding(List[Tensor]): B tensors of shape [1, N_t, 32 * human_num, C_a]
+            x_ref_attn_map(List[Tensor]): B per-sample routing maps
+            human_num(List[int]): Number of speakers of each sample
+        """
+        x_a = torch.empty_like(x)
+
+        # single-speaker samples need no routing and share one attention call
+        single = [i for i, num in enumerate(human_num) if num == 1]
+        if single:
+            encoder_hidden_states = torch.cat([audio_embedding[i] for i in single]).flatten(0, 1)
+            x_a[single] = self.audio_cross_attn(x[single], encoder_hidden_states=encoder_hidden_states,
+                                                shape=shape, human_num=1)
+
+        for i, num in enumerate(human_num):
+            if num == 1:
+                continue
+            x_a[i:i+1] = self.audio_cross_attn(x[i:i+1], encoder_hidden_states=audio_embedding[i],
+                                               shape=shape, x_ref_attn_map=x_ref_attn_map[i], human_num=num)
+        return x_a
+
+
 class Head(nn.Module):
 
     def __init__(self, dim, out_dim, patch_size, eps=1e-6):
@@ -529,47 +598,6 @@ class WanModel(ModelMixin, ConfigMixin):
         # initialize weights
         self.init_weights()
 
-    def teacache_init(
-        self,
-        use_ret_steps=True,
-        teacache_thresh=0.2,
-        sample_steps=40,
-        model_scale='multitalk-480',
-    ):
-        print("teacache_init")
-        self.enable_teacache = True
-        
-        self.__class__.cnt = 0
-        self.__class__.num_steps = sample_steps*3
-        self.__class__.teacache_thresh = teacache_thresh
-        self.__class__.accumulated_rel_l1_distance_even = 0
-        self.__class__.accumulated_rel_l1_distance_odd = 0
-        self.__class__.previous_e0_even = None
-        self.__class__.previous_e0_odd = None
-        self.__class__.previous_residual_even = None
-        self.__class__.previous_residual_odd = None
-        self.__class__.use_ret_steps = use_ret_steps
-
-        if use_ret_steps:
-            if model_scale == 'multitalk-480':
-                self.__class__.coefficients = [ 2.57151496e+05, -3.54229917e+04,  1.40286849e+03, -1.35890334e+01, 1.32517977e-01]
-            if model_scale == 'multitalk-720':
-                self.__class__.coefficients = [ 8.10705460e+03,  2.13393892e+03, -3.72934672e+02,  1.66203073e+01, -4.17769401e-02]
-            self.__class__.ret_steps = 5*3
-            self.__class__.cutoff_steps = sample_steps*3
-        else:
-            if model_scale == 'multitalk-480':
-                self.__class__.coefficients = [-3.02331670e+02,  2.23948934e+02, -5.25463970e+01,  5.87348440e+00, -2.01973289e-01]
-        
-            if model_scale == 'multitalk-720':
-                self.__class__.coefficients = [-114.36346466,   65.26524496,  -18.82220707,    4.91518089,   -0.23412683]
-            self.__class__.ret_steps = 1*3
-            self.__class__.cutoff_steps = sample_steps*3 - 3
-        print("teacache_init done")
-    
-    def disable_teacache(self):
-        self.enable_teacache = False
-
     def forward(
             self,
             x,
@@ -580,7 +608,21 @@ class WanModel(ModelMixin, ConfigMixin):
             y=None,
             audio=None,
             ref_target_masks=None,
+            teacache=None,
+            teacache_branch=None,
         ):
+        """
+        x:              A list of B latents each with shape [C, T, H, W].
+        context:        A list of B text embeddings each with shape [L, C].
+        clip_fea:       [B, 257, 1280].
+        y:              [B, 4 + C, T, H, W].
+        audio:          [human_num, F, W, S, C], or a list of B such tensors when
+                        the samples are conditioned on different audio.
+        ref_target_masks: [3, H, W] speaker and background masks in latent
+                        resolution, or a list of B such masks.
+        teacache:       Optional `TeaCache` of the running job.
+        teacache_branch: Guidance branch key of the batch, or a list of B keys.
+        """
         assert clip_fea is not None and y is not None
 
         _, T, H, W = x[0].shape
@@ -590,7 +632,7 @@ class WanModel(ModelMixin, ConfigMixin):
 
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
-        x[0] = x[0].to(context[0].dtype)
+        x = [u.to(context[0].dtype) for u in x]
 
         # embeddings
         x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
@@ -626,6 +668,12 @@ class WanModel(ModelMixin, ConfigMixin):
             context = torch.concat([context_clip, context], dim=1).to(x.dtype)
 
         
+        # a list of per-sample audio means a batch with different conditions (e.g. batched CFG);
+        # all speakers are projected together and split back per sample afterwards
+        batched_audio = isinstance(audio, (list, tuple))
+        if batched_audio:
+            human_nums = [len(u) for u in audio]
+            audio = torch.cat(list(audio), dim=0)
         audio_cond = audio.to(device=x.device, dtype=x.dtype)
         first_frame_audio_emb_s = audio_cond[:, :1, ...] 
         latter_frame_audio_emb = audio_cond[:, 1:, ...] 
@@ -639,61 +687,30 @@ class WanModel(ModelMixin, ConfigMixin):
         latter_middle_frame_audio_emb = rearrange(latter_middle_frame_audio_emb, "b n_t n w s c -> b n_t (n w) s c") 
         latter_frame_audio_emb_s = torch.concat([latter_first_frame_audio_emb, latter_middle_frame_audio_emb, latter_last_frame_audio_emb], dim=2) 
         audio_embedding = self.audio_proj(first_frame_audio_emb_s, latter_frame_audio_emb_s) 
-        human_num = len(audio_embedding)
-        audio_embedding = torch.concat(audio_embedding.split(1), dim=2).to(x.dtype)
+        if batched_audio:
+            human_num = human_nums
+            audio_embedding = [
+                torch.concat(u.split(1), dim=2).to(x.dtype)
+                for u in audio_embedding.split(human_nums)
+            ]
+        else:
+            human_num = len(audio_embedding)
+            audio_embedding = torch.concat(audio_embedding.split(1), dim=2).to(x.dtype)
 
 
         # convert ref_target_masks to token_ref_target_masks
-        if ref_target_masks is not None:
+        def to_token_masks(ref_target_masks):
             ref_target_masks = ref_target_masks.unsqueeze(0).to(torch.float32) 
             token_ref_target_masks = nn.functional.interpolate(ref_target_masks, size=(N_h, N_w), mode='nearest') 
             token_ref_target_masks = token_ref_target_masks.squeeze(0)
             token_ref_target_masks = (token_ref_target_masks > 0)
             token_ref_target_masks = token_ref_target_masks.view(token_ref_target_masks.shape[0], -1) 
-            token_ref_target_masks = token_ref_target_masks.to(x.dtype)
-
-        # teacache
-        if self.enable_teacache:
-            modulated_inp = e0 if self.use_ret_steps else e
-            if self.cnt%3==0: # cond
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_cond = True
-                    self.accumulated_rel_l1_distance_cond = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_cond += rescale_func(((modulated_inp-self.previous_e0_cond).abs().mean() / self.previous_e0_cond.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_cond < self.teacache_thresh:
-                        should_calc_cond = False
-                    else:
-                        should_calc_cond = True
-                        self.accumulated_rel_l1_distance_cond = 0
-                self.previous_e0_cond = modulated_inp.clone()
-            elif self.cnt%3==1: # drop_text
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_drop_text = True
-                    self.accumulated_rel_l1_distance_drop_text = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_drop_text += rescale_func(((modulated_inp-self.previous_e0_drop_text).abs().mean() / self.previous_e0_drop_text.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_drop_text < self.teacache_thresh:
-                        should_calc_drop_text = False
-                    else:
-                        should_calc_drop_text = True
-                        self.accumulated_rel_l1_distance_drop_text = 0
-                self.previous_e0_drop_text = modulated_inp.clone()
-            else: # uncond
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_uncond = True
-                    self.accumulated_rel_l1_distance_uncond = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_uncond += rescale_func(((modulated_inp-self.previous_e0_uncond).abs().mean() / self.previous_e0_uncond.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_uncond < self.teacache_thresh:
-                        should_calc_uncond = False
-                    else:
-                        should_calc_uncond = True
-                        self.accumulated_rel_l1_distance_uncond = 0
-                self.previous_e0_uncond = modulated_inp.clone()
+            return token_ref_target_masks.to(x.dtype)
+
+        if isinstance(ref_target_masks, (list, tuple)):
+            token_ref_target_masks = [to_token_masks(u) for u in ref_target_masks]
+        elif ref_target_masks is not None:
+            token_ref_target_masks = to_token_masks(ref_target_masks)
 
         # arguments
         kwargs = dict(
@@ -707,44 +724,21 @@ class WanModel(ModelMixin, ConfigMixin):
             ref_target_masks=token_ref_target_masks,
             human_num=human_num,
             )
-        if self.enable_teacache:
-            if self.cnt%3==0:
-                if not should_calc_cond:
-                    x +=  self.previous_residual_cond
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_cond = x - ori_x
-            elif self.cnt%3==1:
-                if not should_calc_drop_text:
-                    x +=  self.previous_residual_drop_text
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_drop_text = x - ori_x
-            else:
-                if not should_calc_uncond:
-                    x +=  self.previous_residual_uncond
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_uncond = x - ori_x
-        else:
+        def run_blocks(x):
             for block in self.blocks:
                 x = block(x, **kwargs)
+            return x
+
+        if teacache is not None:
+            x = teacache.run(teacache_branch, x, e0 if teacache.use_ret_steps else e, run_blocks)
+        else:
+            x = run_blocks(x)
 
         # head
         x = self.head(x, e)
 
         # unpatchify
         x = self.unpatchify(x, grid_sizes)
-        if self.enable_teacache:
-            self.cnt += 1
-            if self.cnt >= self.num_steps:
-                self.cnt = 0
 
         return torch.stack(x).float()
 
@@ -1,12 +1,17 @@
 # Modified from transformers.models.t5.modeling_t5
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
 import logging
 import math
+import os
+import threading
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..utils.checkpoint import assign_state_dict, init_empty_weights, load_state_dict
 from .tokenizers import HuggingfaceTokenizer
 
 __all__ = [
@@ -14,6 +19,7 @@ __all__ = [
     'T5Encoder',
     'T5Decoder',
     'T5EncoderModel',
+    'T5EmbeddingCache',
 ]
 
 
@@ -475,25 +481,30 @@ class T5EncoderModel:
         self,
         text_len,
         dtype=torch.bfloat16,
-        device=torch.cuda.current_device(),
+        device=None,
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
     ):
+        # resolved here rather than at import, so `wan` imports without CUDA
+        if device is None:
+            device = torch.cuda.current_device()
         self.text_len = text_len
         self.dtype = dtype
         self.device = device
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
-        # init model
-        model = umt5_xxl(
-            encoder_only=True,
-            return_tokenizer=False,
-            dtype=dtype,
-            device=device).eval().requires_grad_(False)
+        # init model on the meta device, the weights are assigned from the
+        # checkpoint before moving it to `device`
+        with init_empty_weights():
+            model = umt5_xxl(
+                encoder_only=True,
+                return_tokenizer=False,
+                dtype=dtype,
+                device='meta').eval().requires_grad_(False)
         logging.info(f'loading {checkpoint_path}')
-        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+        assign_state_dict(model, load_state_dict(checkpoint_path), dtype=dtype)
         self.model = model
         if shard_fn is not None:
             self.model = shard_fn(self.model, sync_module_states=False)
@@ -511,3 +522,80 @@ class T5EncoderModel:
         seq_lens = mask.gt(0).sum(dim=1).long()
         context = self.model(ids, mask)
         return [u[:v] for u, v in zip(context, seq_lens)]
+
+
+class T5EmbeddingCache:
+    """
+    LRU cache of `T5EncoderModel` outputs.
+
+    Entries are keyed by (tokenizer, text_len, cleaned text), kept on the CPU
+    in memory and optionally persisted to `cache_dir`. The encoder is only
+    moved to the device and run when some of the requested texts miss.
+    """
+
+    def __init__(self, text_encoder, capacity=64, cache_dir=None):
+        self.text_encoder = text_encoder
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text):
+        tokenizer = self.text_encoder.tokenizer
+        if tokenizer.clean:
+            text = tokenizer._clean(text)
+        return (tokenizer.name, self.text_encoder.text_len, text)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.pt')
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            context = torch.load(self._disk_path(key), map_location='cpu', weights_only=True)
+            self._put(key, context, persist=False)
+            return context
+        return None
+
+    def _put(self, key, context, persist=True):
+        with self._lock:
+            self._entries[key] = context
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        if persist and self.cache_dir is not None:
+            path = self._disk_path(key)
+            torch.save(context, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def __call__(self, texts, device, encode_device=None, offload_model=True):
+        """
+        Return the T5 context of each text on `device`.
+
+        Misses are encoded in one batch on `encode_device` (defaults to
+        `device`); when that is not the CPU the encoder is moved there first and,
+        if `offload_model`, back to the CPU afterwards.
+        """
+        encode_device = device if encode_device is None else torch.device(encode_device)
+        keys = [self.key(text) for text in texts]
+        contexts = [self._get(key) for key in keys]
+
+        misses = [i for i, context in enumerate(contexts) if context is None]
+        if misses:
+            on_cpu = encode_device.type == 'cpu'
+            if not on_cpu:
+                self.text_encoder.model.to(encode_device)
+            encoded = self.text_encoder([texts[i] for i in misses], encode_device)
+            if not on_cpu and offload_model:
+                self.text_encoder.model.cpu()
+            for i, context in zip(misses, encoded):
+                contexts[i] = context.cpu()
+                self._put(keys[i], contexts[i])
+
+        return [context.to(device) for context in contexts]
@@ -7,6 +7,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
+from ..utils.checkpoint import load_state_dict
+
 __all__ = [
     'WanVAE',
 ]
@@ -480,6 +482,31 @@ def count_conv3d(model):
     return count
 
 
+def tile_starts(size, tile, stride):
+    if size <= tile:
+        return [0]
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def blend_mask(size, overlap, edges, device):
+    """
+    Tile weights that ramp up linearly over `overlap` along the edges shared
+    with a neighbouring tile. `edges` holds (low, high) flags per dimension.
+    """
+    masks = []
+    for length, ov, (low, high) in zip(size, overlap, edges):
+        mask = torch.ones(length, device=device)
+        ov = min(ov, length)
+        if ov > 0:
+            ramp = torch.arange(1, ov + 1, device=device) / (ov + 1)
+            if low:
+                mask[:ov] = ramp
+            if high:
+                mask[-ov:] = torch.minimum(mask[-ov:], ramp.flip(0))
+        masks.append(mask)
+    return masks[0][:, None] * masks[1][None, :]
+
+
 class WanVAE_(nn.Module):
 
     def __init__(self,
@@ -507,66 +534,129 @@ class WanVAE_(nn.Module):
         self.decoder = Decoder3d(dim, z_dim, dim_mult, num_res_blocks,
                                  attn_scales, self.temperal_upsample, dropout)
 
+        # the module structure is fixed, so the causal convs are counted once
+        self._enc_conv_num = count_conv3d(self.encoder)
+        self._conv_num = count_conv3d(self.decoder)
+        self.temporal_scale = 2**sum(self.temperal_upsample)
+        self.spatial_scale = 2**(len(dim_mult) - 1)
+
     def forward(self, x):
         mu, log_var = self.encode(x)
         z = self.reparameterize(mu, log_var)
         x_recon = self.decode(z)
         return x_recon, mu, log_var
 
-    def encode(self, x, scale):
-        self.clear_cache()
+    def encode(self, x, scale, tiling=None):
+        """
+        `tiling` is an optional (tile_size, tile_overlap) pair of (h, w) pixel
+        sizes, both multiples of the spatial scale, to encode overlapping
+        spatial tiles one at a time.
+        """
+        if tiling is None:
+            out = self._encode(x)
+        else:
+            out = self._run_tiled(self._encode, x, *tiling,
+                                  1 / self.spatial_scale)
+        mu, log_var = self.conv1(out).chunk(2, dim=1)
+        if isinstance(scale[0], torch.Tensor):
+            mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
+                1, self.z_dim, 1, 1, 1)
+        else:
+            mu = (mu - scale[0]) * scale[1]
+        return mu
+
+    def _encode(self, x):
+        # the causal conv caches are local so concurrent encode / decode calls
+        # (e.g. a background decode while the next clip is conditioned) don't race
+        enc_feat_map = [None] * self._enc_conv_num
         ## cache
         t = x.shape[2]
         iter_ = 1 + (t - 1) // 4
         ## 对encode输入的x，按时间拆分为1、4、4、4....
+        out = None
         for i in range(iter_):
-            self._enc_conv_idx = [0]
+            enc_conv_idx = [0]
             if i == 0:
-                out = self.encoder(
+                out_ = self.encoder(
                     x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
+                    feat_cache=enc_feat_map,
+                    feat_idx=enc_conv_idx)
+                # every chunk yields one latent frame
+                out = out_.new_empty(*out_.shape[:2], iter_, *out_.shape[3:])
             else:
                 out_ = self.encoder(
                     x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
-        mu, log_var = self.conv1(out).chunk(2, dim=1)
-        if isinstance(scale[0], torch.Tensor):
-            mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
-                1, self.z_dim, 1, 1, 1)
-        else:
-            mu = (mu - scale[0]) * scale[1]
-        self.clear_cache()
-        return mu
+                    feat_cache=enc_feat_map,
+                    feat_idx=enc_conv_idx)
+            out[:, :, i:i + 1] = out_
+        return out
 
-    def decode(self, z, scale):
-        self.clear_cache()
+    def decode(self, z, scale, tiling=None):
+        """
+        `tiling` is an optional (tile_size, tile_overlap) pair of (h, w) latent
+        sizes to decode overlapping spatial tiles one at a time.
+        """
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
         x = self.conv2(z)
+        if tiling is None:
+            return self._decode(x)
+        return self._run_tiled(self._decode, x, *tiling, self.spatial_scale)
+
+    def _decode(self, x):
+        feat_map = [None] * self._conv_num
+        iter_ = x.shape[2]
+        out = None
         for i in range(iter_):
-            self._conv_idx = [0]
+            conv_idx = [0]
+            out_ = self.decoder(
+                x[:, :, i:i + 1, :, :],
+                feat_cache=feat_map,
+                feat_idx=conv_idx)
             if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
-        self.clear_cache()
+                # the first latent frame decodes to one frame, the others to
+                # temporal_scale frames each
+                out = out_.new_empty(
+                    *out_.shape[:2], 1 + (iter_ - 1) * self.temporal_scale,
+                    *out_.shape[3:])
+                t = 0
+            out[:, :, t:t + out_.shape[2]] = out_
+            t += out_.shape[2]
         return out
 
+    def _run_tiled(self, fn, x, tile_size, tile_overlap, scale_factor):
+        """
+        Apply `fn` to overlapping spatial tiles of x [b,c,t,h,w] and blend the
+        results into one preallocated output. `scale_factor` is the spatial
+        size of the output relative to the input.
+        """
+        h, w = x.shape[-2:]
+        out_h, out_w = int(h * scale_factor), int(w * scale_factor)
+        out_overlap = [int(o * scale_factor) for o in tile_overlap]
+        out = weight = None
+        for y0 in tile_starts(h, tile_size[0], tile_size[0] - tile_overlap[0]):
+            for x0 in tile_starts(w, tile_size[1],
+                                  tile_size[1] - tile_overlap[1]):
+                y1, x1 = min(y0 + tile_size[0], h), min(x0 + tile_size[1], w)
+                tile = fn(x[..., y0:y1, x0:x1])
+                if out is None:
+                    out = tile.new_zeros(
+                        *tile.shape[:3], out_h, out_w, dtype=torch.float32)
+                    weight = out.new_zeros(out_h, out_w)
+                th, tw = tile.shape[-2:]
+                oy, ox = int(y0 * scale_factor), int(x0 * scale_factor)
+                mask = blend_mask((th, tw), out_overlap,
+                                  ((y0 > 0, y1 < h), (x0 > 0, x1 < w)),
+                                  tile.device)
+                out[..., oy:oy + th, ox:ox + tw] += tile * mask
+                weight[oy:oy + th, ox:ox + tw] += mask
+                del tile
+        return out.div_(weight).to(x.dtype)
+
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
         eps = torch.randn_like(std)
@@ -579,15 +669,6 @@ class WanVAE_(nn.Module):
         std = torch.exp(0.5 * log_var.clamp(-30.0, 20.0))
         return mu + std * torch.randn_like(std)
 
-    def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
-        self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
-        #cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
-        self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
-
 
 def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
     """
@@ -611,7 +692,7 @@ def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
     # load checkpoint
     logging.info(f'loading {pretrained_path}')
     model.load_state_dict(
-        torch.load(pretrained_path, map_location=device), assign=True)
+        load_state_dict(pretrained_path, map_location=device), assign=True)
 
     return model
 
@@ -643,6 +724,17 @@ class WanVAE:
             pretrained_path=vae_pth,
             z_dim=z_dim,
         ).eval().requires_grad_(False).to(device)
+        self.tiling = None
+
+    def enable_tiling(self, tile_size=(256, 256), tile_overlap=(64, 64)):
+        """
+        Encode and decode in overlapping spatial tiles of `tile_size` pixels,
+        blended over `tile_overlap` pixels. Both must be multiples of 8.
+        """
+        self.tiling = (tuple(tile_size), tuple(tile_overlap))
+
+    def disable_tiling(self):
+        self.tiling = None
 
     def encode(self, videos):
         """
@@ -650,14 +742,19 @@ class WanVAE:
         """
         with amp.autocast(dtype=self.dtype):
             return [
-                self.model.encode(u.unsqueeze(0), self.scale).float().squeeze(0)
+                self.model.encode(u.unsqueeze(0), self.scale,
+                                  self.tiling).float().squeeze(0)
                 for u in videos
             ]
 
     def decode(self, zs):
+        tiling = None
+        if self.tiling is not None:
+            s = self.model.spatial_scale
+            tiling = tuple(tuple(v // s for v in size) for size in self.tiling)
         with amp.autocast(dtype=self.dtype):
             return [
-                self.model.decode(u.unsqueeze(0),
-                                  self.scale).float().clamp_(-1, 1).squeeze(0)
+                self.model.decode(u.unsqueeze(0), self.scale,
+                                  tiling).float().clamp_(-1, 1).squeeze(0)
                 for u in zs
             ]
@@ -1,4 +1,5 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import copy
 import gc
 import logging
 import math
@@ -7,7 +8,9 @@ import os
 import random
 import sys
 import types
-from contextlib import contextmanager
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from PIL import Image
 
@@ -23,15 +26,21 @@ from tqdm import tqdm
 from .distributed.fsdp import shard_model
 from .modules.clip import CLIPModel
 from .modules.multitalk_model import WanModel, WanLayerNorm, WanRMSNorm
-from .modules.t5 import T5EncoderModel, T5LayerNorm, T5RelativeEmbedding
+from .modules.t5 import T5EmbeddingCache, T5EncoderModel, T5LayerNorm, T5RelativeEmbedding
 from .modules.vae import WanVAE, CausalConv3d, RMS_norm, Upsample
+from .utils.checkpoint import load_pretrained_model
+from .utils.clip_checkpoint import ClipCheckpoint
+from .utils.fm_solvers import (
+    FlowDPMSolverMultistepScheduler,
+    get_sampling_sigmas,
+    retrieve_timesteps,
+)
+from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
 from .utils.multitalk_utils import MomentumBuffer, adaptive_projected_guidance
-from src.vram_management import AutoWrappedLinear, AutoWrappedModule, enable_vram_management
-
-
-def torch_gc():
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
+from .utils.teacache import TeaCache
+from .utils.tracing import Tracer
+from src.audio_analysis.embedding_cache import AudioEmbeddingCache
+from src.vram_management import AutoWrappedLinear, AutoWrappedModule, enable_block_streaming, enable_vram_management
 
 
 def resize_and_centercrop(cond_image, target_size):
@@ -102,7 +111,8 @@ class MultiTalkPipeline:
         t5_cpu=False,
         init_on_cpu=True,
         num_timesteps=1000,
-        use_timestep_transform=True
+        use_timestep_transform=True,
+        prompt_cache_dir=None,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -126,9 +136,12 @@ class MultiTalkPipeline:
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
+            prompt_cache_dir (`str`, *optional*, defaults to None):
+                Directory to persist T5 prompt embeddings in. If None, they are only cached in memory.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
+        self.checkpoint_dir = checkpoint_dir
         self.rank = rank
         self.use_usp = use_usp
         self.t5_cpu = t5_cpu
@@ -160,7 +173,7 @@ class MultiTalkPipeline:
             tokenizer_path=os.path.join(checkpoint_dir, config.clip_tokenizer))
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
-        self.model = WanModel.from_pretrained(checkpoint_dir)
+        self.model = load_pretrained_model(WanModel, checkpoint_dir)
         self.model.eval().requires_grad_(False)
 
 
@@ -195,6 +208,13 @@ class MultiTalkPipeline:
                 self.model.to(self.device)
         
         self.sample_neg_prompt = config.sample_neg_prompt
+        self.last_teacache_stats = None
+        self.last_trace = None
+        self.last_batch_stats = []
+        self.prompt_cache = T5EmbeddingCache(
+            self.text_encoder, cache_dir=prompt_cache_dir)
+        # the default negative prompt is encoded once here instead of on every call
+        self.encode_prompts([self.sample_neg_prompt])
         self.num_timesteps = num_timesteps
         self.use_timestep_transform = use_timestep_transform
 
@@ -202,6 +222,13 @@ class MultiTalkPipeline:
         self.model_names = ["model"]
         self.vram_management = False
 
+    def encode_prompts(self, texts, offload_model=True):
+        return self.prompt_cache(
+            texts,
+            self.device,
+            encode_device=torch.device('cpu') if self.t5_cpu else self.device,
+            offload_model=offload_model)
+
     def add_noise(
         self,
         original_samples: torch.FloatTensor,
@@ -216,7 +243,77 @@ class MultiTalkPipeline:
 
         return (1 - timesteps) * original_samples + timesteps * noise
 
-    def enable_vram_management(self, num_persistent_param_in_dit=None):
+    def get_sample_scheduler(self, sample_solver, sampling_steps, shift):
+        """
+        Build a multistep flow scheduler and its timesteps, as `[1]` tensors followed by a final 0.
+
+        The euler solver has no scheduler object, None is returned and `step_latent`
+        applies the update itself.
+        """
+        if sample_solver == 'euler':
+            timesteps = list(np.linspace(self.num_timesteps, 1, sampling_steps, dtype=np.float32))
+            timesteps.append(0.)
+            timesteps = [torch.tensor([t], device=self.device) for t in timesteps]
+            if self.use_timestep_transform:
+                timesteps = [timestep_transform(t, shift=shift, num_timesteps=self.num_timesteps) for t in timesteps]
+            return None, timesteps
+        if sample_solver == 'unipc':
+            sample_scheduler = FlowUniPCMultistepScheduler(
+                num_train_timesteps=self.num_timesteps,
+                shift=1,
+                use_dynamic_shifting=False)
+            sample_scheduler.set_timesteps(
+                sampling_steps, device=self.device, shift=shift)
+            timesteps = sample_scheduler.timesteps
+        elif sample_solver == 'dpm++':
+            sample_scheduler = FlowDPMSolverMultistepScheduler(
+                num_train_timesteps=self.num_timesteps,
+                shift=1,
+                use_dynamic_shifting=False)
+            sampling_sigmas = get_sampling_sigmas(sampling_steps, shift)
+            timesteps, _ = retrieve_timesteps(
+                sample_scheduler,
+                device=self.device,
+                sigmas=sampling_sigmas)
+        else:
+            raise NotImplementedError("Unsupported solver.")
+        timesteps = [t.view(1).float() for t in timesteps]
+        timesteps.append(torch.zeros(1, device=self.device))
+        return sample_scheduler, timesteps
+
+    def step_latent(self, sample_scheduler, timesteps, i, latent, noise_pred):
+        """
+        Move `latent` from `timesteps[i]` to `timesteps[i + 1]` along the guided `noise_pred`.
+        """
+        if sample_scheduler is None:
+            noise_pred = -noise_pred
+            dt = timesteps[i] - timesteps[i + 1]
+            dt = dt / self.num_timesteps
+            return latent + noise_pred * dt[:, None, None, None]
+        return sample_scheduler.step(
+            noise_pred.unsqueeze(0),
+            timesteps[i],
+            latent.unsqueeze(0),
+            return_dict=False)[0].squeeze(0)
+
+    def enable_vram_management(self, num_persistent_param_in_dit=None, streaming=False):
+        """
+        Keep at most `num_persistent_param_in_dit` DiT parameters on the GPU.
+
+        With `streaming`, whole attention blocks past the budget are streamed from
+        pinned host memory with prefetching instead of casting every overflow
+        layer on each forward.
+        """
+        if streaming:
+            enable_block_streaming(
+                self.model,
+                self.model.blocks,
+                self.device,
+                self.param_dtype,
+                max_num_param=num_persistent_param_in_dit,
+            )
+            self.enable_cpu_offload()
+            return
         dtype = next(iter(self.model.parameters())).dtype
         enable_vram_management(
             self.model,
@@ -290,6 +387,42 @@ class MultiTalkPipeline:
         # fresh the cuda cache
         torch.cuda.empty_cache()
 
+    @staticmethod
+    def count_clips(audio_len, frame_num=81, motion_frame=25, max_frames_num=1000):
+        """
+        Number of clips `generate` produces for an audio embedding of `audio_len` frames.
+        """
+        if max_frames_num <= frame_num:
+            return 1
+        num_clips, audio_start_idx = 1, 0
+        while True:
+            num_clips += 1
+            audio_start_idx += frame_num - motion_frame
+            if audio_start_idx + frame_num >= min(max_frames_num, audio_len):
+                return num_clips
+
+    def decode_to_cpu(self, x0, start=0, stream=None):
+        """
+        Decode latents and return the frames from `start` on as a CPU tensor (B C T H W).
+
+        Runs on `stream` when given, so it can overlap with sampling of the next clip.
+        """
+        with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else nullcontext():
+            videos = torch.stack(self.vae.decode(x0))[:, :, start:].cpu()
+        return videos
+
+    def decode_motion_frames(self, x0, num_frames, warmup_latents=2):
+        """
+        Approximately decode only the last `num_frames` frames of `x0`.
+
+        The causal VAE decoder is warmed up on `warmup_latents` preceding latents
+        instead of the whole clip, so the result differs slightly from a full decode.
+        """
+        num_latents = (num_frames + 3) // 4 + warmup_latents
+        with torch.no_grad():
+            videos = self.vae.decode([u[:, -num_latents:] for u in x0])
+        return torch.stack(videos)[:, :, -num_frames:]
+
     def generate(self,
                  input_data,
                  size_buckget='multitalk-480',
@@ -297,6 +430,7 @@ class MultiTalkPipeline:
                  frame_num=81,
                  shift=5.0,
                  sampling_steps=40,
+                 sample_solver='euler',
                  text_guide_scale=5.0,
                  audio_guide_scale=4.0,
                  n_prompt="",
@@ -305,7 +439,9 @@ class MultiTalkPipeline:
                  max_frames_num=1000,
                  face_scale=0.05,
                  progress=True,
-                 extra_args=None):
+                 extra_args=None,
+                 progress_callback=None,
+                 video_writer=None):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -317,23 +453,224 @@ class MultiTalkPipeline:
                 [NOTE]: If you want to generate a 480p video, it is recommended to set the shift value to 3.0.
             sampling_steps (`int`, *optional*, defaults to 40):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_solver (`str`, *optional*, defaults to 'euler'):
+                Solver used to sample each clip: 'euler', or the multistep 'unipc' / 'dpm++'
+                schedulers, which reach the same quality in fewer steps
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            progress_callback (`callable`, *optional*, defaults to None):
+                Called after every sampling step with keyword arguments `clip`, `total_clips`,
+                `step` and `total_steps`, e.g. to report job progress
+            video_writer (`StreamingVideoWriter`, *optional*, defaults to None):
+                If given, each decoded clip is written to it as soon as it is available and
+                `generate` returns None instead of the whole video tensor
+
+        Returns:
+            torch.Tensor: Generated video frames (C T H W) on rank 0 when no `video_writer` is given, else None.
+        """
+        return self.run_jobs([self.generate_job(
+            input_data,
+            size_buckget=size_buckget,
+            motion_frame=motion_frame,
+            frame_num=frame_num,
+            shift=shift,
+            sampling_steps=sampling_steps,
+            sample_solver=sample_solver,
+            text_guide_scale=text_guide_scale,
+            audio_guide_scale=audio_guide_scale,
+            n_prompt=n_prompt,
+            seed=seed,
+            offload_model=offload_model,
+            max_frames_num=max_frames_num,
+            face_scale=face_scale,
+            progress=progress,
+            extra_args=extra_args,
+            progress_callback=progress_callback,
+            video_writer=video_writer)])[0]
+
+    def generate_batch(self, jobs, return_exceptions=False):
         """
+        Generate several videos with their DiT forwards batched together.
+
+        `jobs` is a list of dicts of `generate` keyword arguments, one per video.
+        Whenever the jobs sample clips of the same latent shape (same size bucket,
+        aspect ratio and `frame_num`), their guidance branches run as one batch, so
+        jobs that also agree on `sampling_steps` and `sample_solver` stay in lockstep
+        for the whole render. Prompts, audio, masks, guidance scales and seeds stay
+        per job. TeaCache is disabled and the DiT is kept on the GPU for batches of
+        more than one job.
+
+        Returns the result of `generate` for every job. With `return_exceptions`, the
+        exception of a failed job takes the place of its result and the other jobs
+        carry on. The TeaCache stats and trace of every job are in `last_batch_stats`.
+        """
+        jobs = [dict(job) for job in jobs]
+        if len(jobs) > 1:
+            for job in jobs:
+                extra_args = job.get('extra_args')
+                if extra_args is not None and extra_args.use_teacache:
+                    # the skip decisions of a job need all of its forwards
+                    job['extra_args'] = extra_args = copy.copy(extra_args)
+                    extra_args.use_teacache = False
+                # the jobs interleave, so the DiT can't be offloaded after a clip
+                job['offload_model'] = False
+        generators = [self.generate_job(**job) for job in jobs]
+        if self.use_usp and len(jobs) > 1:
+            logging.warning("Batching jobs is not supported together with USP, generating them one by one.")
+            results, stats = [], []
+            for generator in generators:
+                results += self.run_jobs([generator], return_exceptions)
+                stats += self.last_batch_stats
+            self.last_batch_stats = stats
+            return results
+        return self.run_jobs(generators, return_exceptions)
+
+    def run_jobs(self, jobs, return_exceptions=False):
+        """
+        Drive `generate_job` generators to completion and return their results.
 
-        # init teacache
+        Every job yields the DiT samples it needs next. The pending samples of all
+        jobs whose latents have the same shape are evaluated with one forward and
+        the noise predictions are sent back to their jobs.
+        """
+        results = [None] * len(jobs)
+        stats = [None] * len(jobs)
+        pending = {}
+
+        def advance(i, noise_preds=None, error=None):
+            try:
+                pending[i] = jobs[i].throw(error) if error is not None else jobs[i].send(noise_preds)
+            except StopIteration as e:
+                results[i] = e.value
+                stats[i] = {'teacache_stats': self.last_teacache_stats, 'trace': self.last_trace}
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                logging.exception(f"Job {i} of the batch failed.")
+                results[i] = e
+            else:
+                return
+            pending.pop(i, None)
+
+        try:
+            with torch.no_grad():
+                for i in range(len(jobs)):
+                    advance(i)
+                while pending:
+                    groups = defaultdict(list)
+                    for i, samples in pending.items():
+                        groups[(samples[0]['seq_len'], tuple(samples[0]['x'].shape))].append(i)
+                    for group in groups.values():
+                        samples = [sample for i in group for sample in pending[i]]
+                        try:
+                            noise_preds = self.forward_samples(samples)
+                        except Exception as e:
+                            for i in group:
+                                advance(i, error=e)
+                            continue
+                        for i in group:
+                            num_samples = len(pending[i])
+                            advance(i, noise_preds[:num_samples])
+                            noise_preds = noise_preds[num_samples:]
+        finally:
+            for job in jobs:
+                job.close()
+        self.last_batch_stats = stats
+        return results
+
+    def forward_samples(self, samples):
+        """
+        Evaluate the DiT on `samples` as one batch and return their noise predictions.
+
+        Every sample is a dict of `WanModel.forward` arguments for a single latent:
+        `x` [C, T, H, W], `t` [1], `context` [L, C], `clip_fea` [1, 257, 1280],
+        `y` [1, 4 + C, T, H, W], `audio` [human_num, F, W, S, C], `ref_target_masks`,
+        `seq_len`, `teacache` and `teacache_branch`. The samples must share `seq_len`.
+        TeaCache is only used when all samples belong to the same job.
+        """
+        def shared(key):
+            first = samples[0][key]
+            return first if all(sample[key] is first for sample in samples) else None
+
+        if len(samples) == 1:
+            sample = samples[0]
+            return [self.model(
+                [sample['x']], t=sample['t'], context=[sample['context']], seq_len=sample['seq_len'],
+                clip_fea=sample['clip_fea'], y=sample['y'], audio=sample['audio'],
+                ref_target_masks=sample['ref_target_masks'], teacache=sample['teacache'],
+                teacache_branch=sample['teacache_branch'])[0]]
+
+        timesteps = [sample['t'] for sample in samples]
+        ref_target_masks = shared('ref_target_masks')
+        noise_preds = self.model(
+            [sample['x'] for sample in samples],
+            t=timesteps[0] if all(t is timesteps[0] or torch.equal(t, timesteps[0]) for t in timesteps) else torch.cat(timesteps),
+            context=[sample['context'] for sample in samples],
+            seq_len=samples[0]['seq_len'],
+            clip_fea=torch.cat([sample['clip_fea'] for sample in samples]),
+            y=torch.cat([sample['y'] for sample in samples]),
+            audio=[sample['audio'] for sample in samples],
+            ref_target_masks=ref_target_masks if ref_target_masks is not None else [
+                sample['ref_target_masks'] for sample in samples],
+            teacache=shared('teacache'),
+            teacache_branch=[sample['teacache_branch'] for sample in samples])
+        return list(noise_preds)
+
+    def generate_job(self,
+                     input_data,
+                     size_buckget='multitalk-480',
+                     motion_frame=25,
+                     frame_num=81,
+                     shift=5.0,
+                     sampling_steps=40,
+                     sample_solver='euler',
+                     text_guide_scale=5.0,
+                     audio_guide_scale=4.0,
+                     n_prompt="",
+                     seed=-1,
+                     offload_model=True,
+                     max_frames_num=1000,
+                     face_scale=0.05,
+                     progress=True,
+                     extra_args=None,
+                     progress_callback=None,
+                     video_writer=None):
+        """
+        The body of `generate` as a generator, driven by `run_jobs`.
+
+        Instead of calling the DiT, it yields the list of samples it needs evaluated
+        next (see `forward_samples`) and is sent back their noise predictions, so the
+        forwards of several jobs can be batched. Returns what `generate` returns.
+        """
+
+        # batched CFG runs cond / drop-text / uncond as one forward; the USP
+        # forward still relies on one call per guidance branch
+        batched_cfg = extra_args.batched_cfg
+        if batched_cfg and self.use_usp:
+            logging.warning("batched_cfg is not supported together with USP, falling back to sequential CFG.")
+            batched_cfg = False
+        incremental_cond = getattr(extra_args, 'incremental_cond', False)
+        overlap_decode = getattr(extra_args, 'overlap_decode', False) and max_frames_num > frame_num
+
+        # init teacache, the state belongs to this call only
+        teacache = None
         if extra_args.use_teacache:
-            self.model.teacache_init(
+            teacache = TeaCache(
                 sample_steps=sampling_steps,
                 teacache_thresh=extra_args.teacache_thresh,
                 model_scale=extra_args.size,
             )
-        else:
-            self.model.disable_teacache()
+
+        # stage spans and the CUDA memory release policy of this call
+        trace_file = getattr(extra_args, 'trace_file', None)
+        tracer = Tracer(
+            enabled=getattr(extra_args, 'trace', False) or trace_file is not None,
+            device=self.device,
+            memory_release=getattr(extra_args, 'memory_release', 'stage'))
 
         input_prompt = input_data['prompt']
         cond_file_path = input_data['cond_image']
@@ -374,7 +711,7 @@ class MultiTalkPipeline:
             audio_embedding_path = audio_embedding_paths[human_idx]
             if not os.path.exists(audio_embedding_path):
                 continue
-            full_audio_emb = torch.load(audio_embedding_path)
+            full_audio_emb = AudioEmbeddingCache.load(audio_embedding_path)
             if torch.isnan(full_audio_emb).any():
                 continue
             if full_audio_emb.shape[0] <= frame_num:
@@ -386,28 +723,50 @@ class MultiTalkPipeline:
         # preprocess text embedding
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context, context_null = self.text_encoder([input_prompt, n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        with tracer.span('text_encode', release=True):
+            context, context_null = self.encode_prompts(
+                [input_prompt, n_prompt], offload_model=offload_model)
 
-        torch_gc()
         # prepare params for video generation
         indices = (torch.arange(2 * 2 + 1) - 2) * 1 
         clip_length = frame_num
+        clip_idx = 0
+        total_clips = self.count_clips(len(full_audio_embs[0]), frame_num, motion_frame, max_frames_num)
         is_first_clip = True
         arrive_last_frame = False
         cur_motion_frames_num = 1
         audio_start_idx = 0
         audio_end_idx = audio_start_idx + clip_length
         gen_video_list = []
-        torch_gc()
+        # incremental conditioning state, reused across streaming clips
+        cached_clip_context = None
+        cached_padding_latent = None
+        if overlap_decode:
+            # full clip decodes run in the background while the next clip samples
+            decode_executor = ThreadPoolExecutor(max_workers=1)
+            decode_stream = torch.cuda.Stream(device=self.device)
+        tracer.release()
+
+        # per-clip checkpoints of multi-clip renders, keyed by the job so a rerun resumes it
+        clip_checkpoint = None
+        clip_checkpoint_dir = getattr(extra_args, 'clip_checkpoint_dir', None)
+        if clip_checkpoint_dir is not None and max_frames_num > frame_num:
+            clip_checkpoint = ClipCheckpoint(clip_checkpoint_dir, ClipCheckpoint.fingerprint(
+                input_data, size_buckget=size_buckget, motion_frame=motion_frame, frame_num=frame_num,
+                shift=shift, sampling_steps=sampling_steps, sample_solver=sample_solver,
+                text_guide_scale=text_guide_scale, audio_guide_scale=audio_guide_scale,
+                n_prompt=n_prompt, seed=seed, max_frames_num=max_frames_num, face_scale=face_scale,
+                use_apg=extra_args.use_apg, apg_momentum=extra_args.apg_momentum,
+                apg_norm_threshold=extra_args.apg_norm_threshold, use_teacache=extra_args.use_teacache,
+                teacache_thresh=extra_args.teacache_thresh, incremental_cond=incremental_cond,
+                overlap_decode=overlap_decode, checkpoint_dir=os.path.abspath(self.checkpoint_dir)))
+
+        def decode_clip(x0, start, stream, clip_idx):
+            # runs on the decode thread when overlapping, the clip is saved as soon as it is decoded
+            videos = self.decode_to_cpu(x0, start, stream)
+            if clip_checkpoint is not None and self.rank == 0:
+                clip_checkpoint.save_clip(clip_idx, videos)
+            return videos
 
         # set random seed and init noise
         seed = seed if seed >= 0 else random.randint(0, 99999999)
@@ -416,6 +775,31 @@ class MultiTalkPipeline:
         np.random.seed(seed)
         random.seed(seed)
         torch.backends.cudnn.deterministic = True
+        # the noise has its own generator, so jobs sampled together keep their seeds
+        generator = torch.Generator(device=self.device).manual_seed(seed)
+
+        resumed = clip_checkpoint.load(self.device, generator) if clip_checkpoint is not None else None
+        if resumed is not None:
+            state, gen_video_list = resumed
+            clip_idx = state['clip_idx']
+            is_first_clip = False
+            cur_motion_frames_num = state['cur_motion_frames_num']
+            audio_start_idx = state['audio_start_idx']
+            audio_end_idx = state['audio_end_idx']
+            arrive_last_frame = state['arrive_last_frame']
+            if arrive_last_frame:
+                # redo the audio padding of the last clip
+                miss_lengths = state['miss_lengths']
+                for human_inx, miss_length in enumerate(miss_lengths):
+                    if miss_length > 0:
+                        add_audio_emb = torch.flip(full_audio_embs[human_inx][-1*miss_length:], dims=[0])
+                        full_audio_embs[human_inx] = torch.cat([full_audio_embs[human_inx], add_audio_emb], dim=0)
+            cond_image = state['cond_image'].to(self.device)
+            if state['cached_clip_context'] is not None:
+                cached_clip_context = state['cached_clip_context'].to(self.device)
+            if state['cached_padding_latent'] is not None:
+                cached_padding_latent = state['cached_padding_latent'].to(self.device)
+            logging.info(f"Resuming from clip {clip_idx + 1} of {total_clips} in {clip_checkpoint.dir}")
 
         # start video generation iteratively
         while True:
@@ -433,7 +817,7 @@ class MultiTalkPipeline:
                 audio_emb = full_audio_embs[human_idx][center_indices][None,...].to(self.device)
                 audio_embs.append(audio_emb)
             audio_embs = torch.concat(audio_embs, dim=0).to(self.param_dtype)
-            torch_gc()
+            tracer.release()
 
             h, w = cond_image.shape[-2], cond_image.shape[-1]
             lat_h, lat_w = h // self.vae_stride[1], w // self.vae_stride[2]
@@ -448,7 +832,8 @@ class MultiTalkPipeline:
                 lat_h,
                 lat_w,
                 dtype=torch.float32,
-                device=self.device) 
+                device=self.device,
+                generator=generator) 
 
             # get mask
             msk = torch.ones(1, frame_num, lat_h, lat_w, device=self.device)
@@ -462,21 +847,39 @@ class MultiTalkPipeline:
 
             with torch.no_grad():
                 # get clip embedding
-                self.clip.model.to(self.device)
-                clip_context = self.clip.visual(cond_image[:, :, -1:, :, :]).to(self.param_dtype) 
-                if offload_model:
-                    self.clip.model.cpu()
-                torch_gc()
-
-                # zero padding and vae encode
-                video_frames = torch.zeros(1, cond_image.shape[1], frame_num-cond_image.shape[2], target_h, target_w).to(self.device)
-                padding_frames_pixels_values = torch.concat([cond_image, video_frames], dim=2)
-                y = self.vae.encode(padding_frames_pixels_values) 
-                y = torch.stack(y).to(self.param_dtype) # B C T H W
-                cur_motion_frames_latent_num = int(1 + (cur_motion_frames_num-1) // 4)
-                latent_motion_frames = y[:, :, :cur_motion_frames_latent_num][0] # C T H W
-                y = torch.concat([msk, y], dim=1) # B 4+C T H W
-                torch_gc()
+                with tracer.span('clip_encode', release=cached_clip_context is None, clip=clip_idx):
+                    if cached_clip_context is not None:
+                        # the CLIP features of the first clip's reference image, whereas the
+                        # exact path re-encodes the last motion frame of every clip
+                        clip_context = cached_clip_context
+                    else:
+                        self.clip.model.to(self.device)
+                        clip_context = self.clip.visual(cond_image[:, :, -1:, :, :]).to(self.param_dtype) 
+                        if offload_model:
+                            self.clip.model.cpu()
+                        if incremental_cond:
+                            cached_clip_context = clip_context
+
+                with tracer.span('vae_encode', release=True, clip=clip_idx):
+                    cur_motion_frames_latent_num = int(1 + (cur_motion_frames_num-1) // 4)
+                    if cached_padding_latent is not None:
+                        # only encode the motion frames and reuse the zero padding latent, an
+                        # approximation: the causal cache it was encoded with came from the
+                        # second clip's motion frames, not this clip's
+                        y = self.vae.encode(cond_image)
+                        y = torch.stack(y).to(self.param_dtype)
+                        y = torch.concat([y, cached_padding_latent], dim=2) # B C T H W
+                    else:
+                        # zero padding and vae encode
+                        video_frames = torch.zeros(1, cond_image.shape[1], frame_num-cond_image.shape[2], target_h, target_w).to(self.device)
+                        padding_frames_pixels_values = torch.concat([cond_image, video_frames], dim=2)
+                        y = self.vae.encode(padding_frames_pixels_values) 
+                        y = torch.stack(y).to(self.param_dtype) # B C T H W
+                        # the motion frame count is fixed from the second clip on
+                        if incremental_cond and not is_first_clip:
+                            cached_padding_latent = y[:, :, cur_motion_frames_latent_num:]
+                    latent_motion_frames = y[:, :, :cur_motion_frames_latent_num][0] # C T H W
+                    y = torch.concat([msk, y], dim=1) # B 4+C T H W
             
 
             # construct human mask
@@ -522,7 +925,7 @@ class MultiTalkPipeline:
             ref_target_masks = (ref_target_masks > 0) 
             ref_target_masks = ref_target_masks.float().to(self.device)
 
-            torch_gc()
+            tracer.release()
 
             @contextmanager
             def noop_no_sync():
@@ -533,47 +936,49 @@ class MultiTalkPipeline:
             # evaluation mode
             with torch.no_grad(), no_sync():
                 
-                # prepare timesteps
-                timesteps = list(np.linspace(self.num_timesteps, 1, sampling_steps, dtype=np.float32))
-                timesteps.append(0.)
-                timesteps = [torch.tensor([t], device=self.device) for t in timesteps]
-                if self.use_timestep_transform:
-                    timesteps = [timestep_transform(t, shift=shift, num_timesteps=self.num_timesteps) for t in timesteps]
+                # prepare timesteps, a fresh scheduler per clip, the multistep history doesn't carry over
+                sample_scheduler, timesteps = self.get_sample_scheduler(sample_solver, sampling_steps, shift)
                 
                 # sample videos
                 latent = noise
 
                 # prepare condition and uncondition configs
                 arg_c = {
-                    'context': [context],
+                    'context': context,
                     'clip_fea': clip_context,
                     'seq_len': max_seq_len,
                     'y': y,
                     'audio': audio_embs,
-                    'ref_target_masks': ref_target_masks
+                    'ref_target_masks': ref_target_masks,
+                    'teacache': teacache,
+                    'teacache_branch': 'cond',
                 }
 
 
                 arg_null_text = {
-                    'context': [context_null],
+                    'context': context_null,
                     'clip_fea': clip_context,
                     'seq_len': max_seq_len,
                     'y': y,
                     'audio': audio_embs,
-                    'ref_target_masks': ref_target_masks
+                    'ref_target_masks': ref_target_masks,
+                    'teacache': teacache,
+                    'teacache_branch': 'drop_text',
                 }
 
 
                 arg_null = {
-                    'context': [context_null],
+                    'context': context_null,
                     'clip_fea': clip_context,
                     'seq_len': max_seq_len,
                     'y': y,
                     'audio': torch.zeros_like(audio_embs)[-1:],
-                    'ref_target_masks': ref_target_masks
+                    'ref_target_masks': ref_target_masks,
+                    'teacache': teacache,
+                    'teacache_branch': 'uncond',
                 }
 
-                torch_gc()
+                tracer.release()
                 if not self.vram_management:
                     self.model.to(self.device)
                 else:
@@ -582,7 +987,9 @@ class MultiTalkPipeline:
                 # injecting motion frames
                 if not is_first_clip:
                     latent_motion_frames = latent_motion_frames.to(latent.dtype).to(self.device)
-                    motion_add_noise = torch.randn_like(latent_motion_frames).contiguous()
+                    motion_add_noise = torch.randn(
+                        latent_motion_frames.shape, dtype=latent_motion_frames.dtype,
+                        device=self.device, generator=generator)
                     add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[0])
                     _, T_m, _, _ = add_latent.shape
                     latent[:, :T_m] = add_latent
@@ -595,20 +1002,26 @@ class MultiTalkPipeline:
 
 
                 progress_wrap = partial(tqdm, total=len(timesteps)-1) if progress else (lambda x: x)
-                for i in progress_wrap(range(len(timesteps)-1)):
+                # every iteration is traced as one 'step' span
+                for i in tracer.iterate('step', progress_wrap(range(len(timesteps)-1)), clip=clip_idx):
                     timestep = timesteps[i]
-                    latent_model_input = [latent.to(self.device)]
-
-                    # inference with CFG strategy
-                    noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0] 
-                    torch_gc()
-                    noise_pred_drop_text = self.model(
-                        latent_model_input, t=timestep, **arg_null_text)[0] 
-                    torch_gc()
-                    noise_pred_uncond = self.model(
-                        latent_model_input, t=timestep, **arg_null)[0]  
-                    torch_gc()
+                    latent_model_input = latent.to(self.device)
+
+                    # inference with CFG strategy, the driver runs the DiT on the yielded samples
+                    if batched_cfg:
+                        # the three guidance branches as one batch of 3
+                        noise_pred_cond, noise_pred_drop_text, noise_pred_uncond = yield [
+                            dict(arg_c, x=latent_model_input, t=timestep),
+                            dict(arg_null_text, x=latent_model_input, t=timestep),
+                            dict(arg_null, x=latent_model_input, t=timestep)]
+                        tracer.release()
+                    else:
+                        noise_pred_cond, = yield [dict(arg_c, x=latent_model_input, t=timestep)]
+                        tracer.release()
+                        noise_pred_drop_text, = yield [dict(arg_null_text, x=latent_model_input, t=timestep)]
+                        tracer.release()
+                        noise_pred_uncond, = yield [dict(arg_null, x=latent_model_input, t=timestep)]
+                        tracer.release()
 
                     if extra_args.use_apg:
                         # correct update direction
@@ -627,42 +1040,59 @@ class MultiTalkPipeline:
                         noise_pred = noise_pred_uncond + text_guide_scale * (
                             noise_pred_cond - noise_pred_drop_text) + \
                             audio_guide_scale * (noise_pred_drop_text - noise_pred_uncond)  
-                    noise_pred = -noise_pred  
-
                     # update latent
-                    dt = timesteps[i] - timesteps[i + 1]
-                    dt = dt / self.num_timesteps
-                    latent = latent + noise_pred * dt[:, None, None, None]
+                    latent = self.step_latent(sample_scheduler, timesteps, i, latent, noise_pred)
 
                     # injecting motion frames
                     if not is_first_clip:
                         latent_motion_frames = latent_motion_frames.to(latent.dtype).to(self.device)
-                        motion_add_noise = torch.randn_like(latent_motion_frames).contiguous()
+                        motion_add_noise = torch.randn(
+                            latent_motion_frames.shape, dtype=latent_motion_frames.dtype,
+                            device=self.device, generator=generator)
                         add_latent = self.add_noise(latent_motion_frames, motion_add_noise, timesteps[i+1])
                         _, T_m, _, _ = add_latent.shape
                         latent[:, :T_m] = add_latent
 
                     x0 = [latent.to(self.device)] 
                     del latent_model_input, timestep
+
+                    if progress_callback is not None:
+                        progress_callback(clip=clip_idx, total_clips=total_clips,
+                                          step=i + 1, total_steps=len(timesteps) - 1)
                 
                 if offload_model: 
                     if not self.vram_management:
                         self.model.cpu()
-                torch_gc()
+                tracer.release(boundary=True)
 
-                videos = self.vae.decode(x0) 
-            
             # cache generated samples
-            videos = torch.stack(videos).cpu() # B C T H W
-            if is_first_clip:
-                gen_video_list.append(videos)
-            else:
-                gen_video_list.append(videos[:, :, cur_motion_frames_num:])
+            with tracer.span('vae_decode', release=True, clip=clip_idx):
+                start = 0 if is_first_clip else cur_motion_frames_num
+                if overlap_decode and not arrive_last_frame:
+                    # decode the frames conditioning the next clip now, the whole clip later
+                    decode_stream.wait_stream(torch.cuda.current_stream(self.device))
+                    for u in x0:
+                        u.record_stream(decode_stream)
+                    gen_video_list.append(decode_executor.submit(decode_clip, x0, start, decode_stream, clip_idx))
+                    videos = self.decode_motion_frames(x0, motion_frame)
+                else:
+                    videos = self.decode_to_cpu(x0) # B C T H W
+                    gen_video_list.append(videos[:, :, start:])
+                    if clip_checkpoint is not None and self.rank == 0:
+                        clip_checkpoint.save_clip(clip_idx, gen_video_list[-1])
+
+            if video_writer is not None and self.rank == 0:
+                with tracer.span('write', clip=clip_idx):
+                    # hand finished clips to the writer, only a pending background decode is kept
+                    while gen_video_list and (torch.is_tensor(gen_video_list[0]) or len(gen_video_list) > 1):
+                        clip_video = gen_video_list.pop(0)
+                        video_writer.write((clip_video if torch.is_tensor(clip_video) else clip_video.result())[0])
 
             # decide whether is done
             if arrive_last_frame: break
 
             # update next condition frames
+            clip_idx += 1
             is_first_clip = False
             cur_motion_frames_num = motion_frame
 
@@ -685,15 +1115,65 @@ class MultiTalkPipeline:
                         miss_lengths.append(miss_length)
                     else:
                         miss_lengths.append(0)
+
+            if clip_checkpoint is not None and self.rank == 0:
+                with tracer.span('checkpoint', clip=clip_idx):
+                    clip_checkpoint.save_state({
+                        'clip_idx': clip_idx,
+                        'cur_motion_frames_num': cur_motion_frames_num,
+                        'audio_start_idx': audio_start_idx,
+                        'audio_end_idx': audio_end_idx,
+                        'arrive_last_frame': arrive_last_frame,
+                        'miss_lengths': miss_lengths if arrive_last_frame else None,
+                        'cond_image': cond_image,
+                        'cached_clip_context': cached_clip_context,
+                        'cached_padding_latent': cached_padding_latent,
+                    }, self.device, generator,
+                        # queued behind the pending clip save, so a state never refers to a missing clip
+                        executor=decode_executor if overlap_decode else None)
             
             if max_frames_num <= frame_num: break
             
-            torch_gc()
+            tracer.release()
             if offload_model:    
                 torch.cuda.synchronize()
             if dist.is_initialized():
                 dist.barrier()
         
+        self.last_teacache_stats = None
+        if teacache is not None:
+            # skip rates for tuning teacache_thresh
+            self.last_teacache_stats = teacache.stats()
+            logging.info(f"TeaCache skipped {self.last_teacache_stats['total']['skips']} of "
+                         f"{self.last_teacache_stats['total']['calls']} branch evaluations: {self.last_teacache_stats}")
+
+        if overlap_decode:
+            gen_video_list = [v if torch.is_tensor(v) else v.result() for v in gen_video_list]
+            decode_executor.shutdown()
+
+        if clip_checkpoint is not None and self.rank == 0:
+            # every clip is done, nothing is left to resume
+            clip_checkpoint.clear()
+
+        self.last_trace = None
+        if tracer.enabled:
+            self.last_trace = tracer.summary()
+            tracer.log_summary()
+            if trace_file is not None and self.rank == 0:
+                tracer.export_chrome_trace(trace_file)
+                logging.info(f"Saved chrome trace to {trace_file}")
+
+        if video_writer is not None:
+            if self.rank == 0:
+                for clip_video in gen_video_list:
+                    video_writer.write(clip_video[0])
+                video_writer.flush(trim_end=miss_lengths[0] if max_frames_num > frame_num and sum(miss_lengths) > 0 else 0)
+            if dist.is_initialized():
+                dist.barrier()
+            del noise, latent
+            tracer.release(boundary=True)
+            return None
+
         gen_video_samples = torch.cat(gen_video_list, dim=2)[:, :, :int(max_frames_num)] 
         gen_video_samples = gen_video_samples.to(torch.float32)
         if max_frames_num > frame_num and sum(miss_lengths) > 0:
@@ -704,6 +1184,6 @@ class MultiTalkPipeline:
             dist.barrier()
 
         del noise, latent
-        torch_gc()
+        tracer.release(boundary=True)
 
         return gen_video_samples[0] if self.rank == 0 else None
\ No newline at end of file
@@ -16,7 +16,7 @@ from tqdm import tqdm
 
 from .distributed.fsdp import shard_model
 from .modules.model import WanModel
-from .modules.t5 import T5EncoderModel
+from .modules.t5 import T5EmbeddingCache, T5EncoderModel
 from .modules.vae import WanVAE
 from .utils.fm_solvers import (
     FlowDPMSolverMultistepScheduler,
@@ -38,6 +38,7 @@ class WanT2V:
         dit_fsdp=False,
         use_usp=False,
         t5_cpu=False,
+        prompt_cache_dir=None,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -59,6 +60,8 @@ class WanT2V:
                 Enable distribution strategy of USP.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            prompt_cache_dir (`str`, *optional*, defaults to None):
+                Directory to persist T5 prompt embeddings in. If None, they are only cached in memory.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
@@ -110,6 +113,17 @@ class WanT2V:
             self.model.to(self.device)
 
         self.sample_neg_prompt = config.sample_neg_prompt
+        self.prompt_cache = T5EmbeddingCache(
+            self.text_encoder, cache_dir=prompt_cache_dir)
+        # the default negative prompt is encoded once here instead of on every call
+        self.encode_prompts([self.sample_neg_prompt])
+
+    def encode_prompts(self, texts, offload_model=True):
+        return self.prompt_cache(
+            texts,
+            self.device,
+            encode_device=torch.device('cpu') if self.t5_cpu else self.device,
+            offload_model=offload_model)
 
     def generate(self,
                  input_prompt,
@@ -171,17 +185,9 @@ class WanT2V:
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
 
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        context, context_null = self.encode_prompts(
+            [input_prompt, n_prompt], offload_model=offload_model)
+        context, context_null = [context], [context_null]
 
         noise = [
             torch.randn(
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import torch
+
+try:
+    from safetensors.torch import load_file as load_safetensors
+except ImportError:
+    load_safetensors = None
+
+from src.utils import init_weights_on_device
+
+__all__ = [
+    'init_empty_weights',
+    'resolve_checkpoint',
+    'load_state_dict',
+    'load_sharded_state_dict',
+    'assign_state_dict',
+    'load_pretrained_model',
+]
+
+SAFETENSORS_WEIGHTS_NAME = 'diffusion_pytorch_model.safetensors'
+SAFETENSORS_INDEX_NAME = 'diffusion_pytorch_model.safetensors.index.json'
+
+
+def init_empty_weights():
+    """
+    Create parameters on the meta device, so building a model allocates and
+    initializes nothing. Buffers and other tensors are created as usual.
+    """
+    return init_weights_on_device(torch.device('meta'), include_buffers=False)
+
+
+def resolve_checkpoint(path):
+    """Prefer a `.safetensors` export next to a pickled checkpoint."""
+    root, ext = os.path.splitext(path)
+    if ext != '.safetensors' and load_safetensors is not None \
+            and os.path.exists(root + '.safetensors'):
+        return root + '.safetensors'
+    return path
+
+
+def load_state_dict(path, map_location='cpu'):
+    """
+    Load a state dict without materializing a pickled copy of it in RAM.
+
+    Safetensors files are read through a memory map. Pickled checkpoints are
+    memory-mapped too when they use the zipfile format; legacy ones fall back
+    to a plain `torch.load`.
+    """
+    path = resolve_checkpoint(path)
+    if path.endswith('.safetensors'):
+        if load_safetensors is None:
+            raise ImportError(f'safetensors is required to load {path}')
+        return load_safetensors(path, device=str(map_location))
+    try:
+        return torch.load(
+            path, map_location=map_location, mmap=True, weights_only=True)
+    except (RuntimeError, TypeError, pickle.UnpicklingError) as e:
+        logging.warning(f'cannot memory-map {path} ({e}), loading it eagerly')
+        return torch.load(path, map_location=map_location)
+
+
+def load_sharded_state_dict(paths, map_location='cpu', max_workers=None):
+    """Load the shards in `paths` concurrently and merge them."""
+    if len(paths) == 1:
+        return load_state_dict(paths[0], map_location)
+    state_dict = {}
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, len(paths))) as pool:
+        for shard in pool.map(
+                partial(load_state_dict, map_location=map_location), paths):
+            state_dict.update(shard)
+    return state_dict
+
+
+def assign_state_dict(model, state_dict, dtype=None):
+    """
+    Assign `state_dict` to a model built under `init_empty_weights`.
+
+    The checkpoint tensors become the parameters, so nothing is copied. Missing
+    keys are an error since their parameters would stay on the meta device.
+    """
+    missing, unexpected = model.load_state_dict(
+        state_dict, strict=False, assign=True)
+    params = dict(model.named_parameters())
+    missing = [name for name in missing if name in params]
+    if missing:
+        raise RuntimeError(
+            f'{len(missing)} parameters are missing from the checkpoint, '
+            f'e.g. {missing[:5]}')
+    if unexpected:
+        logging.warning(f'ignoring {len(unexpected)} unexpected keys in the '
+                        f'checkpoint, e.g. {unexpected[:5]}')
+    if dtype is not None:
+        model.to(dtype)
+    return model
+
+
+def load_pretrained_model(model_cls, checkpoint_dir, map_location='cpu',
+                          max_workers=None):
+    """
+    Build a diffusers model from `checkpoint_dir` on the meta device and assign
+    its safetensors shards, which are loaded in parallel. Falls back to
+    `model_cls.from_pretrained` for other checkpoint layouts.
+    """
+    index_file = os.path.join(checkpoint_dir, SAFETENSORS_INDEX_NAME)
+    weights_file = os.path.join(checkpoint_dir, SAFETENSORS_WEIGHTS_NAME)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)['weight_map']
+        paths = [
+            os.path.join(checkpoint_dir, name)
+            for name in sorted(set(weight_map.values()))
+        ]
+    elif os.path.exists(weights_file):
+        paths = [weights_file]
+    else:
+        paths = None
+    if paths is None or load_safetensors is None:
+        return model_cls.from_pretrained(checkpoint_dir)
+
+    with init_empty_weights():
+        model = model_cls.from_config(model_cls.load_config(checkpoint_dir))
+    logging.info(f'loading {len(paths)} shards from {checkpoint_dir}')
+    state_dict = load_sharded_state_dict(paths, map_location, max_workers)
+    return assign_state_dict(model, state_dict).eval()
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+__all__ = ['ClipCheckpoint']
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _save_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ClipCheckpoint:
+    """
+    Per-clip checkpoints of a streaming render, so a long `generate` call can
+    resume from its last completed clip.
+
+    Every job gets its own directory under `root`, named after a fingerprint of
+    its inputs and sampling parameters, so resubmitting the same job picks up
+    where the failed one stopped. After every clip the decoded frames are saved
+    as `clip_XXXX.pt`, and `state.pt` records what the next clip starts from:
+    the motion frame conditioning, the audio window, the cached conditioning
+    tensors and the RNG states, including the job's own noise generator.
+    """
+
+    STATE_FILE = 'state.pt'
+
+    def __init__(self, root, fingerprint):
+        self.dir = os.path.join(root, fingerprint)
+        os.makedirs(self.dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(input_data, **params):
+        """A stable key of the job inputs in `input_data` and the sampling `params`."""
+        key = {
+            'prompt': input_data.get('prompt'),
+            'cond_image': _file_digest(input_data['cond_image']),
+            'cond_audio': input_data.get('cond_audio'),
+            'audio_type': input_data.get('audio_type'),
+            'bbox': input_data.get('bbox'),
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+    def _clip_path(self, clip_idx):
+        return os.path.join(self.dir, f'clip_{clip_idx:04d}.pt')
+
+    def save_clip(self, clip_idx, video):
+        """Persist the decoded frames [B, C, T, H, W] that clip `clip_idx` adds to the video."""
+        _save_atomic(video.cpu(), self._clip_path(clip_idx))
+
+    def save_state(self, state, device, generator=None, executor=None):
+        """
+        Persist the state the next clip starts from, together with the RNG states.
+
+        The state is captured right away. With `executor`, it is written by a task
+        submitted there, after the clip saves queued before it.
+        """
+        state = {
+            key: value.cpu() if torch.is_tensor(value) else value
+            for key, value in state.items()
+        }
+        state['rng'] = {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state(device) if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'random': random.getstate(),
+            'generator': generator.get_state() if generator is not None else None,
+        }
+        state_path = os.path.join(self.dir, self.STATE_FILE)
+        if executor is None:
+            _save_atomic(state, state_path)
+            return
+
+        def write():
+            try:
+                _save_atomic(state, state_path)
+            except Exception:
+                logging.exception(f"Failed to save the checkpoint state to {state_path}")
+        executor.submit(write)
+
+    def load(self, device, generator=None):
+        """
+        Return the saved state and the decoded clips before it, or None if there
+        is nothing to resume. The RNG states are restored, `generator`'s too.
+        """
+        state_path = os.path.join(self.dir, self.STATE_FILE)
+        if not os.path.exists(state_path):
+            return None
+        state = torch.load(state_path, map_location='cpu', weights_only=False)
+        clip_paths = [self._clip_path(i) for i in range(state['clip_idx'])]
+        missing = [path for path in clip_paths if not os.path.exists(path)]
+        if missing:
+            logging.warning(f"Ignoring the checkpoint in {self.dir}, clips are missing: {missing}")
+            return None
+        clips = [torch.load(path, map_location='cpu') for path in clip_paths]
+
+        rng = state.pop('rng')
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state(rng['cuda'], device)
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['random'])
+        if generator is not None and rng.get('generator') is not None:
+            generator.set_state(rng['generator'])
+        return state, clips
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
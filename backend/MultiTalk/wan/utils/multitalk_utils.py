@@ -4,11 +4,6 @@ from einops import rearrange
 import torch
 import torch.nn as nn
 
-from xfuser.core.distributed import (
-    get_sequence_parallel_rank,
-    get_sequence_parallel_world_size,
-    get_sp_group,
-)
 from einops import rearrange, repeat
 from functools import lru_cache
 import imageio
@@ -37,12 +32,6 @@ ASPECT_RATIO_960 = {
 
 
 
-def torch_gc():
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-
-
-
 def split_token_counts_and_frame_ids(T, token_frame, world_size, rank):
 
     S = T * token_frame
@@ -73,45 +62,53 @@ def normalize_and_scale(column, source_range, target_range, epsilon=1e-8):
     return scaled
 
 
-@torch.compile
-def calculate_x_ref_attn_map(visual_q, ref_k, ref_target_masks, mode='mean', attn_bias=None):
-    
-    ref_k = ref_k.to(visual_q.dtype).to(visual_q.device)
-    scale = 1.0 / visual_q.shape[-1] ** 0.5
-    visual_q = visual_q * scale
-    visual_q = visual_q.transpose(1, 2)
-    ref_k = ref_k.transpose(1, 2)
-    attn = visual_q @ ref_k.transpose(-2, -1)
-
-    if attn_bias is not None:
-        attn = attn + attn_bias
-
-    x_ref_attn_map_source = attn.softmax(-1) # B, H, x_seqlens, ref_seqlens
-
-
-    x_ref_attn_maps = []
-    ref_target_masks = ref_target_masks.to(visual_q.dtype)
-    x_ref_attn_map_source = x_ref_attn_map_source.to(visual_q.dtype)
-
-    for class_idx, ref_target_mask in enumerate(ref_target_masks):
-        torch_gc()
-        ref_target_mask = ref_target_mask[None, None, None, ...]
-        x_ref_attnmap = x_ref_attn_map_source * ref_target_mask
-        x_ref_attnmap = x_ref_attnmap.sum(-1) / ref_target_mask.sum() # B, H, x_seqlens, ref_seqlens --> B, H, x_seqlens
-        x_ref_attnmap = x_ref_attnmap.permute(0, 2, 1) # B, x_seqlens, H
-       
+# number of attention scores materialized at once by calculate_x_ref_attn_map
+X_REF_ATTN_CHUNK_ELEMENTS = 2 ** 27
+
+
+def calculate_x_ref_attn_map(visual_q, ref_k, ref_target_masks, mode='mean', attn_bias=None, chunk_size=None):
+    """Args:
+        visual_q (torch.tensor): B, x_seqlens, H, K
+        ref_k (torch.tensor): B, ref_seqlens, H, K
+        ref_target_masks: [class_num, ref_seqlens]
+        mode: how the heads are reduced, 'mean' or 'max'
+        chunk_size: query tokens per chunk, derived from X_REF_ATTN_CHUNK_ELEMENTS by default
+    Returns:
+        class_num * B, x_seqlens
+
+    The query tokens are processed in chunks, and the masks of all classes are
+    reduced with a single matmul against the stacked, normalized masks, so only
+    a B x H x chunk_size x ref_seqlens slice of the attention is ever stored.
+    """
+    B, x_seqlens, heads, dim = visual_q.shape
+    ref_seqlens = ref_k.shape[1]
+    class_num = ref_target_masks.shape[0]
+    ref_k = ref_k.to(device=visual_q.device, dtype=visual_q.dtype).transpose(1, 2)
+    scale = 1.0 / dim ** 0.5
+
+    # ref_seqlens, class_num; each column averages the scores inside one mask
+    ref_target_masks = ref_target_masks.to(device=visual_q.device, dtype=visual_q.dtype)
+    ref_target_masks = (ref_target_masks / ref_target_masks.sum(-1, keepdim=True)).transpose(0, 1)
+
+    if chunk_size is None:
+        chunk_size = max(1, X_REF_ATTN_CHUNK_ELEMENTS // (B * heads * ref_seqlens))
+
+    x_ref_attn_maps = visual_q.new_empty(B, x_seqlens, class_num)
+    for start in range(0, x_seqlens, chunk_size):
+        end = min(start + chunk_size, x_seqlens)
+        q = visual_q[:, start:end].transpose(1, 2) * scale
+        attn = q @ ref_k.transpose(-2, -1) # B, H, chunk, ref_seqlens
+        if attn_bias is not None:
+            attn = attn + (attn_bias[..., start:end, :] if attn_bias.shape[-2] > 1 else attn_bias)
+        attn = attn.softmax(-1) @ ref_target_masks # B, H, chunk, class_num
+
         if mode == 'mean':
-            x_ref_attnmap = x_ref_attnmap.mean(-1) # B, x_seqlens
+            x_ref_attn_maps[:, start:end] = attn.mean(1)
         elif mode == 'max':
-            x_ref_attnmap = x_ref_attnmap.max(-1) # B, x_seqlens
-        
-        x_ref_attn_maps.append(x_ref_attnmap)
-    
-    del attn
-    del x_ref_attn_map_source
-    torch_gc()
+            x_ref_attn_maps[:, start:end] = attn.amax(1)
+        del q, attn
 
-    return torch.concat(x_ref_attn_maps, dim=0)
+    return x_ref_attn_maps.permute(2, 0, 1).reshape(class_num * B, x_seqlens)
 
 
 def get_attn_map_with_target(visual_q, ref_k, shape, ref_target_masks=None, split_num=2, enable_sp=False):
@@ -120,25 +117,18 @@ def get_attn_map_with_target(visual_q, ref_k, shape, ref_target_masks=None, spli
         key (torch.tensor): B M H K
         shape (tuple): (N_t, N_h, N_w)
         ref_target_masks: [B, N_h * N_w]
+        split_num: kept for compatibility; the map is averaged over all heads
+            and memory is bounded by chunking the query tokens instead
     """
 
     N_t, N_h, N_w = shape
     if enable_sp:
+        from xfuser.core.distributed import get_sp_group
         ref_k = get_sp_group().all_gather(ref_k, dim=1)
     
     x_seqlens = N_h * N_w
     ref_k     = ref_k[:, :x_seqlens]
-    _, seq_lens, heads, _ = visual_q.shape
-    class_num, _ = ref_target_masks.shape
-    x_ref_attn_maps = torch.zeros(class_num, seq_lens).to(visual_q.device).to(visual_q.dtype)
-
-    split_chunk = heads // split_num
-    
-    for i in range(split_num):
-        x_ref_attn_maps_perhead = calculate_x_ref_attn_map(visual_q[:, :, i*split_chunk:(i+1)*split_chunk, :], ref_k[:, :, i*split_chunk:(i+1)*split_chunk, :], ref_target_masks)
-        x_ref_attn_maps += x_ref_attn_maps_perhead
-    
-    return x_ref_attn_maps / split_num
+    return calculate_x_ref_attn_map(visual_q, ref_k, ref_target_masks)
 
 
 def rotate_half(x):
@@ -243,6 +233,108 @@ def save_video_ffmpeg(gen_video_samples, save_path, vocal_audio_list, fps=25, qu
 
 
 
+class StreamingVideoWriter:
+    """
+    Encode a video clip by clip with a single ffmpeg process.
+
+    Frames are piped to ffmpeg as raw RGB and muxed with the audio track in the
+    same pass, so the whole video is never held in memory and no temporary
+    files are written. The last `holdback` frames are buffered until `flush`,
+    because the end of the video may still be trimmed after later clips are
+    generated. Frames past `max_frames` are dropped.
+    """
+
+    def __init__(self, save_path, audio_path, fps=25, quality=5, max_frames=None, holdback=0):
+        self.save_path = save_path + ".mp4"
+        self.audio_path = audio_path
+        self.fps = fps
+        # same quality -> crf mapping as imageio's libx264 writer
+        self.crf = int((1 - quality / 10) * 51)
+        self.max_frames = max_frames
+        self.holdback = holdback
+        self.num_written = 0
+        self._pending = None
+        self._process = None
+
+    def _start(self, height, width):
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", f"{width}x{height}",
+            "-r", f"{self.fps}",
+            "-i", "-",
+            "-i", self.audio_path,
+            "-map", "0:v",
+            "-map", "1:a",
+            "-c:v", "libx264",
+            "-crf", f"{self.crf}",
+            "-pix_fmt", "yuv420p",
+            "-c:a", "aac",
+            "-shortest",
+            self.save_path,
+        ]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def _encode(self, frames):
+        if self.max_frames is not None:
+            frames = frames[:, :max(0, self.max_frames - self.num_written)]
+        if frames.shape[1] == 0:
+            return
+        if self._process is None:
+            self._start(frames.shape[2], frames.shape[3])
+        frames = ((frames.float() + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8) # C T H W
+        self._process.stdin.write(frames.permute(1, 2, 3, 0).contiguous().numpy().tobytes())
+        self.num_written += frames.shape[1]
+
+    def write(self, frames):
+        """Append decoded frames (C T H W, values in [-1, 1])."""
+        frames = frames.cpu()
+        if self._pending is not None:
+            frames = torch.cat([self._pending, frames], dim=1)
+        ready = max(0, frames.shape[1] - self.holdback)
+        self._encode(frames[:, :ready])
+        self._pending = frames[:, ready:]
+
+    def flush(self, trim_end=0):
+        """Write the held back frames, dropping the last `trim_end` frames of the video."""
+        if self._pending is None:
+            return
+        total = self.num_written + self._pending.shape[1]
+        if self.max_frames is not None:
+            total = min(total, self.max_frames)
+        self._encode(self._pending[:, :max(0, total - trim_end - self.num_written)])
+        self._pending = None
+
+    def close(self):
+        """Flush and wait for ffmpeg to finish writing the file."""
+        self.flush()
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, "ffmpeg")
+
+    def abort(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            if os.path.exists(self.save_path):
+                os.remove(self.save_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 class MomentumBuffer:
     def __init__(self, momentum: float): 
         self.momentum = momentum 
@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+
+__all__ = ['TeaCache']
+
+
+# polynomial fits rescaling the relative L1 change of the modulated input
+# to the change of the model output, keyed by (use_ret_steps, model_scale)
+TEACACHE_COEFFICIENTS = {
+    (True, 'multitalk-480'): [2.57151496e+05, -3.54229917e+04, 1.40286849e+03, -1.35890334e+01, 1.32517977e-01],
+    (True, 'multitalk-720'): [8.10705460e+03, 2.13393892e+03, -3.72934672e+02, 1.66203073e+01, -4.17769401e-02],
+    (False, 'multitalk-480'): [-3.02331670e+02, 2.23948934e+02, -5.25463970e+01, 5.87348440e+00, -2.01973289e-01],
+    (False, 'multitalk-720'): [-114.36346466, 65.26524496, -18.82220707, 4.91518089, -0.23412683],
+}
+
+
+class _BranchState:
+
+    def __init__(self):
+        self.step = 0
+        self.accumulated_rel_l1_distance = 0
+        self.previous_modulated_input = None
+        self.previous_residual = None
+        self.calls = 0
+        self.skips = 0
+
+
+class TeaCache:
+    """
+    TeaCache state of one generation job.
+
+    Every guidance branch (e.g. 'cond', 'drop_text', 'uncond') is tracked under
+    its own key with its own step counter, so the branches may be evaluated in
+    any order, one per forward or batched together. A branch skips the DiT
+    blocks and reuses its previous residual while the accumulated, rescaled
+    change of the modulated timestep input stays below `teacache_thresh`.
+    """
+
+    def __init__(self, sample_steps=40, teacache_thresh=0.2, use_ret_steps=True,
+                 model_scale='multitalk-480'):
+        self.sample_steps = sample_steps
+        self.teacache_thresh = teacache_thresh
+        self.use_ret_steps = use_ret_steps
+        self.rescale_func = np.poly1d(TEACACHE_COEFFICIENTS[(use_ret_steps, model_scale)])
+        if use_ret_steps:
+            self.ret_steps = 5
+            self.cutoff_steps = sample_steps
+        else:
+            self.ret_steps = 1
+            self.cutoff_steps = sample_steps - 1
+        self.branches = {}
+
+    def should_calc(self, branch, modulated_inp):
+        """Decide whether `branch` has to run the DiT blocks at its current step."""
+        state = self.branches.setdefault(branch, _BranchState())
+        if state.step < self.ret_steps or state.step >= self.cutoff_steps or state.previous_residual is None:
+            calc = True
+        else:
+            rel_l1 = ((modulated_inp - state.previous_modulated_input).abs().mean() /
+                      state.previous_modulated_input.abs().mean()).cpu().item()
+            state.accumulated_rel_l1_distance += self.rescale_func(rel_l1)
+            calc = state.accumulated_rel_l1_distance >= self.teacache_thresh
+        state.previous_modulated_input = modulated_inp.clone()
+        return calc
+
+    def _finish_step(self, branch, calculated):
+        state = self.branches[branch]
+        state.calls += 1
+        if calculated:
+            state.accumulated_rel_l1_distance = 0
+        else:
+            state.skips += 1
+        # the step counter restarts with every clip
+        state.step = (state.step + 1) % self.sample_steps
+
+    def run(self, branch, x, modulated_inp, blocks):
+        """
+        Apply `blocks` to x [B, L, C], or reuse the cached residual.
+
+        `branch` is one key for the whole batch, or a list of B keys when the
+        batch stacks several branches (batched CFG). Such a batch is only
+        skipped when every branch in it may skip; otherwise all samples are
+        computed and every residual is refreshed.
+        """
+        batched = isinstance(branch, (list, tuple))
+        keys = list(dict.fromkeys(branch)) if batched else [branch]
+        calc = any([self.should_calc(key, modulated_inp) for key in keys])
+
+        if calc:
+            ori_x = x.clone()
+            x = blocks(x)
+            residual = x - ori_x
+            if batched:
+                for i, key in enumerate(branch):
+                    self.branches[key].previous_residual = residual[i:i + 1]
+            else:
+                self.branches[branch].previous_residual = residual
+        elif batched:
+            x = x + torch.cat([self.branches[key].previous_residual for key in branch])
+        else:
+            x = x + self.branches[branch].previous_residual
+
+        for key in keys:
+            self._finish_step(key, calc)
+        return x
+
+    def stats(self):
+        """Skip counts and rates per branch and in total."""
+        stats = {
+            branch: {
+                'calls': state.calls,
+                'skips': state.skips,
+                'skip_rate': state.skips / state.calls if state.calls else 0.0,
+            } for branch, state in self.branches.items()
+        }
+        calls = sum(state.calls for state in self.branches.values())
+        skips = sum(state.skips for state in self.branches.values())
+        stats['total'] = {
+            'calls': calls,
+            'skips': skips,
+            'skip_rate': skips / calls if calls else 0.0,
+        }
+        return stats
@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+__all__ = ['MEMORY_RELEASE_POLICIES', 'Tracer', 'release_cuda_memory']
+
+# 'always' empties the CUDA cache at every release point, 'stage' only at stage
+# boundaries and 'never' leaves the caching allocator alone
+MEMORY_RELEASE_POLICIES = ('always', 'stage', 'never')
+
+
+def release_cuda_memory():
+    if not torch.cuda.is_available():
+        return
+    torch.cuda.empty_cache()
+    torch.cuda.ipc_collect()
+
+
+class _Span:
+
+    def __init__(self, name, attrs, start):
+        self.name = name
+        self.attrs = attrs
+        self.start = start
+        self.peak = 0
+
+
+class Tracer:
+    """
+    Spans around the stages of a generation job, plus the memory release policy.
+
+    `span(name, **attrs)` records the wall time of a stage and, on CUDA, the
+    allocated memory at its end and the peak allocated memory while it ran,
+    nested spans included. Spans are only recorded when `enabled`; the memory
+    release points work either way. With `sync`, CUDA is synchronized at span
+    boundaries so the times cover the queued kernels. Peaks are tracked with
+    the global CUDA peak counter, so spans running concurrently on different
+    threads see each other's allocations.
+    """
+
+    def __init__(self, enabled=False, device=None, memory_release='stage', sync=True):
+        assert memory_release in MEMORY_RELEASE_POLICIES, f"Unsupported memory_release: {memory_release}"
+        self.enabled = enabled
+        self.device = torch.device(device) if device is not None else None
+        self.memory_release = memory_release
+        self.sync = sync
+        self.track_memory = (self.device is not None and self.device.type == 'cuda'
+                             and torch.cuda.is_available())
+        self.origin = time.perf_counter()
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def release(self, boundary=False):
+        """A point where cached CUDA memory may be returned, depending on the policy."""
+        if self.memory_release == 'always' or (boundary and self.memory_release == 'stage'):
+            release_cuda_memory()
+
+    @contextmanager
+    def span(self, name, release=False, **attrs):
+        """
+        Trace the enclosed stage. With `release`, its end is a stage boundary
+        for the memory release policy.
+        """
+        if not self.enabled:
+            yield
+            if release:
+                self.release(boundary=True)
+            return
+
+        stack = self._stack()
+        if self.track_memory:
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            # keep the peak reached so far by the enclosing span before resetting
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+        span = _Span(name, attrs, time.perf_counter())
+        stack.append(span)
+        try:
+            yield
+        finally:
+            if self.track_memory and self.sync:
+                torch.cuda.synchronize(self.device)
+            end = time.perf_counter()
+            stack.pop()
+            event = {
+                'name': name,
+                'start': span.start - self.origin,
+                'duration': end - span.start,
+                'thread': threading.get_ident(),
+                'depth': len(stack),
+                'attrs': attrs,
+            }
+            if self.track_memory:
+                span.peak = max(span.peak, torch.cuda.max_memory_allocated(self.device))
+                event['peak_allocated'] = span.peak
+                event['allocated'] = torch.cuda.memory_allocated(self.device)
+                event['reserved'] = torch.cuda.memory_reserved(self.device)
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, span.peak)
+            with self._lock:
+                self.events.append(event)
+        if release:
+            self.release(boundary=True)
+
+    def iterate(self, name, iterable, **attrs):
+        """Yield from `iterable`, tracing the body of every iteration as a span with its `step`."""
+        for step, item in enumerate(iterable):
+            with self.span(name, step=step, **attrs):
+                yield item
+
+    def summary(self):
+        """Count, total and mean time and the highest peak memory per span name."""
+        summary = defaultdict(lambda: {'count': 0, 'total': 0.0})
+        for event in self.events:
+            entry = summary[event['name']]
+            entry['count'] += 1
+            entry['total'] += event['duration']
+            if 'peak_allocated' in event:
+                entry['peak_allocated'] = max(entry.get('peak_allocated', 0), event['peak_allocated'])
+        for entry in summary.values():
+            entry['mean'] = entry['total'] / entry['count']
+        return dict(summary)
+
+    def log_summary(self):
+        for name, entry in self.summary().items():
+            peak = f", peak {entry['peak_allocated'] / 1024**3:.2f} GiB" if 'peak_allocated' in entry else ''
+            logging.info(f"{name}: {entry['count']} x {entry['mean']:.3f}s = {entry['total']:.3f}s{peak}")
+
+    def export_chrome_trace(self, path):
+        """Write the spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        trace_events = []
+        for event in sorted(self.events, key=lambda e: e['start']):
+            args = dict(event['attrs'])
+            for key in ('allocated', 'peak_allocated', 'reserved'):
+                if key in event:
+                    args[key] = event[key]
+            trace_events.append({
+                'name': event['name'],
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['duration'] * 1e6,
+                'pid': pid,
+                'tid': event['thread'],
+                'args': args,
+            })
+            if 'allocated' in event:
+                trace_events.append({
+                    'name': 'cuda_memory',
+                    'ph': 'C',
+                    'ts': (event['start'] + event['duration']) * 1e6,
+                    'pid': pid,
+                    'args': {'allocated': event['allocated'], 'reserved': event['reserved']},
+                })
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
@@ -33,7 +33,7 @@ def initialize_learning_system(config: Dict[str, Any]) -> bool:
         learning_config = {
             'patterns_db_path': config.get('patterns_db_path', './backend/memory/data/learning_patterns.json'),
             'feedback_db_path': config.get('feedback_db_path', './backend/memory/data/feedback_records.json'),
-            'vectorizer_path': config.get('vectorizer_path', './backend/memory/data/pattern_vectorizer.pkl'),
+            'store_db_path': config.get('store_db_path', './backend/memory/data/learning_store.db'),
             'min_success_score': config.get('min_success_score', 0.7),
             'max_patterns_per_type': config.get('max_patterns_per_type', 1000),
             'pattern_decay_days': config.get('pattern_decay_days', 30)
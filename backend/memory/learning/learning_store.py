@@ -0,0 +1,80 @@
+"""
+SQLite storage for learned patterns and feedback records
+Keeps one row per record, so saving a record never rewrites the whole collection
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import asdict
+from typing import Any, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+class LearningStore:
+    """
+    SQLite-backed storage for LearningPattern and FeedbackRecord objects
+
+    Every record is a row keyed by its id that holds the record as JSON, so
+    saving a pattern or a feedback record is a single upsert. The database runs
+    in WAL mode: commits append to the write-ahead log, which SQLite folds back
+    into the main file at its periodic checkpoints, and an interrupted write
+    never leaves a truncated store behind.
+    """
+
+    TABLES = ('patterns', 'feedback')
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+
+        # One connection shared by all threads, serialized by the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            for table in self.TABLES:
+                self._conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+                )
+
+    def load(self, table: str) -> List[Dict[str, Any]]:
+        """Load all records of a table as dicts"""
+        self._check_table(table)
+        with self._lock:
+            rows = self._conn.execute(f'SELECT data FROM {table}').fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def count(self, table: str) -> int:
+        """Number of records in a table"""
+        self._check_table(table)
+        with self._lock:
+            return self._conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def save(self, table: str, records: Iterable[Any]):
+        """Insert or replace dataclass records, keyed by their `id`, in one transaction"""
+        self._check_table(table)
+        rows = [(record.id, json.dumps(asdict(record))) for record in records]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)', rows
+            )
+
+    def delete(self, table: str, ids: Iterable[str]):
+        """Delete records by id in one transaction"""
+        self._check_table(table)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f'DELETE FROM {table} WHERE id = ?', [(record_id,) for record_id in ids]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _check_table(self, table: str):
+        if table not in self.TABLES:
+            raise ValueError(f"Unknown table: {table}")
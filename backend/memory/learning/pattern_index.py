@@ -0,0 +1,130 @@
+"""
+Partitioned top-k index over learned patterns
+Scores only the patterns matching the type / brain region filters, in one vectorized pass
+"""
+
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from pattern_vectorizer import IncrementalPatternVectorizer
+
+class PatternIndex:
+    """
+    Top-k retrieval of learned patterns, partitioned by (pattern_type, brain_region)
+
+    Each partition lists the vectorizer rows of its patterns, and the
+    effectiveness scores are kept in an array aligned with those rows. A query
+    gathers the rows of the partitions matching its filters, computes the TF-IDF
+    similarity for those rows only, blends it with their effectiveness and picks
+    the best `limit` with `argpartition`. Patterns outside the matching
+    partitions are never touched.
+    """
+
+    def __init__(self, similarity_weight: float = 0.7, vectorizer: Optional[IncrementalPatternVectorizer] = None):
+        self.similarity_weight = similarity_weight
+        self.vectorizer = vectorizer or IncrementalPatternVectorizer()
+        self.partitions: Dict[Tuple[str, str], List[int]] = {}
+        self.row_of: Dict[str, int] = {}
+        self._keys: List[Tuple[str, str]] = []
+        self._effectiveness = np.zeros(1024)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, pattern):
+        """Index a new pattern"""
+        key = (pattern.pattern_type, pattern.brain_region)
+        with self._lock:
+            row = len(self._keys)
+            self.vectorizer.add(pattern.id, pattern.input_context)
+            if row == len(self._effectiveness):
+                self._effectiveness = np.concatenate([self._effectiveness, np.zeros(row)])
+            self._effectiveness[row] = pattern.effectiveness_score
+            self.partitions.setdefault(key, []).append(row)
+            self.row_of[pattern.id] = row
+            self._keys.append(key)
+
+    def update_effectiveness(self, pattern):
+        """Refresh the effectiveness score of an indexed pattern"""
+        with self._lock:
+            row = self.row_of.get(pattern.id)
+            if row is not None:
+                self._effectiveness[row] = pattern.effectiveness_score
+
+    def remove(self, pattern_ids: Iterable[str]):
+        """Drop patterns from the index, renumbering the remaining rows"""
+        removed_ids = set(pattern_ids)
+        with self._lock:
+            kept_rows = [row for pattern_id, row in self.row_of.items() if pattern_id not in removed_ids]
+            kept_rows.sort()
+            self.vectorizer.remove(removed_ids)
+            self._keys = [self._keys[row] for row in kept_rows]
+            effectiveness = self._effectiveness[kept_rows]
+            self._effectiveness = np.zeros(max(1024, 2 * len(kept_rows)))
+            self._effectiveness[:len(kept_rows)] = effectiveness
+            self.row_of = {pattern_id: row for row, pattern_id in enumerate(self.vectorizer.ids)}
+            self.partitions = {}
+            for row, key in enumerate(self._keys):
+                self.partitions.setdefault(key, []).append(row)
+
+    def most_similar(self, text: str, pattern_type: str, brain_region: str) -> Optional[Tuple[str, float]]:
+        """
+        The pattern of the (pattern_type, brain_region) partition closest to `text`
+
+        Returns:
+            (pattern id, similarity), or None if the partition is empty
+        """
+        with self._lock:
+            rows = self.partitions.get((pattern_type, brain_region))
+            if not rows:
+                return None
+            rows = np.asarray(rows)
+            ids = self.vectorizer.ids
+            # unseen terms keep counting towards the query norm, so a text with
+            # new words is less likely to be merged into an existing pattern
+            similarities = self.vectorizer.similarities(text, rows, known_terms_only=False)
+
+        best = int(np.argmax(similarities))
+        return ids[rows[best]], float(similarities[best])
+
+    def top_k(self,
+              query: str,
+              pattern_type: Optional[str] = None,
+              brain_region: Optional[str] = None,
+              limit: int = 5) -> List[Tuple[str, float]]:
+        """
+        Best matching patterns for a query
+
+        Args:
+            query: Query text
+            pattern_type: Only consider patterns of this type
+            brain_region: Only consider patterns of this brain region
+            limit: Maximum patterns to return
+
+        Returns:
+            (pattern id, combined score) pairs, best first
+        """
+        with self._lock:
+            if pattern_type or brain_region:
+                partitions = [
+                    rows for (partition_type, partition_region), rows in self.partitions.items()
+                    if (not pattern_type or partition_type == pattern_type)
+                    and (not brain_region or partition_region == brain_region)
+                ]
+                rows = np.concatenate([np.asarray(r) for r in partitions]) if partitions else np.zeros(0, dtype=int)
+            else:
+                rows = np.arange(len(self._keys))
+            effectiveness = self._effectiveness[rows]
+            ids = self.vectorizer.ids
+            if rows.size == 0 or limit <= 0:
+                return []
+            similarities = self.vectorizer.similarities(query, rows)
+
+        scores = similarities * self.similarity_weight + effectiveness * (1 - self.similarity_weight)
+        k = min(limit, rows.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(ids[rows[i]], float(scores[i])) for i in top]
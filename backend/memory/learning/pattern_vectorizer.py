@@ -0,0 +1,150 @@
+"""
+Incremental TF-IDF vectors for learned patterns
+Hashes pattern texts into a fixed feature space and keeps document frequencies online
+"""
+
+import threading
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    """Copy of `array` with room for at least `size` entries, doubling its capacity"""
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class IncrementalPatternVectorizer:
+    """
+    TF-IDF similarity over pattern texts without refitting
+
+    Texts are hashed into `n_features` term counts, so there is no vocabulary to
+    fit, and the document frequency of every feature is updated as patterns are
+    added or removed. The counts are stored row by row in CSR arrays whose
+    capacity doubles when full, so adding a pattern writes one row and costs
+    amortized O(nnz of the row). The IDF weights are applied when scoring a
+    query, from the stored rows being scored only, so stored rows never have to
+    be recomputed. Everything derives from the pattern texts, so the only state
+    to persist is the patterns themselves.
+
+    Rows keep the insertion order of the patterns, `ids[i]` being the id of row i.
+    """
+
+    def __init__(self, n_features: int = 2 ** 18):
+        self.hasher = HashingVectorizer(
+            n_features=n_features,
+            alternate_sign=False,
+            norm=None,
+            stop_words='english'
+        )
+        self.doc_freq = np.zeros(n_features, dtype=np.int64)
+        self.ids: List[str] = []
+        # row i holds the entries _indptr[i]:_indptr[i + 1] of _indices / _data
+        self._indptr = np.zeros(1025, dtype=np.int64)
+        self._indices = np.zeros(16384, dtype=np.int32)
+        self._data = np.zeros(16384, dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, pattern_id: str, text: str):
+        """Append the row of a new pattern"""
+        row = self.hasher.transform([text]).tocsr()
+        with self._lock:
+            n_rows = len(self.ids)
+            start = int(self._indptr[n_rows])
+            end = start + row.nnz
+            if n_rows + 2 > len(self._indptr):
+                self._indptr = _grow(self._indptr, n_rows + 2)
+            if end > len(self._indices):
+                self._indices = _grow(self._indices, end)
+                self._data = _grow(self._data, end)
+            self._indices[start:end] = row.indices
+            self._data[start:end] = row.data
+            self._indptr[n_rows + 1] = end
+            self.doc_freq[row.indices] += 1
+            self.ids.append(pattern_id)
+
+    def remove(self, pattern_ids: Iterable[str]):
+        """Drop the rows of removed patterns, compacting the storage"""
+        removed_ids = set(pattern_ids)
+        with self._lock:
+            keep = np.array([pattern_id not in removed_ids for pattern_id in self.ids], dtype=bool)
+            if keep.all():
+                return
+            indptr = self._indptr[:len(self.ids) + 1]
+            lengths = np.diff(indptr)
+            kept_entries = np.repeat(keep, lengths)
+            indices = self._indices[:indptr[-1]]
+            data = self._data[:indptr[-1]]
+            # a feature occurs at most once per row, so this counts documents
+            self.doc_freq -= np.bincount(indices[~kept_entries], minlength=len(self.doc_freq))
+            kept_nnz = int(kept_entries.sum())
+            self._indices[:kept_nnz] = indices[kept_entries]
+            self._data[:kept_nnz] = data[kept_entries]
+            kept_indptr = np.concatenate([[0], np.cumsum(lengths[keep])])
+            self._indptr[:len(kept_indptr)] = kept_indptr
+            self.ids = [pattern_id for pattern_id, kept in zip(self.ids, keep) if kept]
+
+    def idf(self, features: Optional[np.ndarray] = None) -> np.ndarray:
+        """Smoothed IDF weights of `features` (all features if None), as TfidfVectorizer computes them"""
+        doc_freq = self.doc_freq if features is None else self.doc_freq[features]
+        return np.log((1 + len(self.ids)) / (1 + doc_freq)) + 1
+
+    def similarities(self, text: str, rows: Optional[Sequence[int]] = None,
+                     known_terms_only: bool = True) -> np.ndarray:
+        """
+        Cosine similarity between the TF-IDF vectors of `text` and of the patterns
+
+        Args:
+            text: Query text
+            rows: Row indices to score, all rows if None
+            known_terms_only: Drop the query terms no pattern contains, as
+                TfidfVectorizer drops out-of-vocabulary terms
+
+        Returns:
+            One similarity per scored row
+        """
+        query = self.hasher.transform([text]).tocsr()
+        with self._lock:
+            rows = np.arange(len(self.ids)) if rows is None else np.asarray(rows, dtype=np.int64)
+            starts = self._indptr[rows]
+            lengths = self._indptr[rows + 1] - starts
+            # storage positions of the entries of the scored rows, row after row
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            indices = self._indices[positions]
+            data = self._data[positions]
+            entry_idf = self.idf(indices)
+            query_features = query.indices
+            query_counts = query.data
+            if known_terms_only:
+                known = self.doc_freq[query_features] > 0
+                query_features = query_features[known]
+                query_counts = query_counts[known]
+            query_idf = self.idf(query_features)
+
+        query_weights = query_counts * query_idf
+        query_norm = np.linalg.norm(query_weights)
+        if query_norm == 0 or rows.size == 0:
+            return np.zeros(rows.size)
+
+        row_of_entry = np.repeat(np.arange(rows.size), lengths)
+        weights = data * entry_idf
+        norms = np.sqrt(np.bincount(row_of_entry, weights=weights ** 2, minlength=rows.size))
+
+        # the dot products only involve the entries of the query's features
+        order = np.argsort(query_features)
+        query_features = query_features[order]
+        query_weights = query_weights[order]
+        matches = np.minimum(np.searchsorted(query_features, indices), len(query_features) - 1)
+        matched = query_features[matches] == indices
+        dots = np.bincount(
+            row_of_entry[matched],
+            weights=weights[matched] * query_weights[matches[matched]],
+            minlength=rows.size
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities = dots / (norms * query_norm)
+        return np.nan_to_num(similarities)
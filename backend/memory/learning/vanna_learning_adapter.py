@@ -8,13 +8,13 @@ import uuid
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional, Tuple
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import pickle
 import os
 
+from learning_store import LearningStore
+from pattern_index import PatternIndex
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -55,23 +55,26 @@ class VannaLearningAdapter:
         self.config = config
         self.patterns_db_path = config.get('patterns_db_path', './backend/memory/data/learning_patterns.json')
         self.feedback_db_path = config.get('feedback_db_path', './backend/memory/data/feedback_records.json')
-        self.vectorizer_path = config.get('vectorizer_path', './backend/memory/data/pattern_vectorizer.pkl')
+        self.store_db_path = config.get(
+            'store_db_path',
+            os.path.join(os.path.dirname(self.patterns_db_path), 'learning_store.db')
+        )
         
         # Learning parameters
         self.min_success_score = config.get('min_success_score', 0.7)
         self.max_patterns_per_type = config.get('max_patterns_per_type', 1000)
         self.pattern_decay_days = config.get('pattern_decay_days', 30)
         
-        # Initialize storage
+        # Initialize storage, the JSON files are only read to migrate them
+        self.store = LearningStore(self.store_db_path)
         self.patterns: Dict[str, LearningPattern] = {}
         self.feedback_records: Dict[str, FeedbackRecord] = {}
-        self.vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-        self.pattern_vectors = None
+        self.index = PatternIndex()
         
         # Load existing data
         self._load_patterns()
         self._load_feedback()
-        self._initialize_vectorizer()
+        self._initialize_index()
         
         logger.info("✅ VANNA Learning Adapter initialized")
     
@@ -112,8 +115,9 @@ class VannaLearningAdapter:
                 similar_pattern.effectiveness_score = (
                     similar_pattern.effectiveness_score * 0.9 + success_score * 0.1
                 )
+                self.index.update_effectiveness(similar_pattern)
                 logger.info(f"📈 Updated existing pattern: {similar_pattern.id}")
-                self._save_patterns()
+                self._save_patterns([similar_pattern])
                 return similar_pattern.id
             else:
                 # Create new pattern
@@ -135,9 +139,9 @@ class VannaLearningAdapter:
                 self.patterns[pattern_id] = new_pattern
                 logger.info(f"🧠 Learned new pattern: {pattern_id} ({pattern_type})")
                 
-                # Update vectorizer with new pattern
-                self._update_vectorizer()
-                self._save_patterns()
+                # Add the new pattern to its partition of the index
+                self.index.add(new_pattern)
+                self._save_patterns([new_pattern])
                 
                 return pattern_id
                 
@@ -166,41 +170,18 @@ class VannaLearningAdapter:
             if not self.patterns:
                 return []
             
-            # Filter patterns by type and region if specified
-            candidate_patterns = []
-            for pattern in self.patterns.values():
-                if pattern_type and pattern.pattern_type != pattern_type:
-                    continue
-                if brain_region and pattern.brain_region != brain_region:
-                    continue
-                candidate_patterns.append(pattern)
-            
-            if not candidate_patterns:
-                return []
-            
-            # Calculate similarity scores
-            pattern_contexts = [p.input_context for p in candidate_patterns]
+            if len(self.index) == len(self.patterns):
+                # Score the matching partitions only and select the top patterns
+                ranked = self.index.top_k(query_context, pattern_type, brain_region, limit)
+                return [self.patterns[pattern_id] for pattern_id, score in ranked]
             
-            if self.pattern_vectors is not None and len(pattern_contexts) > 0:
-                # Use vectorizer for similarity
-                query_vector = self.vectorizer.transform([query_context])
-                similarities = cosine_similarity(query_vector, self.pattern_vectors).flatten()
-                
-                # Combine similarity with effectiveness scores
-                scored_patterns = []
-                for i, pattern in enumerate(candidate_patterns):
-                    if i < len(similarities):
-                        combined_score = similarities[i] * 0.7 + pattern.effectiveness_score * 0.3
-                        scored_patterns.append((pattern, combined_score))
-                
-                # Sort by combined score
-                scored_patterns.sort(key=lambda x: x[1], reverse=True)
-                
-                # Return top patterns
-                return [pattern for pattern, score in scored_patterns[:limit]]
-            else:
-                # Fallback to simple text matching
-                return self._simple_text_matching(query_context, candidate_patterns, limit)
+            # Fallback to simple text matching over the filtered patterns
+            candidate_patterns = [
+                pattern for pattern in self.patterns.values()
+                if (not pattern_type or pattern.pattern_type == pattern_type)
+                and (not brain_region or pattern.brain_region == brain_region)
+            ]
+            return self._simple_text_matching(query_context, candidate_patterns, limit)
                 
         except Exception as e:
             logger.error(f"Error retrieving patterns: {e}")
@@ -246,6 +227,7 @@ class VannaLearningAdapter:
             self.feedback_records[feedback_id] = feedback_record
             
             # Update pattern effectiveness based on feedback
+            updated_patterns = []
             if pattern_id in self.patterns:
                 pattern = self.patterns[pattern_id]
                 # Weighted update: recent feedback has more impact
@@ -253,6 +235,8 @@ class VannaLearningAdapter:
                     pattern.effectiveness_score * 0.8 + 
                     (feedback_score + 1.0) / 2.0 * 0.2  # Normalize -1,1 to 0,1
                 )
+                self.index.update_effectiveness(pattern)
+                updated_patterns.append(pattern)
                 
                 # If user provided correction, learn from it
                 if corrected_output and feedback_score > 0:
@@ -265,8 +249,8 @@ class VannaLearningAdapter:
                         metadata={'source': 'user_correction', 'original_pattern': pattern_id}
                     )
             
-            self._save_feedback()
-            self._save_patterns()
+            self._save_feedback([feedback_record])
+            self._save_patterns(updated_patterns)
             
             logger.info(f"📝 Recorded feedback: {feedback_id} for pattern {pattern_id}")
             return feedback_id
@@ -293,24 +277,36 @@ class VannaLearningAdapter:
                 limit=3
             )
             
-            suggestions = []
-            for pattern in relevant_patterns:
-                suggestion = {
-                    'pattern_id': pattern.id,
-                    'suggestion_type': pattern.pattern_type,
-                    'suggested_approach': pattern.successful_output,
-                    'confidence': pattern.effectiveness_score,
-                    'usage_count': pattern.usage_count,
-                    'brain_region': pattern.brain_region
-                }
-                suggestions.append(suggestion)
-            
-            return suggestions
+            return self.suggestions_from_patterns(relevant_patterns)
             
         except Exception as e:
             logger.error(f"Error getting improvement suggestions: {e}")
             return []
     
+    def suggestions_from_patterns(self, patterns: List[LearningPattern]) -> List[Dict[str, Any]]:
+        """
+        Turn retrieved patterns into improvement suggestions
+        
+        Args:
+            patterns: Patterns returned by retrieve_relevant_patterns
+            
+        Returns:
+            List of improvement suggestions
+        """
+        suggestions = []
+        for pattern in patterns:
+            suggestion = {
+                'pattern_id': pattern.id,
+                'suggestion_type': pattern.pattern_type,
+                'suggested_approach': pattern.successful_output,
+                'confidence': pattern.effectiveness_score,
+                'usage_count': pattern.usage_count,
+                'brain_region': pattern.brain_region
+            }
+            suggestions.append(suggestion)
+        
+        return suggestions
+    
     def cleanup_old_patterns(self):
         """Remove old, ineffective patterns to maintain quality"""
         try:
@@ -331,8 +327,8 @@ class VannaLearningAdapter:
                 logger.info(f"🗑️ Removed old pattern: {pattern_id}")
             
             if patterns_to_remove:
-                self._update_vectorizer()
-                self._save_patterns()
+                self.index.remove(patterns_to_remove)
+                self.store.delete('patterns', patterns_to_remove)
                 
             logger.info(f"🧹 Cleanup complete: removed {len(patterns_to_remove)} patterns")
             
@@ -390,28 +386,16 @@ class VannaLearningAdapter:
             return {'error': str(e)}
     
     def _find_similar_pattern(self, input_context: str, pattern_type: str, brain_region: str) -> Optional[LearningPattern]:
-        """Find if a similar pattern already exists"""
-        for pattern in self.patterns.values():
-            if (pattern.pattern_type == pattern_type and 
-                pattern.brain_region == brain_region):
-                
-                # Simple similarity check (can be enhanced)
-                if self._calculate_text_similarity(input_context, pattern.input_context) > 0.8:
-                    return pattern
+        """Find if a similar pattern already exists in the same partition of the index"""
+        match = self.index.most_similar(input_context, pattern_type, brain_region)
+        if match is not None:
+            pattern_id, similarity = match
+            if similarity > 0.8:
+                return self.patterns.get(pattern_id)
         return None
     
-    def _calculate_text_similarity(self, text1: str, text2: str) -> float:
-        """Calculate similarity between two texts"""
-        try:
-            vectorizer = TfidfVectorizer().fit([text1, text2])
-            vectors = vectorizer.transform([text1, text2])
-            similarity = cosine_similarity(vectors[0:1], vectors[1:2])[0][0]
-            return similarity
-        except:
-            return 0.0
-    
     def _simple_text_matching(self, query: str, patterns: List[LearningPattern], limit: int) -> List[LearningPattern]:
-        """Fallback text matching when vectorizer is not available"""
+        """Fallback text matching when the pattern index is not available"""
         scored_patterns = []
         query_words = set(query.lower().split())
         
@@ -428,87 +412,56 @@ class VannaLearningAdapter:
         scored_patterns.sort(key=lambda x: x[1], reverse=True)
         return [pattern for pattern, score in scored_patterns[:limit]]
     
-    def _initialize_vectorizer(self):
-        """Initialize or load the TF-IDF vectorizer"""
-        try:
-            if os.path.exists(self.vectorizer_path) and self.patterns:
-                with open(self.vectorizer_path, 'rb') as f:
-                    self.vectorizer = pickle.load(f)
-                self._update_pattern_vectors()
-            elif self.patterns:
-                self._update_vectorizer()
-        except Exception as e:
-            logger.error(f"Error initializing vectorizer: {e}")
-    
-    def _update_vectorizer(self):
-        """Update the vectorizer with current patterns"""
-        try:
-            if not self.patterns:
-                return
-            
-            pattern_texts = [pattern.input_context for pattern in self.patterns.values()]
-            self.vectorizer.fit(pattern_texts)
-            self._update_pattern_vectors()
-            
-            # Save vectorizer
-            os.makedirs(os.path.dirname(self.vectorizer_path), exist_ok=True)
-            with open(self.vectorizer_path, 'wb') as f:
-                pickle.dump(self.vectorizer, f)
-                
-        except Exception as e:
-            logger.error(f"Error updating vectorizer: {e}")
-    
-    def _update_pattern_vectors(self):
-        """Update pattern vectors for similarity calculations"""
+    def _initialize_index(self):
+        """Build the pattern index from the loaded patterns"""
         try:
-            if self.patterns:
-                pattern_texts = [pattern.input_context for pattern in self.patterns.values()]
-                self.pattern_vectors = self.vectorizer.transform(pattern_texts)
+            for pattern in self.patterns.values():
+                self.index.add(pattern)
         except Exception as e:
-            logger.error(f"Error updating pattern vectors: {e}")
+            logger.error(f"Error initializing pattern index: {e}")
     
     def _load_patterns(self):
         """Load patterns from storage"""
         try:
-            if os.path.exists(self.patterns_db_path):
-                with open(self.patterns_db_path, 'r') as f:
-                    data = json.load(f)
-                    for pattern_data in data:
-                        pattern = LearningPattern(**pattern_data)
-                        self.patterns[pattern.id] = pattern
-                logger.info(f"📚 Loaded {len(self.patterns)} learning patterns")
+            self._migrate_json(self.patterns_db_path, 'patterns', LearningPattern)
+            for pattern_data in self.store.load('patterns'):
+                pattern = LearningPattern(**pattern_data)
+                self.patterns[pattern.id] = pattern
+            logger.info(f"📚 Loaded {len(self.patterns)} learning patterns")
         except Exception as e:
             logger.error(f"Error loading patterns: {e}")
     
-    def _save_patterns(self):
-        """Save patterns to storage"""
+    def _save_patterns(self, patterns: List[LearningPattern]):
+        """Save new or changed patterns to storage"""
         try:
-            os.makedirs(os.path.dirname(self.patterns_db_path), exist_ok=True)
-            with open(self.patterns_db_path, 'w') as f:
-                patterns_data = [asdict(pattern) for pattern in self.patterns.values()]
-                json.dump(patterns_data, f, indent=2)
+            if patterns:
+                self.store.save('patterns', patterns)
         except Exception as e:
             logger.error(f"Error saving patterns: {e}")
     
     def _load_feedback(self):
         """Load feedback records from storage"""
         try:
-            if os.path.exists(self.feedback_db_path):
-                with open(self.feedback_db_path, 'r') as f:
-                    data = json.load(f)
-                    for feedback_data in data:
-                        feedback = FeedbackRecord(**feedback_data)
-                        self.feedback_records[feedback.id] = feedback
-                logger.info(f"📝 Loaded {len(self.feedback_records)} feedback records")
+            self._migrate_json(self.feedback_db_path, 'feedback', FeedbackRecord)
+            for feedback_data in self.store.load('feedback'):
+                feedback = FeedbackRecord(**feedback_data)
+                self.feedback_records[feedback.id] = feedback
+            logger.info(f"📝 Loaded {len(self.feedback_records)} feedback records")
         except Exception as e:
             logger.error(f"Error loading feedback: {e}")
     
-    def _save_feedback(self):
-        """Save feedback records to storage"""
+    def _save_feedback(self, feedback_records: List[FeedbackRecord]):
+        """Save new feedback records to storage"""
         try:
-            os.makedirs(os.path.dirname(self.feedback_db_path), exist_ok=True)
-            with open(self.feedback_db_path, 'w') as f:
-                feedback_data = [asdict(feedback) for feedback in self.feedback_records.values()]
-                json.dump(feedback_data, f, indent=2)
+            self.store.save('feedback', feedback_records)
         except Exception as e:
             logger.error(f"Error saving feedback: {e}")
+    
+    def _migrate_json(self, json_path: str, table: str, record_cls):
+        """Import a JSON file written by earlier versions into an empty store table"""
+        if not os.path.exists(json_path) or self.store.count(table) > 0:
+            return
+        with open(json_path, 'r') as f:
+            records = [record_cls(**record_data) for record_data in json.load(f)]
+        self.store.save(table, records)
+        logger.info(f"📦 Migrated {len(records)} records from {json_path} into {self.store_db_path}")
@@ -129,7 +129,6 @@ def initialize_memory():
             learning_config = {
                 'patterns_db_path': './backend/memory/data/learning_patterns.json',
                 'feedback_db_path': './backend/memory/data/feedback_records.json',
-                'vectorizer_path': './backend/memory/data/pattern_vectorizer.pkl',
                 'min_success_score': 0.7,
                 'max_patterns_per_type': 1000,
                 'pattern_decay_days': 30
@@ -164,7 +163,8 @@ def initialize_memory():
                 'conversation_enabled': CONVERSATION_AVAILABLE,
                 'default_brain_region': 'FRONTAL_LOBE',
                 'enable_recommendations': True,
-                'enable_analytics': True
+                'enable_analytics': True,
+                'max_concurrent_calls': 8
             }
 
             if initialize_unified_service(unified_config):
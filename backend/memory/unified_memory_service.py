@@ -9,8 +9,11 @@ import sys
 import json
 import logging
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Union
+from functools import partial
+from typing import Dict, List, Any, Optional, Tuple, Union
 from dataclasses import dataclass, asdict
 from flask import Flask, request, jsonify, Blueprint
 from flask_cors import CORS
@@ -72,6 +75,49 @@ class UnifiedMemoryResponse:
     metadata: Dict[str, Any]
     timestamp: str
 
+def _take_top(results: Any, limit: Optional[int]) -> Any:
+    """Keep the first `limit` entries of a ranked result list"""
+    if limit is None:
+        return results
+    if isinstance(results, list):
+        return results[:limit]
+    if isinstance(results, dict) and isinstance(results.get('results'), list):
+        return {**results, 'results': results['results'][:limit]}
+    return results
+
+class RequestMemo:
+    """
+    Per-request memo of subsystem calls
+    
+    Calls run on the service's bounded thread pool, so independent subsystem
+    calls of a request proceed concurrently. A call with the key of an earlier
+    call of the same request shares its result instead of running again. For
+    ranked lookups taking a `limit`, an earlier call that asked for at least as
+    many results is reused and cut down to the requested length.
+    """
+    
+    def __init__(self, executor: ThreadPoolExecutor):
+        self.executor = executor
+        self._calls: Dict[tuple, Tuple[Optional[int], asyncio.Future]] = {}
+    
+    def run(self, func, *args, **kwargs) -> asyncio.Future:
+        """Run a blocking subsystem call on the thread pool without memoizing it"""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+    
+    async def call(self, key: tuple, func, *args, limit: Optional[int] = None, **kwargs) -> Any:
+        """Run `func` once per `key` and request, passing `limit` through when given"""
+        cached = self._calls.get(key)
+        if cached is not None:
+            cached_limit, future = cached
+            if cached_limit is None or (limit is not None and cached_limit >= limit):
+                return _take_top(await future, limit)
+        if limit is not None:
+            kwargs['limit'] = limit
+        future = self.run(func, *args, **kwargs)
+        self._calls[key] = (limit, future)
+        return await future
+
 class UnifiedMemoryService:
     """
     Unified Memory Service that orchestrates all memory subsystems
@@ -84,6 +130,12 @@ class UnifiedMemoryService:
         self.learning_adapter = None
         self.conversation_manager = None
         
+        # Bounded pool for the blocking subsystem calls of all requests
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('max_concurrent_calls', 8),
+            thread_name_prefix='unified-memory'
+        )
+        
         # Service status
         self.services_status = {
             'memory': False,
@@ -127,7 +179,6 @@ class UnifiedMemoryService:
                 learning_config = {
                     'patterns_db_path': './backend/memory/data/learning_patterns.json',
                     'feedback_db_path': './backend/memory/data/feedback_records.json',
-                    'vectorizer_path': './backend/memory/data/pattern_vectorizer.pkl',
                     'min_success_score': 0.7,
                     'max_patterns_per_type': 1000,
                     'pattern_decay_days': 30
@@ -175,24 +226,29 @@ class UnifiedMemoryService:
             conversation_state = {}
             recommendations = []
             
+            # Identical subsystem queries of this request run only once
+            memo = RequestMemo(self.executor)
+            
             # Route to appropriate operation
             if operation_type == 'store':
-                results = await self._handle_store_operation(request)
+                results = await self._handle_store_operation(request, memo)
             elif operation_type == 'search':
-                results = await self._handle_search_operation(request)
+                results = await self._handle_search_operation(request, memo)
             elif operation_type == 'chat':
-                results = await self._handle_chat_operation(request)
+                results = await self._handle_chat_operation(request, memo)
             elif operation_type == 'learn':
-                results = await self._handle_learn_operation(request)
+                results = await self._handle_learn_operation(request, memo)
             elif operation_type == 'analyze':
-                results = await self._handle_analyze_operation(request)
+                results = await self._handle_analyze_operation(request, memo)
             else:
                 raise ValueError(f"Unknown operation type: {operation_type}")
             
-            # Gather context from all subsystems
-            memory_context = await self._get_memory_context(request)
-            learning_insights = await self._get_learning_insights(request)
-            conversation_state = await self._get_conversation_state(request)
+            # Gather context from all subsystems concurrently, reusing the operation's queries
+            memory_context, learning_insights, conversation_state = await asyncio.gather(
+                self._get_memory_context(request, memo),
+                self._get_learning_insights(request, memo),
+                self._get_conversation_state(request)
+            )
             recommendations = await self._generate_recommendations(request, results)
             
             return UnifiedMemoryResponse(
@@ -221,14 +277,36 @@ class UnifiedMemoryService:
                 timestamp=datetime.now().isoformat()
             )
     
-    async def _handle_store_operation(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    def _search_memories(self, memo: RequestMemo, request: UnifiedMemoryRequest, limit: int):
+        """Memory search for the request content, shared by all callers within the request"""
+        return memo.call(
+            ('memory.search', str(request.content), request.user_id),
+            self.memory_instance.search,
+            query=str(request.content),
+            user_id=request.user_id,
+            limit=limit
+        )
+    
+    def _retrieve_patterns(self, memo: RequestMemo, request: UnifiedMemoryRequest,
+                           brain_region: Optional[str], limit: int):
+        """Learning pattern retrieval for the request content, shared by all callers within the request"""
+        return memo.call(
+            ('learning.retrieve_relevant_patterns', str(request.content), brain_region),
+            self.learning_adapter.retrieve_relevant_patterns,
+            query_context=str(request.content),
+            brain_region=brain_region,
+            limit=limit
+        )
+    
+    async def _handle_store_operation(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Handle memory storage operation"""
         results = {}
         
         # Store in memory system
         if self.memory_instance and self.services_status['memory']:
             try:
-                memory_result = self.memory_instance.add(
+                memory_result = await memo.run(
+                    self.memory_instance.add,
                     messages=request.content if isinstance(request.content, list) else [{"role": "user", "content": request.content}],
                     user_id=request.user_id,
                     metadata=request.metadata or {}
@@ -237,7 +315,8 @@ class UnifiedMemoryService:
                 
                 # Learn from successful storage
                 if self.learning_adapter and request.learning_enabled:
-                    self.learning_adapter.learn_from_interaction(
+                    await memo.run(
+                        self.learning_adapter.learn_from_interaction,
                         input_context=str(request.content),
                         output_result=f"Successfully stored in {request.brain_region or 'memory'}",
                         success_score=1.0,
@@ -251,43 +330,47 @@ class UnifiedMemoryService:
         
         return results
     
-    async def _handle_search_operation(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _handle_search_operation(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Handle memory search operation"""
         results = {}
         
         # Search memory system
         if self.memory_instance and self.services_status['memory']:
             try:
-                search_results = self.memory_instance.search(
-                    query=str(request.content),
-                    user_id=request.user_id,
+                # Search memories and get learning suggestions concurrently
+                calls = [self._search_memories(
+                    memo, request,
                     limit=request.context.get('limit', 5) if request.context else 5
-                )
-                results['memory'] = search_results
+                )]
+                with_suggestions = self.learning_adapter and request.learning_enabled
+                if with_suggestions:
+                    calls.append(self._retrieve_patterns(
+                        memo, request,
+                        brain_region=request.brain_region or 'CEREBELLUM',
+                        limit=3
+                    ))
+                outcomes = await asyncio.gather(*calls)
+                results['memory'] = outcomes[0]
                 
-                # Get learning suggestions
-                if self.learning_adapter and request.learning_enabled:
-                    suggestions = self.learning_adapter.get_improvement_suggestions(
-                        context=str(request.content),
-                        brain_region=request.brain_region or 'CEREBELLUM'
-                    )
-                    results['learning_suggestions'] = suggestions
+                if with_suggestions:
+                    results['learning_suggestions'] = self.learning_adapter.suggestions_from_patterns(outcomes[1])
                 
             except Exception as e:
                 results['memory'] = {'error': str(e)}
         
         return results
     
-    async def _handle_chat_operation(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _handle_chat_operation(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Handle chat operation with full system integration"""
         results = {}
         
         # Process through conversation system
-        if self.conversation_manager and request.conversation_enabled:
+        async def converse():
             try:
                 # Start or continue conversation
                 if not request.session_id:
-                    context = self.conversation_manager.start_conversation(
+                    context = await memo.run(
+                        self.conversation_manager.start_conversation,
                         user_id=request.user_id,
                         initial_message=str(request.content)
                     )
@@ -296,7 +379,8 @@ class UnifiedMemoryService:
                     session_id = request.session_id
                 
                 # Process message
-                conversation_result = self.conversation_manager.process_message(
+                conversation_result = await memo.run(
+                    self.conversation_manager.process_message,
                     session_id=session_id,
                     message=str(request.content),
                     message_type='user'
@@ -309,34 +393,38 @@ class UnifiedMemoryService:
                 results['conversation'] = {'error': str(e)}
         
         # Search relevant memories
-        if self.memory_instance and self.services_status['memory']:
+        async def search_memories():
             try:
-                memory_results = self.memory_instance.search(
-                    query=str(request.content),
-                    user_id=request.user_id,
-                    limit=3
-                )
-                results['relevant_memories'] = memory_results
+                results['relevant_memories'] = await self._search_memories(memo, request, limit=3)
                 
             except Exception as e:
                 results['relevant_memories'] = {'error': str(e)}
         
         # Get learning patterns
-        if self.learning_adapter and request.learning_enabled:
+        async def retrieve_patterns():
             try:
-                patterns = self.learning_adapter.retrieve_relevant_patterns(
-                    query_context=str(request.content),
+                results['learning_patterns'] = await self._retrieve_patterns(
+                    memo, request,
                     brain_region=request.brain_region,
                     limit=3
                 )
-                results['learning_patterns'] = patterns
                 
             except Exception as e:
                 results['learning_patterns'] = {'error': str(e)}
         
+        # The subsystems don't depend on each other, so query them concurrently
+        calls = []
+        if self.conversation_manager and request.conversation_enabled:
+            calls.append(converse())
+        if self.memory_instance and self.services_status['memory']:
+            calls.append(search_memories())
+        if self.learning_adapter and request.learning_enabled:
+            calls.append(retrieve_patterns())
+        await asyncio.gather(*calls)
+        
         return results
     
-    async def _handle_learn_operation(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _handle_learn_operation(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Handle learning operation"""
         results = {}
         
@@ -347,7 +435,8 @@ class UnifiedMemoryService:
                 success_score = context.get('success_score', 0.8)
                 pattern_type = context.get('pattern_type', 'general')
                 
-                pattern_id = self.learning_adapter.learn_from_interaction(
+                pattern_id = await memo.run(
+                    self.learning_adapter.learn_from_interaction,
                     input_context=str(request.content),
                     output_result=context.get('output_result', 'Learning recorded'),
                     success_score=success_score,
@@ -366,19 +455,15 @@ class UnifiedMemoryService:
         
         return results
     
-    async def _handle_analyze_operation(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _handle_analyze_operation(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Handle analysis operation across all systems"""
         results = {}
         
         # Memory analysis
-        if self.memory_instance and self.services_status['memory']:
+        async def analyze_memory():
             try:
                 # Search for related memories
-                memory_results = self.memory_instance.search(
-                    query=str(request.content),
-                    user_id=request.user_id,
-                    limit=10
-                )
+                memory_results = await self._search_memories(memo, request, limit=10)
                 
                 # Analyze memory patterns
                 analysis = {
@@ -393,12 +478,11 @@ class UnifiedMemoryService:
                 results['memory_analysis'] = {'error': str(e)}
         
         # Learning analysis
-        if self.learning_adapter and request.learning_enabled:
+        async def analyze_learning():
             try:
-                stats = self.learning_adapter.get_learning_stats()
-                patterns = self.learning_adapter.retrieve_relevant_patterns(
-                    query_context=str(request.content),
-                    limit=5
+                stats, patterns = await asyncio.gather(
+                    memo.run(self.learning_adapter.get_learning_stats),
+                    self._retrieve_patterns(memo, request, brain_region=None, limit=5)
                 )
                 
                 analysis = {
@@ -413,28 +497,33 @@ class UnifiedMemoryService:
                 results['learning_analysis'] = {'error': str(e)}
         
         # Conversation analysis
-        if self.conversation_manager and request.conversation_enabled:
+        async def analyze_conversations():
             try:
-                stats = self.conversation_manager.get_conversation_stats()
+                stats = await memo.run(self.conversation_manager.get_conversation_stats)
                 results['conversation_analysis'] = stats
                 
             except Exception as e:
                 results['conversation_analysis'] = {'error': str(e)}
         
+        calls = []
+        if self.memory_instance and self.services_status['memory']:
+            calls.append(analyze_memory())
+        if self.learning_adapter and request.learning_enabled:
+            calls.append(analyze_learning())
+        if self.conversation_manager and request.conversation_enabled:
+            calls.append(analyze_conversations())
+        await asyncio.gather(*calls)
+        
         return results
     
-    async def _get_memory_context(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _get_memory_context(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Get memory context for the request"""
         if not self.memory_instance or not self.services_status['memory']:
             return {}
         
         try:
-            # Get recent memories for context
-            recent_memories = self.memory_instance.search(
-                query=str(request.content),
-                user_id=request.user_id,
-                limit=3
-            )
+            # Get recent memories for context, usually answered by the operation's own search
+            recent_memories = await self._search_memories(memo, request, limit=3)
             
             return {
                 'recent_memories_count': len(recent_memories),
@@ -446,14 +535,14 @@ class UnifiedMemoryService:
             logger.error(f"Error getting memory context: {e}")
             return {}
     
-    async def _get_learning_insights(self, request: UnifiedMemoryRequest) -> Dict[str, Any]:
+    async def _get_learning_insights(self, request: UnifiedMemoryRequest, memo: RequestMemo) -> Dict[str, Any]:
         """Get learning insights for the request"""
         if not self.learning_adapter or not request.learning_enabled:
             return {}
         
         try:
-            patterns = self.learning_adapter.retrieve_relevant_patterns(
-                query_context=str(request.content),
+            patterns = await self._retrieve_patterns(
+                memo, request,
                 brain_region=request.brain_region,
                 limit=2
             )
@@ -569,6 +658,28 @@ unified_bp = Blueprint('unified', __name__, url_prefix='/api/unified')
 # Global unified service instance
 unified_service = None
 
+# Long-lived event loop the request handlers run their coroutines on
+loop = None
+loop_lock = threading.Lock()
+
+def start_event_loop():
+    """Start the asyncio event loop in a separate thread, once"""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='unified-memory-loop', daemon=True).start()
+    return loop
+
+def run_async(coro, timeout: Optional[float] = None):
+    """Run a coroutine on the service's event loop and wait for its result"""
+    future = asyncio.run_coroutine_threadsafe(coro, start_event_loop())
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
 def initialize_unified_service(config: Dict[str, Any]) -> bool:
     """Initialize the unified memory service"""
     global unified_service
@@ -661,15 +772,8 @@ def process_unified_request():
             conversation_enabled=data.get('conversation_enabled', True)
         )
 
-        # Process request asynchronously
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(
-                unified_service.process_unified_request(unified_request)
-            )
-        finally:
-            loop.close()
+        # Process request on the service's event loop
+        response = run_async(unified_service.process_unified_request(unified_request))
 
         # Convert response to dict
         response_dict = asdict(response)
@@ -708,15 +812,8 @@ def unified_store():
             learning_enabled=data.get('learning_enabled', True)
         )
 
-        # Process request
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(
-                unified_service.process_unified_request(store_request)
-            )
-        finally:
-            loop.close()
+        # Process request on the service's event loop
+        response = run_async(unified_service.process_unified_request(store_request))
 
         return jsonify(asdict(response))
 
@@ -749,15 +846,8 @@ def unified_search():
             learning_enabled=data.get('learning_enabled', True)
         )
 
-        # Process request
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(
-                unified_service.process_unified_request(search_request)
-            )
-        finally:
-            loop.close()
+        # Process request on the service's event loop
+        response = run_async(unified_service.process_unified_request(search_request))
 
         return jsonify(asdict(response))
 
@@ -792,15 +882,8 @@ def unified_chat():
             conversation_enabled=data.get('conversation_enabled', True)
         )
 
-        # Process request
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(
-                unified_service.process_unified_request(chat_request)
-            )
-        finally:
-            loop.close()
+        # Process request on the service's event loop
+        response = run_async(unified_service.process_unified_request(chat_request))
 
         return jsonify(asdict(response))
 
@@ -834,15 +917,8 @@ def unified_analyze():
             conversation_enabled=data.get('conversation_enabled', True)
         )
 
-        # Process request
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(
-                unified_service.process_unified_request(analyze_request)
-            )
-        finally:
-            loop.close()
+        # Process request on the service's event loop
+        response = run_async(unified_service.process_unified_request(analyze_request))
 
         return jsonify(asdict(response))
 
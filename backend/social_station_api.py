@@ -7,6 +7,8 @@ Connects the Social Station frontend to the PraisonAI Social Agent
 import os
 import json
 import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
@@ -38,6 +40,28 @@ connected_platforms = {
     "tiktok": False
 }
 
+# Long-lived event loop for the agent's coroutines, so its clients are reused across requests
+loop = None
+loop_lock = threading.Lock()
+
+def start_event_loop():
+    """Start the asyncio event loop in a separate thread, once"""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='social-agent-loop', daemon=True).start()
+    return loop
+
+def run_async(coro, timeout: float = None):
+    """Run a coroutine on the event loop and wait for its result"""
+    future = asyncio.run_coroutine_threadsafe(coro, start_event_loop())
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
 @app.route('/api/social-agent/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -63,12 +87,7 @@ def chat_with_agent():
             return jsonify({"error": "Social agent not available"}), 503
         
         # Process message through PraisonAI agent
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            social_agent.handle_chat_message(message)
-        )
-        loop.close()
+        result = run_async(social_agent.handle_chat_message(message))
         
         return jsonify(result)
         
@@ -112,12 +131,7 @@ def publish_post():
             })
         
         # Publish through PraisonAI agent
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            social_agent.publish_post(post)
-        )
-        loop.close()
+        result = run_async(social_agent.publish_post(post))
         
         # Store in published posts
         published_posts.append({
@@ -182,12 +196,7 @@ def schedule_post():
             })
         
         # Schedule through PraisonAI agent
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            social_agent.schedule_post(post, schedule_time)
-        )
-        loop.close()
+        result = run_async(social_agent.schedule_post(post, schedule_time))
         
         # Store in scheduled posts
         if result.get("success"):
@@ -263,12 +272,7 @@ def get_analytics():
             })
         
         # Get real analytics through PraisonAI agent
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            social_agent.get_analytics(platform, days)
-        )
-        loop.close()
+        result = run_async(social_agent.get_analytics(platform, days))
         
         return jsonify(result)
         
@@ -311,12 +315,7 @@ def connect_platform():
             })
         
         # Real connection through PraisonAI agent
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(
-            social_agent.connect_platform(platform, data.get('auth_data'))
-        )
-        loop.close()
+        result = run_async(social_agent.connect_platform(platform, data.get('auth_data')))
         
         if result.get("success"):
             connected_platforms[platform] = True